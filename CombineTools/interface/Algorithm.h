@@ -6,6 +6,7 @@
 #include "boost/range/end.hpp"
 #include "boost/regex.hpp"
 #include "boost/range/algorithm_ext/erase.hpp"
+#include "CombineHarvester/CombineTools/interface/CowVector.h"
 
 namespace ch {
 template <typename Range, typename Predicate>
@@ -40,7 +41,7 @@ bool contains_rgx(const std::vector<boost::regex>& r, T p) {
 template <typename Input, typename Filter, typename Converter>
 void FilterContaining(Input& in, Filter const& filter, Converter fn,
                       bool cond) {
-  boost::remove_erase_if(in, [&](typename Input::value_type const& p) {
+  ch::erase_if(in, [&](typename Input::value_type const& p) {
     return cond != ch::contains(filter, fn(p));
   });
 }
@@ -50,7 +51,7 @@ void FilterContainingRgx(Input& in, Filter const& filter, Converter fn,
                          bool cond) {
   std::vector<boost::regex> rgx;
   for (auto const& ele : filter) rgx.emplace_back(ele);
-  boost::remove_erase_if(in, [&](typename Input::value_type const& p) {
+  ch::erase_if(in, [&](typename Input::value_type const& p) {
     return cond != ch::contains_rgx(rgx, fn(p));
   });
 }
@@ -58,7 +59,7 @@ void FilterContainingRgx(Input& in, Filter const& filter, Converter fn,
 template <typename Input, typename Filter, typename Converter, typename Funcarg>
 void FilterContaining(Input& in, Filter const& filter, Converter fn, Funcarg arg,
                       bool cond) {
-  boost::remove_erase_if(in, [&](typename Input::value_type const& p) {
+  ch::erase_if(in, [&](typename Input::value_type const& p) {
     return cond != ch::contains(filter, fn(p,arg));
   });
 }
@@ -68,7 +69,7 @@ void FilterContainingRgx(Input& in, Filter const& filter, Converter fn, Funcarg
                          bool cond) {
   std::vector<boost::regex> rgx;
   for (auto const& ele : filter) rgx.emplace_back(ele);
-  boost::remove_erase_if(in, [&](typename Input::value_type const& p) {
+  ch::erase_if(in, [&](typename Input::value_type const& p) {
     return cond != ch::contains_rgx(rgx, fn(p,arg));
   });
 }
@@ -20,6 +20,7 @@
 #include "CombineHarvester/CombineTools/interface/Observation.h"
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
 #include "CombineHarvester/CombineTools/interface/HistMapping.h"
+#include "CombineHarvester/CombineTools/interface/CowVector.h"
 
 
 namespace ch {
@@ -118,6 +119,36 @@ class CombineHarvester {
   void WriteDatacard(std::string const& name, std::string const& root_file);
   void WriteDatacard(std::string const& name, TFile & root_file);
   void WriteDatacard(std::string const& name);
+
+  /**
+   * Save the contents of this instance to a compact binary file
+   *
+   * The snapshot contains the Observation, Process and Systematic entries
+   * with their histograms, the parameters (including their groups), the
+   * autoMCStats settings and any extra datacard lines. Histograms are
+   * stored as contiguous arrays of doubles in a single block at the end of
+   * the file.
+   *
+   * Only histogram-based models can be stored. An exception is thrown if
+   * any entry uses RooFit objects, or if there are workspaces other than
+   * the one holding simple rateParams.
+   *
+   * @param path Output file path
+   */
+  void SaveSnapshot(std::string const& path);
+
+  /**
+   * Add the contents of a file written by SaveSnapshot to this instance
+   *
+   * The file is memory-mapped and the histograms are built directly from
+   * the stored arrays, which is much faster than parsing the datacard and
+   * extracting the shapes again. As with ParseDatacard the new entries are
+   * added to any that already exist. If the file can't be read an exception
+   * is thrown and this instance is left unchanged.
+   *
+   * @param path Snapshot file path
+   */
+  void LoadSnapshot(std::string const& path);
   /**@}*/
 
   /**
@@ -165,6 +196,37 @@ class CombineHarvester {
   CombineHarvester& FilterProcs(Function func);
   template<typename Function>
   CombineHarvester& FilterSysts(Function func);
+
+  /**
+   * Build a persistent lookup index for the filter methods
+   *
+   * The index maps each value of the bin, process, era, channel, mass and
+   * systematic name properties to the Observation, Process and Systematic
+   * entries that have it. It is shared by all shallow copies made with cp()
+   * afterwards, and while a copy still holds the full set of objects the
+   * index was built from a filter on one of these properties is resolved
+   * directly from the index instead of scanning every object. This makes
+   * repeated `cb.cp().process({...}).bin({...})` calls on large instances
+   * much cheaper.
+   *
+   * Objects added to an instance with the Add and Insert methods are
+   * appended to its index in place. The filters only fall back to scanning
+   * the objects when a collection no longer matches the index, i.e. once
+   * objects have been removed from it, or after the bin, process, era,
+   * channel, mass or systematic name of any indexed object has actually been
+   * changed. BuildIndex can then be called again to index the current
+   * objects.
+   */
+  CombineHarvester& BuildIndex();
+
+  /**
+   * Drop the filter index of this instance
+   *
+   * Shallow copies that were made earlier keep their own reference to it.
+   */
+  void ClearIndex();
+
+  inline bool HasIndex() const { return bool(index_); }
   /**@}*/
 
 
@@ -329,6 +391,15 @@ class CombineHarvester {
    * available objects and evaluate the effect of all uncertainties. They
    * should be used at the end of a chain of filter methods to give the
    * desired yield, shape or uncertainty.
+   *
+   * If the flag "uncertainties-use-linear" is set the uncertainty methods
+   * and GetRateCovariance use a linear approximation instead: the
+   * derivatives of every yield and shape bin with respect to the parameters
+   * are found in a single pass and propagated with the fit covariance
+   * matrix, or the parameter uncertainties when no fit is given. The number
+   * of samples is then ignored. Only parameters acting via a Systematic are
+   * included, so cards relying on workspace parameters should keep the
+   * default sampling.
    */
   /**@{*/
   double GetRate();
@@ -359,9 +430,42 @@ class CombineHarvester {
    */
   TH1F GetShapeWithUncertainty(RooFitResult const* fit, unsigned n_samples);
   TH1F GetShapeWithUncertainty(RooFitResult const& fit, unsigned n_samples);
+
+  /**
+   * Evaluate GetShapeWithUncertainty for many selections at once
+   *
+   * Selection `i` contains the Process entries in bin `bins[i]` with a
+   * process name in `processes[i]`. An empty bin name or process list
+   * applies no selection on that property. The `n_samples` parameter
+   * vectors are drawn from the fit once and every selection is evaluated
+   * with each of them, which is much faster than calling
+   * GetShapeWithUncertainty on each selection in turn.
+   *
+   * @return One shape per selection, with the bin errors set to the
+   * sampled uncertainty
+   */
+  std::vector<TH1F> GetShapesWithUncertainty(
+      std::vector<std::string> const& bins,
+      std::vector<std::vector<std::string>> const& processes,
+      RooFitResult const& fit, unsigned n_samples);
   TH1F GetObservedShape();
 
   TH2F GetRateCovariance(RooFitResult const& fit, unsigned n_samples);
+
+  /**
+   * Sampled covariance matrix of the Process yields
+   *
+   * Entry `[i][j]` is the covariance between the total yields of the bin and
+   * process of the i-th and j-th Process entries, in the order they are
+   * stored. This is the matrix behind GetRateCovariance. The parameter
+   * vectors are drawn from the fit once per sample, and all yields of a
+   * sample are then evaluated together. The samples are spread over
+   * `n_threads` threads, or all available cores if zero. If any Process has
+   * a RooFit normalisation term the workspace has to be updated for every
+   * sample, and a single thread is used.
+   */
+  std::vector<std::vector<double>> GetRateCovarianceMatrix(
+      RooFitResult const& fit, unsigned n_samples, unsigned n_threads = 0);
   TH2F GetRateCorrelation(RooFitResult const& fit, unsigned n_samples);
   /**@}*/
 
@@ -410,6 +514,30 @@ class CombineHarvester {
   void AddSyst(CombineHarvester & target, std::string const& name,
                std::string const& type, Map const& valmap);
 
+  /**
+   * Add many Systematic entries in a single call
+   *
+   * Each index `i` of the input vectors describes one row of a table. Every
+   * Process in this instance with bin `bin[i]` and process `process[i]` gets
+   * a Systematic named `name[i]` of type `type[i]`, added to `target`. The
+   * name may contain the same placeholders as in AddSyst. For lnN and lnU
+   * entries a `val_d[i]` of zero gives a symmetric value `val_u[i]`, while
+   * any other value gives an asymmetric `val_d[i]/val_u[i]` entry. For shape
+   * entries `val_u[i]` sets the scale.
+   *
+   * This is equivalent to calling AddSyst once per row with a SystMap on
+   * bin and process, but the processes are only looped over once in total.
+   *
+   * @return The number of Systematic entries that were created
+   */
+  unsigned AddSystBulk(CombineHarvester& target,
+                       std::vector<std::string> const& bin,
+                       std::vector<std::string> const& process,
+                       std::vector<std::string> const& name,
+                       std::vector<std::string> const& type,
+                       std::vector<double> const& val_d,
+                       std::vector<double> const& val_u);
+
   void ExtractShapes(std::string const& file, std::string const& rule,
                      std::string const& syst_rule);
   void ExtractPdfs(CombineHarvester& target, std::string const& ws_name,
@@ -467,9 +595,11 @@ class CombineHarvester {
   // ---------------------------------------------------------------
   // Main data members
   // ---------------------------------------------------------------
-  std::vector<std::shared_ptr<Observation>> obs_;
-  std::vector<std::shared_ptr<Process>> procs_;
-  std::vector<std::shared_ptr<Systematic>> systs_;
+  // Storage is shared with any copies made by cp() until either side adds or
+  // removes objects
+  CowVector<std::shared_ptr<Observation>> obs_;
+  CowVector<std::shared_ptr<Process>> procs_;
+  CowVector<std::shared_ptr<Systematic>> systs_;
   std::map<std::string, std::shared_ptr<Parameter>> params_;
   std::map<std::string, std::shared_ptr<RooWorkspace>> wspaces_;
 
@@ -492,6 +622,70 @@ class CombineHarvester {
   std::map<std::string, AutoMCStatsSettings> auto_stats_settings_;
   std::vector<std::string> post_lines_;
 
+  // ---------------------------------------------------------------
+  // Filter index
+  // --> implementation in src/CombineHarvester_Filters.cc
+  // ---------------------------------------------------------------
+  typedef std::unordered_map<std::string, std::vector<unsigned>> IndexKeyMap;
+
+  template <typename T>
+  struct CollectionIndex {
+    CowVector<std::shared_ptr<T>> base;
+    std::map<std::string, IndexKeyMap> keys;
+    // The value of Object::key_edits() when the index was built
+    unsigned long edits;
+  };
+
+  struct FilterIndex {
+    CollectionIndex<Observation> obs;
+    CollectionIndex<Process> procs;
+    CollectionIndex<Systematic> systs;
+  };
+
+  std::shared_ptr<FilterIndex> index_;
+
+  CollectionIndex<Observation> const* obs_index() const {
+    return index_ ? &(index_->obs) : nullptr;
+  }
+  CollectionIndex<Process> const* procs_index() const {
+    return index_ ? &(index_->procs) : nullptr;
+  }
+  CollectionIndex<Systematic> const* systs_index() const {
+    return index_ ? &(index_->systs) : nullptr;
+  }
+
+  template <typename T, typename Converter>
+  static void FilterIndexed(CowVector<std::shared_ptr<T>>& in,
+                            CollectionIndex<T> const* idx,
+                            std::string const& key,
+                            std::vector<std::string> const& vec, Converter fn,
+                            bool cond);
+
+  // True if the index still describes exactly the objects in `coll`
+  template <typename T>
+  static bool IndexCurrent(CowVector<std::shared_ptr<T>> const& coll,
+                           CollectionIndex<T> const& idx) {
+    return coll.size() == idx.base.size() && idx.edits == Object::key_edits();
+  }
+
+  static void IndexKeys(Observation const& obs, unsigned i,
+                        CollectionIndex<Observation>* idx);
+  static void IndexKeys(Process const& proc, unsigned i,
+                        CollectionIndex<Process>* idx);
+  static void IndexKeys(Systematic const& sys, unsigned i,
+                        CollectionIndex<Systematic>* idx);
+
+  // Adds an object to one of the collections, keeping the index up to date
+  template <typename T>
+  void AppendIndexed(CowVector<std::shared_ptr<T>>& coll,
+                     CollectionIndex<T> FilterIndex::*member,
+                     std::shared_ptr<T> const& obj);
+
+  // Drops this instance's reference to the index once any of its
+  // collections no longer matches it, so that the index is not copied
+  // when objects are later added to an instance it is shared with
+  void ReleaseStaleIndex();
+
   // ---------------------------------------------------------------
   // typedefs
   // ---------------------------------------------------------------
@@ -522,6 +716,14 @@ class CombineHarvester {
                                     std::string const& bin,
                                     std::vector<HistMapping> const& mappings);
 
+  // Reads the TH1 objects that LoadShapes will need for the bins, processes
+  // and shape systematics of a datacard into the process-wide cache, in
+  // parallel and in the order they will be used, stopping before the cache
+  // is full. Implementation in src/CombineHarvester_Datacards.cc
+  void PrefetchShapes(std::vector<std::vector<std::string>> const& words,
+                      std::string const& mass,
+                      std::vector<HistMapping> const& mappings);
+
   StrPairVec GenerateShapeMapAttempts(std::string process,
       std::string category);
 
@@ -556,7 +758,76 @@ void FillHistMappings(std::vector<HistMapping> & mappings);
   // --> implementation in src/CombineHarvester_Evaluate.cc
   // ---------------------------------------------------------------
   typedef std::vector<std::vector<Systematic const*>> ProcSystMap;
-  ProcSystMap GenerateProcSystMap();
+
+  // The last ProcSystMap that was built, together with the Process and
+  // Systematic entries it was built from and the value of object_edits_ at
+  // that point. It is reused for as long as all of these are unchanged.
+  struct ProcSystCache {
+    std::vector<Process const*> procs;
+    std::vector<Systematic const*> systs;
+    unsigned long edits;
+    ProcSystMap lookup;
+  };
+  std::shared_ptr<ProcSystCache const> proc_syst_cache_;
+
+  // Counts the calls to the ForEach methods and RenameSystematic, which may
+  // change the properties that the evaluation cache matches objects on. As
+  // objects are shared between instances this has to be tracked globally.
+  static unsigned long object_edits_;
+
+  // The returned reference stays valid until the next call
+  ProcSystMap const& GenerateProcSystMap();
+
+  // Draw n_samples parameter vectors from the fit result. Each row of
+  // samples holds one value per entry of the returned vector, which lists
+  // the ch::Parameter objects that were sampled.
+  std::vector<ch::Parameter*> SampleParameters(
+      RooFitResult const& fit, unsigned n_samples,
+      std::vector<std::vector<double>> & samples);
+
+  // The rate dependence of each Process, reduced to the list of Systematic
+  // entries that scale it. The slot is the column of the parameter in the
+  // sampled values, or -1 if it is not sampled, in which case the value x
+  // is used.
+  struct RateTerm {
+    Systematic const* sys;
+    int slot;
+    double x;
+  };
+  typedef std::vector<std::vector<RateTerm>> RateTermMap;
+
+  RateTermMap BuildRateTerms(ProcSystMap const& lookup,
+                             std::vector<ch::Parameter*> const& sampled);
+
+  double EvalRateTerms(std::vector<RateTerm> const& terms,
+                       double const* vals) const;
+
+  // ---------------------------------------------------------------
+  // Linearised uncertainties, used instead of the +/-1 sigma shifts and
+  // sampling when the flag "uncertainties-use-linear" is set. Each yield
+  // or shape bin is expanded to first order in the parameters and the
+  // uncertainty is given by J.C.J^T, with C the fit covariance (or the
+  // parameter errors if fit is null). Parameters that only enter through
+  // RooFit objects in a workspace are not included.
+  // ---------------------------------------------------------------
+  std::vector<ch::Parameter*> GetParameterCovariance(
+      RooFitResult const* fit, std::vector<std::vector<double>> & cov);
+
+  double LogRateDerivative(Systematic const* sys, double x) const;
+
+  std::vector<std::vector<double>> GetRateJacobian(
+      ProcSystMap const& lookup, std::vector<ch::Parameter*> const& pars);
+
+  std::vector<std::vector<double>> GetShapeJacobian(
+      ProcSystMap const& lookup, std::vector<ch::Parameter*> const& pars,
+      TH1F & shape);
+
+  double GetUncertaintyLinear(RooFitResult const* fit);
+  TH1F GetShapeWithUncertaintyLinear(RooFitResult const* fit);
+  std::vector<std::vector<double>> GetRateCovarianceLinear(
+      RooFitResult const* fit);
+
+  TH1F PdfShapeInternal(Process * proc);
 
   double GetRateInternal(ProcSystMap const& lookup,
     std::string const& single_sys = "");
@@ -622,19 +893,42 @@ void CombineHarvester::ForEachObj(Function func) {
 
 template<typename Function>
 void CombineHarvester::ForEachProc(Function func) {
+  ++object_edits_;
   for (auto & item: procs_) func(item.get());
 }
 
 template<typename Function>
 void CombineHarvester::ForEachObs(Function func) {
+  ++object_edits_;
   for (auto & item: obs_) func(item.get());
 }
 
 template<typename Function>
 void CombineHarvester::ForEachSyst(Function func) {
+  ++object_edits_;
   for (auto & item: systs_) func(item.get());
 }
 
+template <typename T>
+void CombineHarvester::AppendIndexed(CowVector<std::shared_ptr<T>>& coll,
+                                     CollectionIndex<T> FilterIndex::*member,
+                                     std::shared_ptr<T> const& obj) {
+  if (index_ && !IndexCurrent(coll, (*index_).*member)) index_.reset();
+  if (!index_) {
+    coll.push_back(obj);
+    return;
+  }
+  if (index_.use_count() > 1) index_ = std::make_shared<FilterIndex>(*index_);
+  CollectionIndex<T>& idx = (*index_).*member;
+  // Release the index's reference to the storage first, so that it is not
+  // copied by the push_back
+  idx.base.clear();
+  coll.push_back(obj);
+  idx.base = coll;
+  IndexKeys(*obj, coll.size() - 1, &idx);
+  obj->set_indexed();
+}
+
 template<typename Function>
 CombineHarvester& CombineHarvester::FilterAll(Function func) {
   FilterObs(func);
@@ -645,24 +939,27 @@ CombineHarvester& CombineHarvester::FilterAll(Function func) {
 
 template<typename Function>
 CombineHarvester& CombineHarvester::FilterObs(Function func) {
-  boost::remove_erase_if(
+  ch::erase_if(
       obs_, [&](std::shared_ptr<Observation> ptr) { return func(ptr.get());
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
 template<typename Function>
 CombineHarvester& CombineHarvester::FilterProcs(Function func) {
-  boost::remove_erase_if(
+  ch::erase_if(
       procs_, [&](std::shared_ptr<Process> ptr) { return func(ptr.get());
   });
+  ReleaseStaleIndex();
   return *this;
 }
 template<typename Function>
 CombineHarvester& CombineHarvester::FilterSysts(Function func) {
-  boost::remove_erase_if(
+  ch::erase_if(
       systs_, [&](std::shared_ptr<Systematic> ptr) { return func(ptr.get());
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
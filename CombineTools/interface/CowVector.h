@@ -0,0 +1,109 @@
+#ifndef CombineTools_CowVector_h
+#define CombineTools_CowVector_h
+#include <algorithm>
+#include <memory>
+#include <utility>
+#include <vector>
+
+namespace ch {
+
+/**
+ * A vector whose storage is shared between copies until one of them is
+ * modified
+ *
+ * Copying a CowVector only copies a pointer to the underlying storage, so
+ * the shallow copies made by CombineHarvester::cp() no longer duplicate the
+ * full list of object pointers. Elements can only be read through const
+ * references; the storage is duplicated the first time a copy adds,
+ * replaces or removes an element while another copy still refers to it.
+ * Removing elements from shared storage builds the reduced vector directly,
+ * so a copy followed by a filter only ever allocates the selected subset.
+ */
+template <typename T>
+class CowVector {
+ public:
+  typedef T value_type;
+  typedef typename std::vector<T>::size_type size_type;
+  typedef typename std::vector<T>::const_iterator const_iterator;
+  typedef const_iterator iterator;
+
+  CowVector() : data_(std::make_shared<std::vector<T>>()) {}
+  CowVector(std::vector<T> vec)
+      : data_(std::make_shared<std::vector<T>>(std::move(vec))) {}
+  // No move operations, so that a moved-from instance is never left without
+  // storage. Copying is already only the cost of a shared_ptr copy.
+  CowVector(CowVector const& other) = default;
+  CowVector& operator=(CowVector const& other) = default;
+
+  const_iterator begin() const { return data_->begin(); }
+  const_iterator end() const { return data_->end(); }
+  size_type size() const { return data_->size(); }
+  bool empty() const { return data_->empty(); }
+  T const& operator[](size_type i) const { return (*data_)[i]; }
+  T const& front() const { return data_->front(); }
+  T const& back() const { return data_->back(); }
+
+  /**
+   * The underlying vector, which may be shared with other copies
+   */
+  std::vector<T> const& vec() const { return *data_; }
+
+  /**
+   * True if this and `other` currently refer to the same storage
+   */
+  bool SharesWith(CowVector const& other) const {
+    return data_ == other.data_;
+  }
+
+  void push_back(T const& val) { mut().push_back(val); }
+  void reserve(size_type n) { mut().reserve(n); }
+  void resize(size_type n) { mut().resize(n); }
+  void set(size_type i, T const& val) { mut()[i] = val; }
+  void assign(std::vector<T> vec) {
+    data_ = std::make_shared<std::vector<T>>(std::move(vec));
+  }
+  void clear() { data_ = std::make_shared<std::vector<T>>(); }
+
+  /**
+   * Remove all elements for which `pred` returns true
+   */
+  template <typename Predicate>
+  void erase_if(Predicate pred) {
+    if (data_.use_count() == 1) {
+      data_->erase(std::remove_if(data_->begin(), data_->end(), pred),
+                   data_->end());
+      return;
+    }
+    auto res = std::make_shared<std::vector<T>>();
+    for (auto const& val : *data_) {
+      if (!pred(val)) res->push_back(val);
+    }
+    data_ = res;
+  }
+
+  void swap(CowVector& other) { data_.swap(other.data_); }
+
+ private:
+  std::shared_ptr<std::vector<T>> data_;
+
+  // Detaches from any other copies before the storage is modified
+  std::vector<T>& mut() {
+    if (data_.use_count() > 1) {
+      data_ = std::make_shared<std::vector<T>>(*data_);
+    }
+    return *data_;
+  }
+};
+
+template <typename T>
+void swap(CowVector<T>& first, CowVector<T>& second) {
+  first.swap(second);
+}
+
+template <typename T, typename Predicate>
+void erase_if(CowVector<T>& r, Predicate p) {
+  r.erase_if(p);
+}
+}
+
+#endif
@@ -13,10 +13,12 @@ class Object {
   Object(Object&& other);
   Object& operator=(Object other);
 
-  virtual void set_bin(std::string const& bin) { bin_ = bin; }
+  virtual void set_bin(std::string const& bin) { SetKey(&bin_, bin); }
   virtual std::string const& bin() const { return bin_; }
 
-  virtual void set_process(std::string const& process) { process_ = process; }
+  virtual void set_process(std::string const& process) {
+    SetKey(&process_, process);
+  }
   virtual std::string const& process() const { return process_; }
 
   void set_signal(bool const& signal) { signal_ = signal; }
@@ -25,16 +27,18 @@ class Object {
   virtual void set_analysis(std::string const& analysis) { analysis_ = analysis; }
   virtual std::string const& analysis() const { return analysis_; }
 
-  virtual void set_era(std::string const& era) { era_ = era; }
+  virtual void set_era(std::string const& era) { SetKey(&era_, era); }
   virtual std::string const& era() const { return era_; }
 
-  virtual void set_channel(std::string const& channel) { channel_ = channel; }
+  virtual void set_channel(std::string const& channel) {
+    SetKey(&channel_, channel);
+  }
   virtual std::string const& channel() const { return channel_; }
 
   virtual void set_bin_id(int const& bin_id) { bin_id_ = bin_id; }
   virtual int bin_id() const { return bin_id_; }
 
-  virtual void set_mass(std::string const& mass) { mass_ = mass; }
+  virtual void set_mass(std::string const& mass) { SetKey(&mass_, mass); }
   virtual std::string const& mass() const { return mass_; }
 
   virtual void set_attribute(std::string const& attr_label, std::string const& attr_value);
@@ -43,6 +47,24 @@ class Object {
   virtual std::map<std::string,std::string> const& all_attributes() const { return attributes_;}
   virtual std::string const attribute(std::string const& attr_label) const { return attributes_.count(attr_label) >0 ? attributes_.at(attr_label) : "" ; }
 
+  // Marks this object as being in a CombineHarvester filter index, after
+  // which any change to the properties used as index keys is counted
+  void set_indexed() { indexed_ = true; }
+  bool indexed() const { return indexed_; }
+
+  // The number of changes made so far to the index key properties (bin,
+  // process, era, channel, mass and systematic name) of objects that are in
+  // a filter index. An index is out of date once this has moved on from the
+  // value it was built with.
+  static unsigned long key_edits() { return key_edits_; }
+
+ protected:
+  // Sets one of the index key properties
+  void SetKey(std::string* prop, std::string const& val) {
+    if (indexed_ && *prop != val) ++key_edits_;
+    *prop = val;
+  }
+
  private:
   std::string bin_;
   std::string process_;
@@ -53,6 +75,9 @@ class Object {
   int bin_id_;
   std::string mass_;
   std::map<std::string,std::string> attributes_;
+  // Not copied or swapped, as it belongs to this instance of the object
+  bool indexed_;
+  static unsigned long key_edits_;
   friend void swap(Object& first, Object& second);
 };
 }
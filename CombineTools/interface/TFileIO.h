@@ -1,7 +1,9 @@
 #ifndef CombineTools_TFileIO_h
 #define CombineTools_TFileIO_h
+#include <map>
 #include <memory>
 #include <string>
+#include <utility>
 #include <vector>
 #include "boost/algorithm/string.hpp"
 #include "TFile.h"
@@ -11,8 +13,32 @@
 
 namespace ch {
 
+// Objects read from files opened in READ mode are kept in the process-wide
+// cache below, so repeated calls for the same object only pay for the clone
 std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path);
 
+// Process-wide cache of opened ROOT files and of the TH1 objects read from
+// them. Entries are keyed on the file path, the object path and the
+// modification time of the file, so a file that has been rewritten since it
+// was cached is read again. The files are limited by number and the
+// histograms by an estimate of their memory use, dropping the least recently
+// used entries first. Setting max_hist_bytes to zero disables the TH1 cache.
+std::shared_ptr<TFile> GetCachedTFile(std::string const& path);
+void SetTFileCacheLimits(unsigned max_files, std::size_t max_hist_bytes);
+void ClearTFileCache();
+
+// Reads the TH1 objects, given as (file path, object path) pairs in the order
+// they will be used, into the cache using up to n_threads threads (zero uses
+// all available cores) that each open their own file handles. Only as many
+// objects are read as are estimated to fit in the TH1 cache, so that none are
+// evicted before they are used, and hit_limit, if given, is set to true when
+// some had to be left out. Objects that are missing or not a TH1 are skipped
+// here and only reported when they are requested. Returns the number of
+// histograms read.
+unsigned PrefetchTH1s(
+    std::vector<std::pair<std::string, std::string>> const& objects,
+    unsigned n_threads = 0, bool* hit_limit = nullptr);
+
 template <class T>
 void WriteToTFile(T * ptr, TFile* file, std::string const& path);
 
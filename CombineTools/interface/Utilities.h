@@ -55,6 +55,27 @@ bool MatchingProcess(T const& first, U const& second) {
   }
 }
 
+/**
+ * Build a key that is identical for two objects exactly when
+ * ch::MatchingProcess would return true for them
+ *
+ * Useful for matching large collections of objects through a hash lookup
+ * instead of comparing every pair.
+ */
+template<class T>
+std::string MatchingProcessKey(T const& obj) {
+  std::string key;
+  for (std::string const* prop :
+       {&obj.bin(), &obj.process(), &obj.analysis(), &obj.era(),
+        &obj.channel(), &obj.mass()}) {
+    key += *prop;
+    key += '\0';
+  }
+  key += obj.signal() ? '1' : '0';
+  key += boost::lexical_cast<std::string>(obj.bin_id());
+  return key;
+}
+
 template<class T, class U>
 void SetProperties(T * first, U const* second) {
   first->set_bin(second->bin());
@@ -130,6 +130,44 @@ def AddSyst(self, target, name, type, valmap):
         for proc in added_procs:
             print proc
 
+# Returns the sampled yield covariance as a NumPy array, see the C++
+# CombineHarvester::GetRateCovarianceMatrix for details
+
+
+def GetRateCovarianceMatrix(self, fit, n_samples, n_threads=0):
+    import numpy as np
+    return np.array(self.__GetRateCovarianceMatrix__(fit, n_samples, n_threads))
+
+# Takes a list of (bin, processes) selections, where processes can be a
+# single name or a list of names, and returns the list of shapes with the
+# sampled uncertainties as bin errors
+
+
+def GetShapesWithUncertainty(self, selections, fit, n_samples):
+    bins = [str(sel[0]) for sel in selections]
+    procs = [[sel[1]] if isinstance(sel[1], str) else list(sel[1]) for sel in selections]
+    return self.__GetShapesWithUncertainty__(bins, procs, fit, n_samples)
+
+# Bulk version of AddSyst: the table holds one row per (bin, process, name,
+# type, kappa_down, kappa_up) entry and is passed to C++ in a single call.
+# It can be a NumPy structured array or a dict of column lists using these
+# field names, or a plain list of row tuples in this order. A kappa_down of
+# zero gives a symmetric lnN/lnU entry.
+BULK_SYST_COLUMNS = ['bin', 'process', 'name', 'type', 'kappa_down', 'kappa_up']
+
+
+def AddSystBulk(self, target, table):
+    if hasattr(table, 'dtype') or isinstance(table, dict):
+        cols = [table[col] for col in BULK_SYST_COLUMNS]
+    else:
+        cols = zip(*table) if len(table) > 0 else [[]] * len(BULK_SYST_COLUMNS)
+    cols = [col.tolist() if hasattr(col, 'tolist') else list(col) for col in cols]
+    for i in range(4):
+        cols[i] = [str(x) for x in cols[i]]
+    for i in range(4, 6):
+        cols[i] = [float(x) for x in cols[i]]
+    return self.__AddSystBulk__(target, *cols)
+
 # Now we turn these free functions into member functions
 # of the CombineHarvester class
 CombineHarvester.ParseDatacard = ParseDatacard
@@ -140,3 +178,6 @@ CombineHarvester.SetFromObs = SetFromObs
 CombineHarvester.SetFromProcs = SetFromProcs
 CombineHarvester.SetFromSysts = SetFromSysts
 CombineHarvester.AddSyst = AddSyst
+CombineHarvester.AddSystBulk = AddSystBulk
+CombineHarvester.GetRateCovarianceMatrix = GetRateCovarianceMatrix
+CombineHarvester.GetShapesWithUncertainty = GetShapesWithUncertainty
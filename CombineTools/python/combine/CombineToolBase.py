@@ -1,7 +1,12 @@
 import os
 import stat
+import json
+import shlex
+import atexit
 from functools import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from CombineHarvester.CombineTools.combine.LocalScheduler import LocalScheduler, add_to_dag_file
 
 DRY_RUN = False
 
@@ -87,12 +92,262 @@ def run_command(dry_run, command, pre_cmd=''):
         print '[DRY-RUN]: ' + command
 
 
+def parse_combine_command(command):
+    """Splits a single call to combine, optionally wrapped in
+    "pushd DIR; ...; popd", into the directory it runs in and a dict of its
+    options. Returns None if the command is anything else"""
+    parts = [x.strip() for x in command.split(';') if x.strip()]
+    directory = ''
+    if len(parts) == 3 and parts[0].startswith('pushd ') and parts[2] == 'popd':
+        directory = parts[0][len('pushd '):].strip()
+        parts = parts[1:2]
+    if len(parts) != 1 or not parts[0].startswith('combine '):
+        return None
+    try:
+        args = shlex.split(parts[0])[1:]
+    except ValueError:
+        return None
+    opts = {}
+    for i, arg in enumerate(args):
+        key, val = arg, args[i + 1] if i + 1 < len(args) else None
+        if '=' in arg and arg.startswith('--'):
+            key, val = arg.split('=', 1)
+        opts[key] = val
+    return (directory, opts)
+
+
+def get_opt(opts, names, default=None):
+    for name in names:
+        if name in opts:
+            return opts[name]
+    return default
+
+
+def combine_output_file(command):
+    """Works out the name of the file that a single call to combine will
+    write. Returns None for other commands, or if the name can't be
+    predicted, e.g. when a random seed is used"""
+    parsed = parse_combine_command(command)
+    if parsed is None:
+        return None
+    directory, opts = parsed
+    get = partial(get_opt, opts)
+    if '--keyword-value' in opts:
+        return None
+    method = get(['-M', '--method'])
+    if method is None:
+        return None
+    try:
+        mass = float(get(['-m', '--mass'], '120'))
+        seed = int(get(['-s', '--seed'], '123456'))
+        toys = int(get(['-t', '--toys'], '0'))
+        quantile = get(['--expectedFromGrid'])
+        if quantile is not None:
+            quantile = float(quantile)
+    except ValueError:
+        return None
+    if seed == -1:
+        return None
+    toy_name = ''
+    if toys > 0 or seed != 123456 or '--saveToys' in opts:
+        toy_name += '%i.' % seed
+    if quantile is not None:
+        toy_name += 'quant%.3f.' % quantile
+    filename = 'higgsCombine%s.%s.mH%g.%sroot' % (
+        get(['-n', '--name'], 'Test'), method, mass, toy_name)
+    return os.path.join(directory, filename)
+
+
+def cost_key(command):
+    """The label under which the wall-times of similar commands are grouped:
+    the combine method, or otherwise the name of the program"""
+    parsed = parse_combine_command(command)
+    if parsed is not None:
+        return 'combine:%s' % get_opt(parsed[1], ['-M', '--method'], 'unknown')
+    words = command.split()
+    return words[0] if words else ''
+
+
+def estimate_cost(command):
+    """A rough estimate of how long a command will take relative to a single
+    fit: the number of toys times the number of points for a combine call,
+    and 1 for anything else"""
+    parsed = parse_combine_command(command)
+    if parsed is None:
+        return 1.
+    get = partial(get_opt, parsed[1])
+    try:
+        cost = 1.
+        toys = int(get(['-t', '--toys'], '0'))
+        if toys > 0:
+            cost *= toys
+        if get(['-M', '--method']) == 'HybridNew':
+            cost *= int(get(['-T', '--toysH'], '500')) * int(get(['-i', '--iterations'], '1'))
+        first, last = get(['--firstPoint']), get(['--lastPoint'])
+        if first is not None and last is not None:
+            cost *= int(last) - int(first) + 1
+        elif get(['--points']) is not None:
+            cost *= int(get(['--points']))
+        fixed = get(['--fixedPointPOIs'])
+        if fixed is not None:
+            cost *= fixed.count(':') + 1
+    except ValueError:
+        return 1.
+    return cost
+
+
+WALLTIME_MARKER = '[combineTool] walltime='
+
+
+def walltime_lines(command, cost, do_log=False, logname=''):
+    """Lines to surround a command in a job script with, such that it prints
+    its wall-time in a form that parse_walltime_logs can read"""
+    line = 'echo "%s$(( $(date +%%s) - CT_START )) key=%s cost=%g"' % (
+        WALLTIME_MARKER, cost_key(command), cost)
+    if do_log:
+        line += ' | tee -a %s' % logname
+    return ('CT_START=$(date +%s)\n', line + '\n')
+
+
+def parse_walltime_logs(filenames):
+    """Reads the wall-times of earlier jobs from the logs of batch jobs made
+    with walltime_lines, or from the logs of the local job-mode. Returns a
+    dict of the median number of seconds per unit of estimate_cost for each
+    cost_key"""
+    per_unit = {}
+    for filename in filenames:
+        try:
+            with open(filename) as logfile:
+                lines = logfile.readlines()
+        except IOError:
+            print '>> Warning, could not read log file %s' % filename
+            continue
+        command = None
+        for line in lines:
+            if line.startswith(WALLTIME_MARKER):
+                fields = dict(x.split('=', 1) for x in line.split() if '=' in x)
+                try:
+                    key = fields['key']
+                    seconds = float(fields['walltime'])
+                    cost = float(fields['cost'])
+                except (KeyError, ValueError):
+                    continue
+            elif line.startswith('>> [attempt '):
+                # The local job-mode logs the command, then how it finished
+                status = line.split('] ', 1)[1].strip()
+                if status.startswith('exit code 0 after ') and command is not None:
+                    key, cost = cost_key(command), estimate_cost(command)
+                    seconds = float(status.rsplit(' ', 1)[1].rstrip('s'))
+                elif not status.startswith('exit code ') and not status.startswith('timed out '):
+                    command = status
+                    continue
+                else:
+                    continue
+            else:
+                continue
+            if cost > 0:
+                per_unit.setdefault(key, []).append(seconds / cost)
+    return dict((key, sorted(vals)[len(vals) // 2]) for key, vals in per_unit.iteritems())
+
+
+def pack_by_cost(commands, costs, target):
+    """Splits the commands into groups whose total cost is at most target,
+    using the first-fit decreasing heuristic. A command that costs more than
+    target on its own gets a group to itself. The commands keep their
+    original order within each group"""
+    bins = []
+    for i in sorted(xrange(len(commands)), key=lambda i: -costs[i]):
+        for b in bins:
+            if b[0] + costs[i] <= target:
+                b[0] += costs[i]
+                b[1].append(i)
+                break
+        else:
+            bins.append([costs[i], [i]])
+    groups = [sorted(b[1]) for b in bins]
+    groups.sort(key=lambda g: g[0])
+    return [[commands[i] for i in g] for g in groups]
+
+
+def probe_output_file(filename):
+    # The import is here so that ROOT is only loaded when files are checked
+    import CombineHarvester.CombineTools.plotting as plot
+    return plot.TFileIsGood(filename)
+
+
+def stat_file(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+def outputs_are_good(filenames, cache_file=None, processes=None):
+    """Returns a list of bools telling whether each of the files exists and
+    passes plotting.TFileIsGood. The results are stored in the json
+    cache_file along with the mtime and size of each file, and files that
+    have not changed since are not opened again. The remaining files are
+    opened in parallel"""
+    paths = [os.path.abspath(x) for x in filenames]
+    if len(paths) == 0:
+        return []
+    # os.stat is mostly waiting on the filesystem, so can use many threads
+    pool = ThreadPool(16)
+    stats = pool.map(stat_file, paths)
+    pool.close()
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file) as jsonfile:
+            cache = json.load(jsonfile)
+    res = [False] * len(paths)
+    todo = []
+    for i, (path, st) in enumerate(zip(paths, stats)):
+        if st is None:
+            cache.pop(path, None)
+            continue
+        entry = cache.get(path)
+        if entry is not None and (entry['mtime'], entry['size']) == st:
+            res[i] = entry['good']
+        else:
+            todo.append(i)
+    if len(todo) > 0:
+        print '>> Checking %i output files' % len(todo)
+        if processes is None:
+            processes = cpu_count()
+        if processes > 1 and len(todo) > 1:
+            pool = Pool(processes=min(processes, len(todo)))
+            probed = pool.map(probe_output_file, [paths[i] for i in todo])
+            pool.close()
+            pool.join()
+        else:
+            probed = [probe_output_file(paths[i]) for i in todo]
+        for i, good in zip(todo, probed):
+            res[i] = good
+            cache[paths[i]] = {'mtime': stats[i][0], 'size': stats[i][1], 'good': good}
+    if cache_file is not None:
+        with open(cache_file, 'w') as jsonfile:
+            json.dump(cache, jsonfile)
+    return res
+
+
 class CombineToolBase:
     description = 'Base class that passes through all arguments to combine and handles job creation and submission'
     requires_root = False
 
     def __init__(self):
         self.job_queue = []
+        # Maps the index of a command in job_queue to the indices of the
+        # commands that must finish before it [only used by local job-mode]
+        self.job_deps = {}
+        # Maps the index of a command in job_queue to the file(s) it will
+        # create, for commands where this can't be inferred automatically
+        self.job_outputs = {}
+        # Maps the index of a command in job_queue to an estimate of its cost
+        # in the same units as estimate_cost
+        self.job_costs = {}
+        self.n_local_jobs = 0
+        self.worker_pool = None
         self.args = None
         self.passthru = []
         self.job_mode = 'interactive'
@@ -106,16 +361,28 @@ class CombineToolBase:
         self.custom_crab_post = None
         self.pre_cmd = ''
         self.crab_files = []
+        self.local_timeout = None
+        self.local_retries = 0
+        self.local_memory = None
+        self.local_preload = False
+        self.local_log_dir = None
+        self.local_dag = None
+        self.local_after = []
+        self.skip_done = False
+        self.skip_done_cache = '.combineTool_outputs.json'
+        self.merge_walltime = None
+        self.cost_logs = []
+        self.cost_unit = 60.
 
     def attach_job_args(self, group):
         group.add_argument('--job-mode', default=self.job_mode, choices=[
-                           'interactive', 'script', 'lxbatch', 'SGE', 'condor', 'crab3'], help='Task execution mode')
+                           'interactive', 'local', 'script', 'lxbatch', 'SGE', 'condor', 'crab3'], help='Task execution mode')
         group.add_argument('--prefix-file', default=self.prefix_file,
                            help='Path to file containing job prefix')
         group.add_argument('--task-name', default=self.task_name,
                            help='Task name, used for job script and log filenames for batch system tasks')
         group.add_argument('--parallel', type=int, default=self.parallel,
-                           help='Number of jobs to run in parallel [only affects interactive job-mode]')
+                           help='Number of jobs to run in parallel [only affects interactive and local job-modes]')
         group.add_argument('--merge', type=int, default=self.merge,
                            help='Number of jobs to run in a single script [only affects batch submission]')
         group.add_argument('--dry-run', action='store_true',
@@ -134,6 +401,30 @@ class CombineToolBase:
                            help='Prefix the call to combine with this string')
         group.add_argument('--custom-crab-post', default=self.custom_crab_post,
                            help='txt file containing command lines that can be used in the crab job script instead of the defaults.')
+        group.add_argument('--merge-walltime', type=float, default=self.merge_walltime,
+                           help='Instead of --merge, pack commands into each job script up to this estimated wall-time [s] [only affects batch submission]')
+        group.add_argument('--cost-logs', nargs='+', default=self.cost_logs,
+                           help='Logs of earlier jobs from which the wall-time of each type of command is learnt, for --merge-walltime')
+        group.add_argument('--cost-unit', type=float, default=self.cost_unit,
+                           help='Assumed wall-time [s] of a single fit, for commands not covered by --cost-logs')
+        group.add_argument('--skip-done', action='store_true', default=self.skip_done,
+                           help='Do not run jobs whose output file already exists and can be opened without errors')
+        group.add_argument('--skip-done-cache', default=self.skip_done_cache,
+                           help='json file used to remember which output files have already been checked by --skip-done')
+        group.add_argument('--local-timeout', type=float, default=self.local_timeout,
+                           help='Kill a job that runs for longer than this [s] [only affects local job-mode]')
+        group.add_argument('--local-retries', type=int, default=self.local_retries,
+                           help='Number of times to rerun a job that fails or times out [only affects local job-mode]')
+        group.add_argument('--local-memory', type=int, default=self.local_memory,
+                           help='Limit on the virtual memory of each job [MB], which for combine is usually several GB above the memory actually used [only affects local job-mode]')
+        group.add_argument('--local-preload', action='store_true', default=self.local_preload,
+                           help='Run jobs that are python scripts, such as text2workspace.py, in worker processes that have already loaded ROOT, libHiggsAnalysisCombinedLimit and the CombinedLimit python modules. combine and other programs are still started anew for every job [only affects local job-mode]')
+        group.add_argument('--local-log-dir', default=self.local_log_dir,
+                           help='Directory for the job logs, defaults to "<task-name>_logs" [only affects local job-mode]')
+        group.add_argument('--local-dag', default=self.local_dag,
+                           help='Add the jobs to this json job graph instead of running them, run it later with runLocalDAG.py [only affects local job-mode]')
+        group.add_argument('--local-after', nargs='+', default=self.local_after,
+                           help='Tasks already in the --local-dag file that must finish before these jobs start')
 
     def attach_intercept_args(self, group):
         pass
@@ -157,6 +448,18 @@ class CombineToolBase:
         self.crab_files = self.args.crab_extra_files
         self.pre_cmd = self.args.pre_cmd
         self.custom_crab_post = self.args.custom_crab_post
+        self.local_timeout = self.args.local_timeout
+        self.local_retries = self.args.local_retries
+        self.local_memory = self.args.local_memory
+        self.local_preload = self.args.local_preload
+        self.local_log_dir = self.args.local_log_dir
+        self.local_dag = self.args.local_dag
+        self.local_after = self.args.local_after
+        self.skip_done = self.args.skip_done
+        self.skip_done_cache = self.args.skip_done_cache
+        self.merge_walltime = self.args.merge_walltime
+        self.cost_logs = self.args.cost_logs
+        self.cost_unit = self.args.cost_unit
 
     def put_back_arg(self, arg_name, target_name):
         if hasattr(self.args, arg_name):
@@ -185,8 +488,12 @@ class CombineToolBase:
                 log_part = '\n'
                 if do_log: log_part = ' 2>&1 | %s ' % tee + logname + log_part
                 if command.startswith('combine') or command.startswith('pushd'):
+                    start, end = walltime_lines(
+                        command, self.command_cost(command), do_log, logname)
+                    text_file.write(start)
                     text_file.write(
                         self.pre_cmd + 'eval ' + command + log_part)
+                    text_file.write(end)
                 else:
                     text_file.write(command)
         st = os.stat(fname)
@@ -194,6 +501,116 @@ class CombineToolBase:
         # print JOB_PREFIX + command
         print 'Created job script: %s' % script_filename
 
+    def add_job(self, command, after=None, output=None, cost=None):
+        # Queue a command that should only start once the commands at the
+        # queue indices in after have finished, returns the index of this one.
+        # output is the file (or list of files) the command creates and cost
+        # its relative run time, if these differ from what
+        # combine_output_file and estimate_cost would guess
+        self.job_queue.append(command)
+        idx = len(self.job_queue) - 1
+        if after:
+            self.job_deps[idx] = list(after)
+        if output is not None:
+            self.job_outputs[idx] = output
+        if cost is not None:
+            self.job_costs[idx] = cost
+        return idx
+
+    def command_cost(self, command):
+        for i, cost in self.job_costs.iteritems():
+            if self.job_queue[i] == command:
+                return cost
+        return estimate_cost(command)
+
+    def job_groups(self):
+        # Split the queue into the lists of commands for each job script,
+        # either --merge commands at a time or packed by estimated wall-time
+        if self.merge_walltime is None:
+            return [self.job_queue[j:j + self.merge] for j in range(0, len(self.job_queue), self.merge)]
+        per_unit = parse_walltime_logs(self.cost_logs) if self.cost_logs else {}
+        walltimes = []
+        for i, command in enumerate(self.job_queue):
+            cost = self.job_costs.get(i)
+            if cost is None:
+                cost = estimate_cost(command)
+            walltimes.append(cost * per_unit.get(cost_key(command), self.cost_unit))
+        groups = pack_by_cost(self.job_queue, walltimes, self.merge_walltime)
+        print '>> Packed %i commands with an estimated total wall-time of %.0fs into %i jobs of up to %.0fs' % (
+            len(self.job_queue), sum(walltimes), len(groups), self.merge_walltime)
+        return groups
+
+    def skip_done_jobs(self):
+        # Remove the jobs whose outputs are all present and good. Any job
+        # depending on a removed job can then start straight away.
+        outputs = []
+        for i, command in enumerate(self.job_queue):
+            output = self.job_outputs.get(i, combine_output_file(command))
+            if output is None:
+                outputs.append([])
+            elif isinstance(output, basestring):
+                outputs.append([output])
+            else:
+                outputs.append(list(output))
+        files = sorted(set(x for output in outputs for x in output))
+        good = dict(zip(files, outputs_are_good(files, self.skip_done_cache)))
+        keep = [i for i, output in enumerate(outputs)
+                if len(output) == 0 or not all(good[x] for x in output)]
+        if len(keep) == len(self.job_queue):
+            return
+        print '>> Skipping %i of %i jobs that have already been done' % (
+            len(self.job_queue) - len(keep), len(self.job_queue))
+        new_idx = dict((old, new) for new, old in enumerate(keep))
+        self.job_queue[:] = [self.job_queue[i] for i in keep]
+        self.job_deps = dict(
+            (new_idx[i], [new_idx[d] for d in deps if d in new_idx])
+            for i, deps in self.job_deps.iteritems() if i in new_idx)
+        self.job_outputs = dict(
+            (new_idx[i], output) for i, output in self.job_outputs.iteritems() if i in new_idx)
+        self.job_costs = dict(
+            (new_idx[i], cost) for i, cost in self.job_costs.iteritems() if i in new_idx)
+
+    def run_local(self):
+        if self.local_dag is not None:
+            commands = [(self.pre_cmd + x if x.startswith('combine') else x) for x in self.job_queue]
+            add_to_dag_file(self.local_dag, self.task_name, commands,
+                            self.job_deps, self.local_after)
+            print '>> Added %i jobs for task %s to %s' % (
+                len(self.job_queue), self.task_name, self.local_dag)
+            return
+        log_dir = self.local_log_dir
+        if log_dir is None:
+            log_dir = '%s_logs' % self.task_name
+        scheduler = LocalScheduler(
+            parallel=self.parallel, timeout=self.local_timeout,
+            memory=self.local_memory, retries=self.local_retries, log_dir=log_dir,
+            pre_cmd=self.pre_cmd, dry_run=self.dry_run,
+            pool=self.preload_pool())
+        # Keep numbering from earlier calls so their logs are not overwritten
+        offset = self.n_local_jobs
+        for i, command in enumerate(self.job_queue):
+            scheduler.add('%s.%i' % (self.task_name, offset + i), command,
+                          ['%s.%i' % (self.task_name, offset + d) for d in self.job_deps.get(i, [])])
+        self.n_local_jobs += len(self.job_queue)
+        failed = scheduler.run()
+        if failed:
+            print '>> %i of %i jobs did not succeed:' % (len(failed), len(self.job_queue))
+            for job in failed:
+                print '  %-30s %-8s %s' % (job.name, job.status, job.log if job.log is not None else '')
+
+    def preload_pool(self):
+        # The worker processes are started once and then reused for the jobs
+        # of every later call to flush_queue
+        if not self.local_preload or self.dry_run:
+            return None
+        from CombineHarvester.CombineTools.combine.WorkerPool import PythonWorkerPool, runs_in_process
+        if self.worker_pool is None:
+            if not any(runs_in_process(x) for x in self.job_queue):
+                return None
+            self.worker_pool = PythonWorkerPool(self.parallel)
+            atexit.register(self.worker_pool.close)
+        return self.worker_pool
+
     def run_method(self):
         print vars(self.args)
         # Put the method back in because we always take it out
@@ -211,10 +628,14 @@ class CombineToolBase:
                 return cmd_list[idx + 1]
         raise RuntimeError('The workspace argument must be specified explicity with -d or --datacard')
     def flush_queue(self):
+        if self.skip_done:
+            self.skip_done_jobs()
         if self.job_mode == 'interactive':
             pool = Pool(processes=self.parallel)
             result = pool.map(
                 partial(run_command, self.dry_run, pre_cmd=self.pre_cmd), self.job_queue)
+        if self.job_mode == 'local':
+            self.run_local()
         script_list = []
         if self.job_mode in ['script', 'lxbatch', 'SGE']:
             if self.prefix_file != '':
@@ -229,13 +650,13 @@ class CombineToolBase:
                   'PWD': os.environ['PWD']
                 })
                 job_prefix_file.close()
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for i, group in enumerate(self.job_groups()):
                 script_name = 'job_%s_%i.sh' % (self.task_name, i)
-                # each job is given a slice from the list of combine commands of length 'merge'
+                # each job is given a group of combine commands, see job_groups
                 # we also keep track of the files that were created in case submission to a
                 # batch system was also requested
                 self.create_job_script(
-                    self.job_queue[j:j + self.merge], script_name, self.job_mode == 'script')
+                    group, script_name, self.job_mode == 'script')
                 script_list.append(script_name)
         if self.job_mode == 'lxbatch':
             for script in script_list:
@@ -255,12 +676,13 @@ class CombineToolBase:
             outscript.write(JOB_PREFIX)
             jobs = 0
             wsp_files = set()
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for group in self.job_groups():
                 outscript.write('\nif [ $1 -eq %i ]; then\n' % jobs)
                 jobs += 1
-                for line in self.job_queue[j:j + self.merge]:
+                for line in group:
                     newline = line
-                    outscript.write('  ' + newline + '\n')
+                    start, end = walltime_lines(line, self.command_cost(line))
+                    outscript.write('  ' + start + '  ' + newline + '\n  ' + end)
                 outscript.write('fi')
             outscript.close()
             subfile = open(subfilename, "w")
@@ -287,10 +709,10 @@ class CombineToolBase:
             wsp_files = set()
             for extra in self.crab_files:
                 wsp_files.add(extra)
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for group in self.job_groups():
                 jobs += 1
                 outscript.write('\nif [ $1 -eq %i ]; then\n' % jobs)
-                for line in self.job_queue[j:j + self.merge]:
+                for line in group:
                     newline = line
                     if line.startswith('combine'): newline = self.pre_cmd + line.replace('combine', './combine', 1)
                     wsp = str(self.extract_workspace_arg(newline.split()))
@@ -329,3 +751,6 @@ class CombineToolBase:
                 except HTTPException, hte:
                     print hte.headers
         del self.job_queue[:]
+        self.job_deps.clear()
+        self.job_outputs.clear()
+        self.job_costs.clear()
@@ -215,20 +215,13 @@ class EnhancedCombine(CombineToolBase):
             split = self.args.split_points
             start = 0
             ranges = []
+            # Use --skip-done to only send the ranges whose output files
+            # don't exist yet or are incomplete
             while (start + (split - 1)) < points:
-            #    filename = "higgsCombine"+self.args.name+".POINTS."+str(start)+"."+str(start+(split-1))+".MultiDimFit.mH"+str(self.args.mass)+".root"
-            #    if (not os.path.isfile(filename)) or (os.path.getsize(filename)<1024):
-            #        # Send job, if the file it's supposed to create doesn't exist yet
-            #        # or if the file is empty because the previous job didn't finish
                 ranges.append((start, start + (split - 1)))
                 start += split
             if start < points:
-            #    filename = "higgsCombine"+self.args.name+".POINTS."+str(start)+"."+str(points - 1)+".MultiDimFit.mH"+str(self.args.mass)+".root"
-            #    if (not os.path.isfile(filename)) or (os.path.getsize(filename)<1024):
                 ranges.append((start, points - 1))
-            #if (ranges == []):
-            #    print "No jobs were created; All files already exist"
-            #    exit()
             subbed_vars[('P_START', 'P_END')] = [(r[0], r[1]) for r in ranges]
             self.passthru.extend(
                 ['--firstPoint %(P_START)s --lastPoint %(P_END)s'])
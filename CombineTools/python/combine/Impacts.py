@@ -1,13 +1,23 @@
 #!/usr/bin/env python
 
 import sys
+import os
 import json
 import ROOT
+from multiprocessing import Pool
 import CombineHarvester.CombineTools.combine.utils as utils
 
 from CombineHarvester.CombineTools.combine.CombineToolBase import CombineToolBase
 
 
+def get_param_fit_results(job):
+    """Reads the singles output of one --algo impact fit, job is a tuple of
+    (filename, param, columns). Defined at module level so that it can be
+    passed to a multiprocessing Pool"""
+    filename, param, columns = job
+    return utils.get_singles_results(filename, [param], columns)
+
+
 class Impacts(CombineToolBase):
     description = 'Calculate nuisance parameter impacts'
     requires_root = True
@@ -43,6 +53,19 @@ class Impacts(CombineToolBase):
             listed as nuisance parameters""")
         group.add_argument('--output', '-o', help="""write output json to a
             file""")
+        group.add_argument('--collect-workers', type=int, default=1, help="""
+            Number of processes used to read the output of the fits when
+            collecting the results""")
+        group.add_argument('--collect-index', nargs='?',
+            const='impacts_index.json', help="""Keep a json index of the
+            results read from each fit output file, keyed by the file path,
+            modification time and size. Files that have not changed since the
+            last collection are not re-read""")
+        group.add_argument('--prefit-cache', nargs='?',
+            const='impacts_prefit_cache.json', help="""Store the prefit
+            uncertainties of the parameters in this json file, keyed by a
+            hash of the workspace file and --setPhysicsModelParameters, and
+            re-use them on subsequent calls""")
 
     def run_method(self):
         passthru = self.passthru
@@ -96,7 +119,7 @@ class Impacts(CombineToolBase):
             paramList = [x for x in paramList if x not in exclude]
 
         print 'Have nuisance parameters: ' + str(len(paramList))
-        prefit = utils.prefit_from_workspace(ws, 'w', paramList, self.args.setPhysicsModelParameters)
+        prefit = utils.prefit_from_workspace(ws, 'w', paramList, self.args.setPhysicsModelParameters, cache=self.args.prefit_cache)
         res = {}
         res["POIs"] = []
         res["params"] = []
@@ -104,6 +127,8 @@ class Impacts(CombineToolBase):
             res["POIs"].append({"name": poi, "fit": initialRes[poi][poi]})
 
         missing = []
+        if not self.args.doFits:
+            paramScanResults = self.collect_param_fits(name, mh, paramList, poiList)
         for param in paramList:
             pres = {'name': param}
             pres.update(prefit[param])
@@ -112,8 +137,7 @@ class Impacts(CombineToolBase):
                 self.job_queue.append(
                     'combine -M MultiDimFit -n _paramFit_%(name)s_%(param)s --algo impact --redefineSignalPOIs %(poistr)s -P %(param)s --floatOtherPOIs 1 --saveInactivePOI 1 %(pass_str)s' % vars())
             else:
-                paramScanRes = utils.get_singles_results(
-                    'higgsCombine_paramFit_%(name)s_%(param)s.MultiDimFit.mH%(mh)s.root' % vars(), [param], poiList + [param])
+                paramScanRes = paramScanResults[param]
                 if paramScanRes is None:
                     missing.append(param)
                     continue
@@ -132,6 +156,55 @@ class Impacts(CombineToolBase):
         if len(missing) > 0:
             print 'Missing inputs: ' + ','.join(missing)
 
+    def collect_param_fits(self, name, mh, paramList, poiList):
+        """Returns a dict of {param: singles results} for the impact fits,
+        with None for any param whose output is missing or incomplete"""
+        index = {}
+        index_file = self.args.collect_index
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file) as jsonfile:
+                index = json.load(jsonfile)
+        results = {}
+        stats = {}
+        todo = []
+        for param in paramList:
+            filename = 'higgsCombine_paramFit_%(name)s_%(param)s.MultiDimFit.mH%(mh)s.root' % vars()
+            columns = poiList + [param]
+            if not os.path.isfile(filename):
+                results[param] = None
+                continue
+            st = os.stat(filename)
+            stats[filename] = st
+            entry = index.get(filename)
+            if (entry is not None and entry['mtime'] == st.st_mtime and
+                    entry['size'] == st.st_size and entry['columns'] == columns):
+                results[param] = entry['res']
+            else:
+                todo.append((filename, param, columns))
+        if len(todo) > 0:
+            print '>> Reading %i of %i fit output files' % (len(todo), len(paramList))
+        if self.args.collect_workers > 1 and len(todo) > 1:
+            pool = Pool(processes=self.args.collect_workers)
+            todo_res = pool.map(get_param_fit_results, todo)
+            pool.close()
+            pool.join()
+        else:
+            todo_res = [get_param_fit_results(job) for job in todo]
+        for (filename, param, columns), res in zip(todo, todo_res):
+            results[param] = res
+            if res is None:
+                index.pop(filename, None)
+            else:
+                st = stats[filename]
+                index[filename] = {
+                    'mtime': st.st_mtime, 'size': st.st_size,
+                    'columns': columns, 'res': res
+                }
+        if index_file is not None:
+            with open(index_file, 'w') as jsonfile:
+                json.dump(index, jsonfile)
+        return results
+
     def all_free_parameters(self, file, wsp, mc, pois):
         res = []
         wsFile = ROOT.TFile.Open(file)
@@ -7,7 +7,8 @@ import re
 import zipfile
 import os
 import bisect
-from math import floor
+from multiprocessing import Pool
+from math import floor, ceil
 from array import array
 
 import CombineHarvester.CombineTools.combine.utils as utils
@@ -30,6 +31,49 @@ class AsymptoticGrid(CombineToolBase):
     CombineToolBase.attach_args(self, group)
     group.add_argument('config', help='json config file')
 
+  def GetPointLimits(self, files):
+    """Returns a dict of the CLs values {'obs': ..., 'exp0': ..., ...} found in
+    the Asymptotic output files of one model point"""
+    res = {}
+    for filename in files:
+      cols = utils.read_limit_tree(filename, ('limit', 'quantileExpected'))
+      if cols is None: continue
+      for limit, mask in utils.quantile_masks(cols['quantileExpected'], tolerance=0.01).iteritems():
+        if mask.any():
+          res[limit] = float(cols['limit'][mask][-1])
+    return res
+
+  def RefineCells(self, cells, point_limits, levels, contours, crossing, fmt):
+    """Walks the grid cells ((x0, x1), (y0, y1)) and returns the list of points
+    that still need to be run: the corners of any cell that are missing from
+    point_limits, and the corners of the four sub-cells of each complete cell
+    whose corner values straddle the crossing, down to the given number of
+    subdivision levels. The cell edges and the keys of point_limits must all
+    be written with fmt, which is also used for the midpoints"""
+    needed = []
+    todo = [(cell, 0) for cell in cells]
+    while len(todo) > 0:
+      ((xa, xb), (ya, yb)), level = todo.pop()
+      corners = [(xa, ya), (xa, yb), (xb, ya), (xb, yb)]
+      missing = [c for c in corners if c not in point_limits]
+      if len(missing) > 0:
+        needed.extend([c for c in missing if c not in needed])
+        continue
+      if level >= levels:
+        continue
+      straddles = False
+      for contour in contours:
+        vals = [point_limits[c][contour] for c in corners if contour in point_limits[c]]
+        if len(vals) == 4 and min(vals) < crossing and max(vals) > crossing:
+          straddles = True
+      if not straddles:
+        continue
+      xm = fmt % (0.5 * (float(xa) + float(xb)))
+      ym = fmt % (0.5 * (float(ya) + float(yb)))
+      for sub_cell in itertools.product([(xa, xm), (xm, xb)], [(ya, ym), (ym, yb)]):
+        todo.append((sub_cell, level + 1))
+    return needed
+
   def run_method(self):
     ROOT.PyConfig.IgnoreCommandLineOptions = True
     ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -54,16 +98,41 @@ class AsymptoticGrid(CombineToolBase):
       else : blacklisted_points.extend(itertools.product(utils.split_vals(igrid[0]), utils.split_vals(igrid[1]), utils.split_vals(igrid[2])))
     POIs = cfg['POIs']
     opts = cfg['opts']
-    
+
+    # Optionally refine the grid around the CLs contours: starting from the
+    # cells of the grids given in the config, any cell whose corners straddle
+    # the CLs threshold for one of the refine_contours is split into four, up
+    # to refine_levels times. The refined points are recovered from the
+    # output files on each cycle, so no other bookkeeping is needed
+    refine_levels = cfg.get('refine_levels', 0)
+    refine_contours = cfg.get('refine_contours', ['obs', 'exp0'])
+    crossing = 1 - cfg.get('CL', 0.95)
+
+    # The same point can be written in different ways, e.g. '1' and '1.0' in
+    # overlapping grids, so points are compared by their values written with
+    # enough decimals for the finest grid. Each level of refinement halves the
+    # step, which needs at most one more decimal for the exact midpoint
+    ndigs = max([len(v.split('.')[1]) if '.' in v else 0 for p in points for v in p] + [0])
+    fmt = '%.' + str(ndigs + refine_levels) + 'f'
+    norm = lambda p: tuple(fmt % float(v) for v in p)
+
     # remove problematic points (points with NaN values)
-    points_to_remove = [];
+    points_to_remove = set()
     grids_to_remove = cfg.get('grids_to_remove', None)
     if grids_to_remove is not None :
         for igrid in grids_to_remove:
             assert(len(igrid) == 2)
-            points_to_remove.extend(itertools.product(utils.split_vals(igrid[0]),utils.split_vals(igrid[1])))
-    for p in points_to_remove:
-        points.remove(p)
+            points_to_remove.update(norm(p) for p in itertools.product(utils.split_vals(igrid[0]),utils.split_vals(igrid[1])))
+
+    # Keep the first spelling of each point, which names its output files
+    unique_points = {}
+    kept = []
+    for p in points:
+      if norm(p) in points_to_remove or norm(p) in unique_points:
+        continue
+      unique_points[norm(p)] = p
+      kept.append(p)
+    points = kept
 
     # Have to merge some arguments from both the command line and the "opts" in the json file
     to_freeze = []
@@ -81,24 +150,50 @@ class AsymptoticGrid(CombineToolBase):
     for p in points:
       file_dict[p] = []
 
+    rgx = re.compile('higgsCombine\.%s\.(?P<p1>.*)\.%s\.(?P<p2>.*)\.Asymptotic\.mH.*\.root' % (POIs[0], POIs[1]))
     for f in glob.glob('higgsCombine.%s.*.%s.*.Asymptotic.mH*.root' % (POIs[0], POIs[1])):
       # print f
-      rgx = re.compile('higgsCombine\.%s\.(?P<p1>.*)\.%s\.(?P<p2>.*)\.Asymptotic\.mH.*\.root' % (POIs[0], POIs[1]))
       matches = rgx.search(f)
       p = (matches.group('p1'), matches.group('p2'))
+      p = unique_points.get(norm(p), p)
       if p in file_dict:
         file_dict[p].append(f)
+      elif refine_levels > 0 and norm(p) not in points_to_remove:
+        unique_points[norm(p)] = p
+        file_dict[p] = [f]
 
+    # Read the CLs values of every point that has been run
+    point_limits = {}
     for key,val in file_dict.iteritems():
+      if len(val) > 0:
+        point_limits[key] = self.GetPointLimits(val)
+
+    needed = [p for p in points if len(file_dict[p]) == 0]
+    if refine_levels > 0:
+      known = dict((norm(p), limits) for p, limits in point_limits.iteritems())
+      for POI1, POI2, CLs in blacklisted_points:
+        known[norm((POI1, POI2))] = dict.fromkeys(refine_contours, float(CLs))
+      cells = []
+      for igrid in cfg['grids']:
+        if igrid[2] == '':
+          xs = [fmt % float(x) for x in utils.split_vals(igrid[0])]
+          ys = [fmt % float(y) for y in utils.split_vals(igrid[1])]
+          cells.extend(itertools.product(zip(xs[:-1], xs[1:]), zip(ys[:-1], ys[1:])))
+      needed_norm = set(norm(p) for p in needed)
+      for p in self.RefineCells(cells, known, refine_levels, refine_contours, crossing, fmt):
+        if p not in needed_norm and p not in points_to_remove:
+          needed_norm.add(p)
+          needed.append(p)
+
+    for key in needed:
       name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
       print '>> Point %s' % name
-      if len(val) == 0:
-        print 'Going to run limit for point %s' % (key,)
-        set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
-        freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
-        point_args = '-n .%s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, set_arg, freeze_arg)
-        cmd = ' '.join(['combine -M Asymptotic', opts, point_args] + self.passthru)
-        self.job_queue.append(cmd)
+      print 'Going to run limit for point %s' % (key,)
+      set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
+      freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
+      point_args = '-n .%s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, set_arg, freeze_arg)
+      cmd = ' '.join(['combine -M Asymptotic', opts, point_args] + self.passthru)
+      self.job_queue.append(cmd)
 
     bail_out = len(self.job_queue) > 0
     self.flush_queue()
@@ -107,67 +202,115 @@ class AsymptoticGrid(CombineToolBase):
         print '>> New jobs were created / run in this cycle, run the script again to collect the output'
         sys.exit(0)
 
-    xvals = []
-    yvals = []
-    zvals_m2s = []; zvals_m1s = []; zvals_exp = []; zvals_p1s = []; zvals_p2s = []; zvals_obs = []
-    for key,val in file_dict.iteritems():
-      for filename in val:
-        fin = ROOT.TFile(filename)
-        if fin.IsZombie(): continue
-        tree = fin.Get('limit')
-        for evt in tree:
-          if abs(evt.quantileExpected+1)<0.01:
-            xvals.append(float(key[0]))
-            yvals.append(float(key[1]))
-            #print 'At point %s have observed CLs = %f' % (key, evt.limit)
-            zvals_obs.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.025)<0.01:
-            #print 'At point %s have -2sigma CLs = %f' % (key, evt.limit)
-            zvals_m2s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.16)<0.01:
-            #print 'At point %s have -1sigma CLs = %f' % (key, evt.limit)
-            zvals_m1s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.5)<0.01:
-            #print 'At point %s have expected CLs = %f' % (key, evt.limit)
-            zvals_exp.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.84)<0.01:
-            #print 'At point %s have +1sigma CLs = %f' % (key, evt.limit)
-            zvals_p1s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.975)<0.01:
-            #print 'At point %s have +2sigma CLs = %f' % (key, evt.limit)
-            zvals_p2s.append(float(evt.limit))
+    if refine_levels > 0:
+      print '>> Grid has %i points, of which %i from refinement' % (len(point_limits), len(set(point_limits) - set(points)))
+
+    # One set of (x, y, CLs) lists per contour
+    limit_names = ['exp-2', 'exp-1', 'exp0', 'exp+1', 'exp+2', 'obs']
+    output = {}
+    for limit in limit_names:
+      output[limit] = ([], [], [])
+    for key,limits in point_limits.iteritems():
+      for limit,val in limits.iteritems():
+        output[limit][0].append(float(key[0]))
+        output[limit][1].append(float(key[1]))
+        output[limit][2].append(val)
     for POI1, POI2, CLs in blacklisted_points:
-      xvals.append(float(POI1))
-      yvals.append(float(POI2))
-      zvals_m2s.append(float(CLs))
-      zvals_m1s.append(float(CLs))
-      zvals_exp.append(float(CLs))
-      zvals_p1s.append(float(CLs))
-      zvals_p2s.append(float(CLs))
-      zvals_obs.append(float(CLs))
-    graph_m2s = ROOT.TGraph2D(len(zvals_m2s), array('d', xvals), array('d', yvals), array('d', zvals_m2s))
-    graph_m1s = ROOT.TGraph2D(len(zvals_m1s), array('d', xvals), array('d', yvals), array('d', zvals_m1s))
-    graph_exp = ROOT.TGraph2D(len(zvals_exp), array('d', xvals), array('d', yvals), array('d', zvals_exp))
-    graph_p1s = ROOT.TGraph2D(len(zvals_p1s), array('d', xvals), array('d', yvals), array('d', zvals_p1s))
-    graph_p2s = ROOT.TGraph2D(len(zvals_p2s), array('d', xvals), array('d', yvals), array('d', zvals_p2s))
-    graph_obs = ROOT.TGraph2D(len(zvals_obs), array('d', xvals), array('d', yvals), array('d', zvals_obs))
+      for limit in limit_names:
+        output[limit][0].append(float(POI1))
+        output[limit][1].append(float(POI2))
+        output[limit][2].append(float(CLs))
+    graphs = {}
+    for limit in limit_names:
+      xvals, yvals, zvals = output[limit]
+      graphs[limit] = ROOT.TGraph2D(len(zvals), array('d', xvals), array('d', yvals), array('d', zvals))
     #h_bins = cfg['hist_binning']
     #hist = ROOT.TH2F('h_observed', '', h_bins[0], h_bins[1], h_bins[2], h_bins[3], h_bins[4], h_bins[5])
     #for i in xrange(1, hist.GetNbinsX()+1):
     #  for j in xrange(1, hist.GetNbinsY()+1):
     #    hist.SetBinContent(i, j, graph.Interpolate(hist.GetXaxis().GetBinCenter(i), hist.GetYaxis().GetBinCenter(j)))
     fout = ROOT.TFile('asymptotic_grid.root', 'RECREATE')
-    fout.WriteTObject(graph_m2s, 'exp-2')
-    fout.WriteTObject(graph_m1s, 'exp-1')
-    fout.WriteTObject(graph_exp, 'exp0')
-    fout.WriteTObject(graph_p1s, 'exp+1')
-    fout.WriteTObject(graph_p2s, 'exp+2')
-    fout.WriteTObject(graph_obs, 'obs')
+    for limit in limit_names:
+      fout.WriteTObject(graphs[limit], limit)
     #fout.WriteTObject(hist)
     fout.Close()
     # Next step: open output files
     # Fill TGraph2D with CLs, CLs+b
 
+def hybrid_new_point_summary(job):
+    """Merges and validates the toys of one HybridNewGrid model point, where job
+    is a tuple of (key, files, name, validate_opts, plot_opts). Returns a tuple
+    of (has_res, ok, results) with the results dict of ValidateHypoTest, so
+    that the HypoTestResult itself never has to be sent between processes"""
+    key, files, name, validate_opts, plot_opts = job
+    grid = HybridNewGrid()
+    res = grid.GetCombinedHypoTest(files)
+    ok, point_res = grid.ValidateHypoTest(res, **validate_opts)
+    # Make plots of the test statistic distributions if requested
+    if res is not None and plot_opts is not None:
+        grid.PlotTestStat(res, 'plot_'+name, opts=plot_opts[0], poi_vals=plot_opts[1], point_info=point_res)
+    return (res is not None, ok, point_res)
+
+
+class HybridNewManifest:
+    """Append-only record of the toy output files found by HybridNewGrid and
+    of the latest validation results for each model point. Each line of the
+    file is a json object, where later lines take precedence over earlier ones:
+      - kind=file:    a toy file with its point, seed, validity and ntoys
+      - kind=removed: a file that no longer exists at its recorded path
+      - kind=point:   the files, ntoys and per-contour results of a point
+      - kind=archive: the mtime and size of the zip archive when last read
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        self.points = {}
+        self.archive = None
+        self.pending = []
+        self.nlines = 0
+        if filename and os.path.isfile(filename):
+            with open(filename) as manifest:
+                for line in manifest:
+                    if line.strip():
+                        self.Apply(json.loads(line))
+                        self.nlines += 1
+
+    def Apply(self, record):
+        kind = record['kind']
+        if kind == 'file':
+            self.files[record['file']] = record
+        elif kind == 'removed':
+            self.files.pop(record['file'], None)
+        elif kind == 'point':
+            self.points[record['point']] = record
+        elif kind == 'archive':
+            self.archive = record
+
+    def Add(self, record):
+        self.Apply(record)
+        self.pending.append(record)
+
+    def Flush(self):
+        if not self.filename:
+            return
+        live = self.files.values() + self.points.values()
+        if self.archive is not None:
+            live.append(self.archive)
+        if self.nlines + len(self.pending) > 2 * len(live) + 1000:
+            # Most of the lines are superseded, write out a compacted copy
+            with open(self.filename + '.tmp', 'w') as manifest:
+                for record in live:
+                    manifest.write(json.dumps(record, sort_keys=True) + '\n')
+            os.rename(self.filename + '.tmp', self.filename)
+            self.nlines = len(live)
+        else:
+            with open(self.filename, 'a') as manifest:
+                for record in self.pending:
+                    manifest.write(json.dumps(record, sort_keys=True) + '\n')
+            self.nlines += len(self.pending)
+        self.pending = []
+
+
 class HybridNewGrid(CombineToolBase):
     description = 'Calculate toy-based limits on parameter grids'
     requires_root = True
@@ -186,6 +329,8 @@ class HybridNewGrid(CombineToolBase):
         group.add_argument('--cycles', default=0, type=int, help='Number of job cycles to create per point')
         group.add_argument('--output', action='store_true', help='Write CLs grids into an output file')
         group.add_argument('--from-asymptotic', default=None, help='JSON file which will be used to create a limit grid automatically')
+        group.add_argument('--adaptive', action='store_true', help='Size the new jobs for each point by the number of toys predicted to reach the target significance, and treat points where the contours are already bracketed by their neighbours along both axes as complete. --cycles then sets the maximum number of jobs per point')
+        group.add_argument('--workers', default=1, type=int, help='Number of processes used to merge and validate the HypoTestResults of the model points')
 
     def GetCombinedHypoTest(self, files):
         if len(files) == 0: return None
@@ -209,6 +354,22 @@ class HybridNewGrid(CombineToolBase):
             print '>> Warning, HypoTestResult from file(s) %s does not contain any toy results, did something go wrong in your fits?' % '+'.join(files)
         return results[0]
 
+    def GetFileInfo(self, file):
+        """Returns (good, ntoys) for a HybridNew output file, where ntoys is the
+        smaller of the number of b-only and s+b toys stored in it"""
+        if not plot.TFileIsGood(file):
+            return (False, 0)
+        ntoys = 0
+        f = ROOT.TFile(file)
+        toys = f.Get('toys')
+        if toys:
+            for key in toys.GetListOfKeys():
+                if ROOT.gROOT.GetClass(key.GetClassName()).InheritsFrom(ROOT.RooStats.HypoTestResult.Class()):
+                    hyp_res = toys.Get(key.GetName())
+                    ntoys += min(hyp_res.GetNullDistribution().GetSize(), hyp_res.GetAltDistribution().GetSize())
+        f.Close()
+        return (True, ntoys)
+
     def ValidateHypoTest(self, hyp_res, min_toys, max_toys, contours, signif, cl, output=False, verbose=False, precomputed=None, feldman_cousins=False):
         results = {}
 
@@ -312,6 +473,103 @@ class HybridNewGrid(CombineToolBase):
         results['ok'] = all_ok
         return (all_ok, results)
 
+    def PredictToys(self, point_res, contours, signif, min_toys, max_toys):
+        """Estimates the total number of toys needed for each of the contours of
+        a point to reach the target significance, assuming CLsErr scales as
+        1/sqrt(ntoys)"""
+        ntoys = point_res['ntoys']
+        if ntoys == 0 or any(c not in point_res for c in contours):
+            return min_toys
+        needed = min_toys
+        for contour in contours:
+            dist = point_res[contour][2]
+            if dist >= signif:
+                continue
+            if dist <= 0.:
+                return max_toys
+            needed = max(needed, ntoys * (signif / dist)**2)
+        return min(int(ceil(needed)), max_toys)
+
+    def GridLines(self, keys):
+        """Returns the lines of the grid through each point as a dict of
+        key -> [line along x, line along y], each sorted by position"""
+        lines_x = {}
+        lines_y = {}
+        for key in keys:
+            lines_x.setdefault(key[1], []).append(key)
+            lines_y.setdefault(key[0], []).append(key)
+        for line in lines_x.values():
+            line.sort(key=lambda x: float(x[0]))
+        for line in lines_y.values():
+            line.sort(key=lambda x: float(x[1]))
+        return dict((key, [lines_x[key[1]], lines_y[key[0]]]) for key in keys)
+
+    def ContourIsBracketed(self, key, contour, lines, point_summaries, signif, cl):
+        """Returns True if, along both axes of the grid, the CLs crossing for
+        this contour is known not to pass between the point and its
+        neighbours. On each axis either the neighbour on one side and the next
+        point beyond it must lie either side of the crossing, or, when both
+        are known, the neighbours on the two sides must lie on the same side
+        of it, counting only points that have reached the target significance.
+        Assuming CLs varies monotonically the point itself then cannot change
+        where the contour is drawn"""
+        crossing = 1 - cl
+
+        def side(other):
+            other_res = point_summaries[other][1]
+            if contour not in other_res or other_res[contour][2] < signif:
+                return None
+            return other_res[contour][0] < crossing
+
+        for line in lines:
+            idx = line.index(key)
+            sides = {}
+            for dist in [-2, -1, +1, +2]:
+                if 0 <= idx + dist < len(line):
+                    sides[dist] = side(line[idx + dist])
+            if sides.get(-1) is not None and sides.get(+1) is not None:
+                if sides[-1] != sides[+1]:
+                    return False
+                continue
+            if not any(sides.get(step) is not None and sides.get(2 * step) is not None and
+                       sides[step] != sides[2 * step] for step in [-1, +1]):
+                return False
+        return True
+
+    def IsBracketed(self, key, contours, lines, point_summaries, signif, cl):
+        """Returns True if all the contours are bracketed at this point"""
+        return all(self.ContourIsBracketed(key, c, lines, point_summaries, signif, cl) for c in contours)
+
+    def ScheduleJobs(self, point_summaries, contours, toys_per_cycle, min_toys, max_toys, signif, cl, margin):
+        """Returns a list of (key, njobs, ntoys per job) for the points that
+        need more toys. By default each incomplete point gets --cycles jobs of
+        toys_per_cycle toys. In --adaptive mode the jobs are sized to the
+        predicted number of missing toys, with at most --cycles jobs per point,
+        and ordered such that the points with the least significant contours
+        come first"""
+        schedule = []
+        grid_lines = self.GridLines(point_summaries.keys())
+        for key, (ok, point_res) in point_summaries.iteritems():
+            if ok:
+                continue
+            if not self.args.adaptive:
+                schedule.append((0., key, self.args.cycles, toys_per_cycle))
+                continue
+            # Points with all their contours bracketed have already been marked
+            # as complete, so only size the jobs by the contours that are not
+            todo = [c for c in contours if not self.ContourIsBracketed(key, c, grid_lines[key], point_summaries, signif, cl)]
+            target = self.PredictToys(point_res, todo, signif, min_toys, max_toys)
+            extra = min(int(ceil(target * margin)), max_toys) - point_res['ntoys']
+            if extra <= 0:
+                extra = toys_per_cycle
+            njobs = min(int(ceil(float(extra) / toys_per_cycle)), self.args.cycles)
+            ntoys = min(int(ceil(float(extra) / njobs)), toys_per_cycle)
+            priority = min([point_res[c][2] if c in point_res else 0. for c in todo])
+            print '>>> Point %s has %i toys, predicted to need %i' % (key, point_res['ntoys'], target)
+            schedule.append((priority, key, njobs, ntoys))
+        schedule.sort(key=lambda x: x[0])
+        return [x[1:] for x in schedule]
+
     def run_method(self):
         ROOT.PyConfig.IgnoreCommandLineOptions = True
         ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -327,7 +585,7 @@ class HybridNewGrid(CombineToolBase):
         opts            = cfg['opts']
         toys_per_cycle  = cfg['toys_per_cycle']
         zipname         = cfg.get('zipfile',    None)
-        statfile        = cfg.get('statusfile', None)
+        manifest_name   = cfg.get('manifest',   None)
         contours        = cfg.get('contours',   ['obs', 'exp-2', 'exp-1', 'exp0', 'exp+1', 'exp+2'])
         min_toys        = cfg.get('min_toys',   500)
         max_toys        = cfg.get('max_toys',   5000)
@@ -340,6 +598,8 @@ class HybridNewGrid(CombineToolBase):
         outfile         = cfg.get('output','hybrid_grid.root')
         from_asymptotic_settings = cfg.get('from_asymptotic_settings', dict())
         feldman_cousins = cfg.get('FC',False)
+        # Safety factor applied to the predicted number of toys in --adaptive mode
+        adaptive_margin = cfg.get('adaptive_margin', 1.2)
         # NB: blacklisting not yet implemented for this method
 
         # Have to merge some arguments from both the command line and the "opts" in the json file
@@ -423,53 +683,83 @@ class HybridNewGrid(CombineToolBase):
         # The regex we will use to identify output files and extract POI values
         rgx = re.compile('higgsCombine\.%s\.(?P<p1>.*)\.%s\.(?P<p2>.*)\.HybridNew\.mH.*\.(?P<toy>.*)\.root' % (POIs[0], POIs[1]))
 
-        stats = {}
-        if statfile and os.path.isfile(statfile):
-            with open(statfile) as stat_json:
-                stats = json.load(stat_json)
+        if 'statusfile' in cfg:
+            print '>> The "statusfile" option is no longer used, set "manifest" instead'
+        manifest = HybridNewManifest(manifest_name)
 
         # Can optionally copy output root files into a zip archive
         # If the user has specified a zipfile we will first
         # look for output files in this archive before scanning the
-        # current directory
+        # current directory. The namelist only needs to be read again
+        # if the archive has changed since the last cycle
         if zipname:
             # Open the zip file in append mode, this should also
             # create it if it doesn't exist
             zipf = zipfile.ZipFile(zipname, 'a')
-            for f in zipf.namelist():
-                matches = rgx.search(f)
-                p = (matches.group('p1'), matches.group('p2'))
-                seed = int(matches.group('toy'))
-                if p in file_dict:
-                    if seed not in file_dict[p]:
-                        # For each model point have a dictionary keyed on the seed number
-                        # with a value pointing to the file in the archive in the format
-                        # ROOT expects: "zipfile.zip#higgsCombine.blah.root"
-                        file_dict[p][seed] = zipname+'#'+f
-
-        # Now look for files in the local directory
-        for f in glob.glob('higgsCombine.%s.*.%s.*.HybridNew.mH*.root' % (POIs[0], POIs[1])):
+            zst = os.stat(zipname)
+            if manifest.archive is None or manifest.archive['stat'] != [zst.st_mtime, zst.st_size]:
+                for f in zipf.namelist():
+                    # The file in the archive is given in the format
+                    # ROOT expects: "zipfile.zip#higgsCombine.blah.root"
+                    path = zipname+'#'+f
+                    if path in manifest.files:
+                        continue
+                    matches = rgx.search(f)
+                    manifest.Add({
+                        'kind': 'file', 'file': path,
+                        'point': [matches.group('p1'), matches.group('p2')],
+                        'seed': int(matches.group('toy')),
+                        'good': True, 'ntoys': None, 'mtime': None
+                    })
+
+        # Now look for files in the local directory. Only files that are not
+        # in the manifest yet, or were not good and have been modified since,
+        # need to be checked
+        local_files = set(glob.glob('higgsCombine.%s.*.%s.*.HybridNew.mH*.root' % (POIs[0], POIs[1])))
+        for f in local_files:
+            record = manifest.files.get(f)
+            if record is not None and record['good']:
+                continue
+            mtime = os.path.getmtime(f)
+            if record is not None and record['mtime'] == mtime:
+                continue
             matches = rgx.search(f)
-            p = (matches.group('p1'), matches.group('p2'))
-            seed = int(matches.group('toy'))
-            if p in file_dict:
-                # Don't add this file to the list if its seed number is already
-                # a value in the dict.
-                if seed not in file_dict[p]:
-                    # If we're using the zipfile we'll add this now and
-                    # then delete it from the local directory
-                    # But: only in the file is good, we don't want to pollute the zip
-                    # file with incomplete or failed jobs
-                    if zipname and plot.TFileIsGood(f):
-                        zipf.write(f) # assume this throws if it fails
-                        print 'Adding %s to %s' % (f, zipname)
-                        file_dict[p][seed] = zipname+'#'+f
-                        os.remove(f)
-                    else:  # otherwise just add the file to the dict in the normal way
-                        file_dict[p][seed] = f
+            good, ntoys = self.GetFileInfo(f)
+            manifest.Add({
+                'kind': 'file', 'file': f,
+                'point': [matches.group('p1'), matches.group('p2')],
+                'seed': int(matches.group('toy')),
+                'good': good, 'ntoys': ntoys, 'mtime': mtime
+            })
+        for f in [x for x in manifest.files if '#' not in x and x not in local_files]:
+            manifest.Add({'kind': 'removed', 'file': f})
 
         if zipname:
+            archived = set((tuple(x['point']), x['seed']) for x in manifest.files.values() if '#' in x['file'])
+            for f, record in sorted(manifest.files.items()):
+                if '#' in f or not record['good'] or (tuple(record['point']), record['seed']) in archived:
+                    continue
+                # If we're using the zipfile we'll add this now and
+                # then delete it from the local directory
+                # But: only in the file is good, we don't want to pollute the zip
+                # file with incomplete or failed jobs
+                zipf.write(f) # assume this throws if it fails
+                print 'Adding %s to %s' % (f, zipname)
+                archived_record = dict(record)
+                archived_record['file'] = zipname+'#'+f
+                manifest.Add(archived_record)
+                manifest.Add({'kind': 'removed', 'file': f})
+                os.remove(f)
             zipf.close()
+            zst = os.stat(zipname)
+            manifest.Add({'kind': 'archive', 'stat': [zst.st_mtime, zst.st_size]})
+
+        # For each model point have a dictionary keyed on the seed number. Files
+        # in the archive take precedence over local files with the same seed
+        for path, record in sorted(manifest.files.items(), key=lambda x: '#' not in x[0]):
+            p = tuple(record['point'])
+            if p in file_dict and record['seed'] not in file_dict[p]:
+                file_dict[p][record['seed']] = path
 
         # These lists will keep track of the CLs values which we will use
         # to create the output TGraph2Ds
@@ -490,76 +780,107 @@ class HybridNewGrid(CombineToolBase):
         # CLs criteria
         total_points = 0
         complete_points = 0
+        point_summaries = {}
+        point_has_res = {}
+
+        validate_opts = {
+            'min_toys': min_toys,
+            'max_toys': max_toys,
+            'contours': contours,
+            'signif': signif,
+            'cl': cl,
+            # The adaptive scheduling needs the CLs values even for points
+            # that have not reached min_toys yet
+            'output': self.args.output or self.args.adaptive,
+            'verbose': verbose,
+            'feldman_cousins': feldman_cousins
+        }
+
+        # Find the points where the HypoTestResult objects have to be merged
+        # again, i.e. unless the results stored in the manifest were made from
+        # the same files. These are merged and validated in one go, optionally
+        # spread over a pool of worker processes, each of which returns only the
+        # summary of the validation
+        point_files = {}
+        point_status = {}
+        jobs = []
+        for key,val in file_dict.iteritems():
+            status_key = ':'.join(key)
+            name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
+            # The files that were declared good when discovered
+            files = [x for x in val.values() if manifest.files[x]['good']]
+            point_files[key] = files
+            status = manifest.points.get(status_key)
+            if (status is not None and set(status['files']) == set(files) and status['ntoys'] > 0 and
+                    (not validate_opts['output'] or all(c in status for c in contours))):
+                print 'For point %s, no files have been updated' % name
+                point_status[key] = status
+            else:
+                plot_opts = None
+                if make_plots:
+                    plot_opts = (cfg['plot_settings'], (float(key[0]), float(key[1])))
+                jobs.append((key, files, name, validate_opts, plot_opts))
+
+        if self.args.workers > 1 and len(jobs) > 1:
+            pool = Pool(processes=self.args.workers)
+            job_results = pool.map(hybrid_new_point_summary, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            job_results = [hybrid_new_point_summary(job) for job in jobs]
+        point_results = dict(zip([job[0] for job in jobs], job_results))
 
         for key,val in file_dict.iteritems():
-            status_changed = True
             total_points += 1
             status_key = ':'.join(key)
             name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
-            
-            # First check if we use the status json
-            all_files = val.values()
-            status_files = []
-            files =[]
-
-
-            if status_key in stats:
-                status_files = stats[status_key]['files']
-                if set(all_files) == set(status_files):
-                    print 'For point %s, no files have been updated' % name
-                    status_changed = False
-                    files = all_files
-                else:
-                    files = [x for x in val.values() if plot.TFileIsGood(x)]
-                    if set(files) == set(status_files) and len(files) < len(all_files):
-                        print 'For point %s, new files exist but they are not declared good' % name
-                        status_changed = False
-            else:
-                files = [x for x in val.values() if plot.TFileIsGood(x)]
+            files = point_files[key]
 
-            # Merge the HypoTestResult objects from each file into one
-            res = None
-            precomputed = None
-            if status_key in stats and not status_changed and stats[status_key]["ntoys"] > 0 :
-                precomputed = stats[status_key]
+            # Do the validation of this model point, from the stored results
+            # when nothing has changed
+            precomputed = point_status.get(key, None)
+            if precomputed is not None:
+                has_res = True
+                ok, point_res = self.ValidateHypoTest(None, precomputed=precomputed, **validate_opts)
             else:
-                res = self.GetCombinedHypoTest(files)
-
-            # Do the validation of this model point
-            #
-            ok, point_res = self.ValidateHypoTest(res,
-                min_toys = min_toys,
-                max_toys = max_toys,
-                contours = contours,
-                signif   = signif,
-                cl       = cl,
-                output   = self.args.output,
-                verbose  = verbose,
-                precomputed = precomputed,
-                feldman_cousins=feldman_cousins)
+                has_res, ok, point_res = point_results[key]
 
             print '>> Point %s [%i toys, %s]' % (name, point_res['ntoys'], 'DONE' if ok else 'INCOMPLETE')
 
-            stats[status_key] = {
-                'files': files,
-                'ntoys': point_res['ntoys']
-            }
-            for cont in contours:
-                if cont in point_res:
-                    stats[status_key][cont] = point_res[cont]
-
+            if precomputed is None:
+                status = {
+                    'kind': 'point',
+                    'point': status_key,
+                    'files': files,
+                    'ntoys': point_res['ntoys']
+                }
+                for cont in contours:
+                    if cont in point_res:
+                        status[cont] = point_res[cont]
+                manifest.Add(status)
+
+            point_summaries[key] = (ok, point_res)
+            point_has_res[key] = has_res
+
+        # In --adaptive mode a point where all the contours are bracketed by its
+        # neighbours gets no more toys, so it is treated as complete
+        if self.args.adaptive:
+            grid_lines = self.GridLines(point_summaries.keys())
+            for key, (ok, point_res) in point_summaries.items():
+                if not ok and self.IsBracketed(key, contours, grid_lines[key], point_summaries, signif, cl):
+                    print '>> Point %s: contours are bracketed by its neighbours, marking as DONE' % (key,)
+                    point_summaries[key] = (True, point_res)
+
+        for key in sorted(point_summaries):
+            ok, point_res = point_summaries[key]
             if ok:
                 complete_points += 1
 
-            # Make plots of the test statistic distributions if requested
-            if res is not None and make_plots:
-                self.PlotTestStat(res, 'plot_'+name, opts = cfg['plot_settings'], poi_vals = (float(key[0]), float(key[1])), point_info=point_res)
-
             # Add the resulting CLs values to the output arrays. Normally just
             # for the model points that passed the validation criteria, but if "output_incomplete"
             # has been set to true then we'll write all model points where at least one HypoTestResult
             # is present
-            if (res is not None or precomputed is not None) and (ok or incomplete) and self.args.output:
+            if point_has_res[key] and (ok or incomplete) and self.args.output:
                 output_x.append(float(key[0]))
                 output_y.append(float(key[1]))
                 output_ntoys.append(point_res['ntoys'])
@@ -568,63 +889,70 @@ class HybridNewGrid(CombineToolBase):
                     output_clserr[contour].append(point_res[contour][1])
                     output_signif[contour].append(point_res[contour][2])
 
-            # Do the job cycle generation if requested
-            if not ok and self.args.cycles > 0:
-                print '>>> Going to generate %i job(s) for point %s' % (self.args.cycles, key)
-                # Figure out the next seed numbers we need to run by finding the maximum seed number
-                # so far
-                done_cycles = val.keys()
-                new_idx = max(done_cycles)+1 if len(done_cycles) > 0 else 1
-                new_cycles = range(new_idx, new_idx+self.args.cycles)
-
-                print '>>> Done cycles: ' + ','.join(str(x) for x in done_cycles)
-                print '>>> New cycles: ' + ','.join(str(x) for x in new_cycles)
-
-                # Build to combine command. Here we'll take responsibility for setting the name and the
-                # model parameters, making sure the latter are frozen
-                if not feldman_cousins:
-                    set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
-                    freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
-                    point_args = '-n .%s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, set_arg, freeze_arg)
-                else:
-                    single_point_arg = '.'.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])])
-                    if len(to_set) > 0 and len(to_freeze) > 0:
-                        point_args = '-n .%s --singlePoint %s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, single_point_arg, to_set, to_freeze)
-                    elif len(to_set) > 0:
-                        point_args = '-n .%s --singlePoint %s --setPhysicsModelParameters %s' % (name, single_point_arg, to_set)
-                    elif len(to_freeze) > 0:
-                        point_args = '-n .%s --singlePoint %s --freezeNuisances %s' % (name, single_point_arg, to_freeze)
-                    else :
-                        point_args = '-n .%s --singlePoint %s ' % (name, single_point_arg)
-
-
+        print ">> %i/%i points have completed and require no further toys" % (complete_points, total_points)
 
-                if self.args.from_asymptotic:
-                    mval = key[0]
-                    command = []
-                    for par in bound_pars:
-                        # The (mass, None, None) is just a trick to make bisect_left do the comparison
-                        # with the list of tuples in bound_var[par]. The +1E-5 is to avoid float rounding
-                        # issues
-                        lower_bound = bisect.bisect_left(bound_vals[par], (float(mval)+1E-5, None, None))
-                        # If lower_bound == 0 this means we are at or below the lowest mass point,
-                        # in which case we should increase by one to take the bounds from this lowest
-                        # point
-                        if lower_bound == 0:
-                            lower_bound += 1
-                        command.append('%s=%g,%g' % (par, bound_vals[par][lower_bound-1][1], bound_vals[par][lower_bound-1][2]))
-                    if len(command) > 0:
-                        point_args += (' --setPhysicsModelParameterRanges %s' % (':'.join(command)))
-                    # print per_mass_point_args
-                    point_args += ' --singlePoint %s' % key[1]
-                    point_args += ' -m %s' % mval
-                # Build a command for each job cycle setting the number of toys and random seed and passing through any other
-                # user options from the config file or the command line
-                for idx in new_cycles:
-                    cmd = ' '.join(['combine -M HybridNew', opts, point_args, '-T %i' % toys_per_cycle, '-s %i' % idx] + self.passthru)
-                    self.job_queue.append(cmd)
+        # Do the job cycle generation if requested
+        schedule = []
+        if self.args.cycles > 0:
+            schedule = self.ScheduleJobs(point_summaries, contours, toys_per_cycle,
+                min_toys, max_toys, signif, cl, adaptive_margin)
+        for key, ncycles, ntoys in schedule:
+            val = file_dict[key]
+            name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
+            print '>>> Going to generate %i job(s) with %i toys for point %s' % (ncycles, ntoys, key)
+            # Figure out the next seed numbers we need to run by finding the maximum seed number
+            # so far
+            done_cycles = val.keys()
+            new_idx = max(done_cycles)+1 if len(done_cycles) > 0 else 1
+            new_cycles = range(new_idx, new_idx+ncycles)
+
+            print '>>> Done cycles: ' + ','.join(str(x) for x in done_cycles)
+            print '>>> New cycles: ' + ','.join(str(x) for x in new_cycles)
+
+            # Build to combine command. Here we'll take responsibility for setting the name and the
+            # model parameters, making sure the latter are frozen
+            if not feldman_cousins:
+                set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
+                freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
+                point_args = '-n .%s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, set_arg, freeze_arg)
+            else:
+                single_point_arg = '.'.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])])
+                if len(to_set) > 0 and len(to_freeze) > 0:
+                    point_args = '-n .%s --singlePoint %s --setPhysicsModelParameters %s --freezeNuisances %s' % (name, single_point_arg, to_set, to_freeze)
+                elif len(to_set) > 0:
+                    point_args = '-n .%s --singlePoint %s --setPhysicsModelParameters %s' % (name, single_point_arg, to_set)
+                elif len(to_freeze) > 0:
+                    point_args = '-n .%s --singlePoint %s --freezeNuisances %s' % (name, single_point_arg, to_freeze)
+                else :
+                    point_args = '-n .%s --singlePoint %s ' % (name, single_point_arg)
+
+
+
+            if self.args.from_asymptotic:
+                mval = key[0]
+                command = []
+                for par in bound_pars:
+                    # The (mass, None, None) is just a trick to make bisect_left do the comparison
+                    # with the list of tuples in bound_var[par]. The +1E-5 is to avoid float rounding
+                    # issues
+                    lower_bound = bisect.bisect_left(bound_vals[par], (float(mval)+1E-5, None, None))
+                    # If lower_bound == 0 this means we are at or below the lowest mass point,
+                    # in which case we should increase by one to take the bounds from this lowest
+                    # point
+                    if lower_bound == 0:
+                        lower_bound += 1
+                    command.append('%s=%g,%g' % (par, bound_vals[par][lower_bound-1][1], bound_vals[par][lower_bound-1][2]))
+                if len(command) > 0:
+                    point_args += (' --setPhysicsModelParameterRanges %s' % (':'.join(command)))
+                # print per_mass_point_args
+                point_args += ' --singlePoint %s' % key[1]
+                point_args += ' -m %s' % mval
+            # Build a command for each job cycle setting the number of toys and random seed and passing through any other
+            # user options from the config file or the command line
+            for idx in new_cycles:
+                cmd = ' '.join(['combine -M HybridNew', opts, point_args, '-T %i' % ntoys, '-s %i' % idx] + self.passthru)
+                self.job_queue.append(cmd)
 
-        print ">> %i/%i points have completed and require no further toys" % (complete_points, total_points)
         self.flush_queue()
 
         # Create and write output CLs TGraph2Ds here
@@ -657,23 +985,19 @@ class HybridNewGrid(CombineToolBase):
                 files_by_mass[key[0]].extend(val.values())
             for m, files in files_by_mass.iteritems():
                 gridfile = 'higgsCombine.gridfile.%s.%s.%s.root' % (POIs[0], m, POIs[1])
-                self.job_queue.append('hadd -f %s %s' % (gridfile, ' '.join(files)))
+                hadd_job = self.add_job('hadd -f %s %s' % (gridfile, ' '.join(files)))
                 for exp in ['', '0.025', '0.160', '0.500', '0.840', '0.975']:
-                    self.job_queue.append(' '.join([
+                    self.add_job(' '.join([
                             'combine -M HybridNew --rAbsAcc 0',
                             opts,
                             '--grid %s' % gridfile,
                             '-n .final.%s.%s.%s' % (POIs[0], m, POIs[1]),
                             '-m %s' % (m),
                             ('--expectedFromGrid %s' % exp) if exp else '--noUpdateGrid'
-                        ] + self.passthru))
+                        ] + self.passthru), after=[hadd_job])
                 self.flush_queue()
 
-        if statfile:
-            with open(statfile, 'w') as stat_out:
-                stat_json = json.dumps(
-                    stats, sort_keys=True, indent=2, separators=(',', ': '))
-                stat_out.write(stat_json)
+        manifest.Flush()
 
 
     def PlotTestStat(self, result, name, opts, poi_vals, point_info=None):
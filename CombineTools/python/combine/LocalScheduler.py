@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import pipes
+import signal
+import subprocess
+import threading
+from collections import deque
+
+
+class LocalJob:
+    def __init__(self, name, command, after=None, task=None):
+        self.name = name
+        self.command = command
+        self.after = list(after) if after is not None else []
+        self.task = task
+        self.status = 'pending'
+        self.attempts = 0
+        self.returncode = None
+        self.log = None
+
+
+class LocalScheduler:
+    """Runs a graph of shell commands on the local machine
+
+    Each job is started only once all the jobs it depends on have succeeded,
+    and at most `parallel` jobs run at once. Idle workers take the next job
+    from a single queue of jobs whose dependencies are satisfied, so a long
+    job never holds up the others. Every job can be limited in wall-clock
+    time [s] and virtual memory [MB], is retried up to `retries` times if it fails,
+    and has its output written to its own log file as it runs. If a job
+    still fails then the jobs that depend on it are skipped, but unrelated
+    jobs carry on.
+
+    If a pool of preloaded python workers is given (a PythonWorkerPool with
+    at least `parallel` workers), jobs that are a single python script run
+    in one of these instead of a new shell, under the same limits."""
+    POLL_INTERVAL = 0.2
+    KILL_GRACE = 10.
+
+    def __init__(self, parallel=1, timeout=None, memory=None, retries=0,
+                 log_dir='.', pre_cmd='', dry_run=False, pool=None):
+        self.parallel = max(1, parallel)
+        self.timeout = timeout
+        self.memory = memory
+        self.retries = retries
+        self.log_dir = log_dir
+        self.pre_cmd = pre_cmd
+        self.dry_run = dry_run
+        self.pool = pool
+        self.jobs = []
+        self.by_name = {}
+        self.lock = threading.Condition()
+        self.running = {}
+        self.aborted = False
+
+    def add(self, name, command, after=None, task=None):
+        if name in self.by_name:
+            raise RuntimeError('A job with the name %s has already been added' % name)
+        job = LocalJob(name, command, after, task)
+        self.jobs.append(job)
+        self.by_name[name] = job
+        return job
+
+    def order(self):
+        """Returns the jobs sorted such that each comes after its dependencies,
+        keeping the order they were added in where possible"""
+        for job in self.jobs:
+            for dep in job.after:
+                if dep not in self.by_name:
+                    raise RuntimeError('Job %s depends on unknown job %s' % (job.name, dep))
+        n_deps = dict((job.name, len(set(job.after))) for job in self.jobs)
+        dependents = dict((job.name, []) for job in self.jobs)
+        for job in self.jobs:
+            for dep in set(job.after):
+                dependents[dep].append(job)
+        ready = deque([job for job in self.jobs if n_deps[job.name] == 0])
+        res = []
+        while ready:
+            job = ready.popleft()
+            res.append(job)
+            for nxt in dependents[job.name]:
+                n_deps[nxt.name] -= 1
+                if n_deps[nxt.name] == 0:
+                    ready.append(nxt)
+        if len(res) != len(self.jobs):
+            cycle = [job.name for job in self.jobs if n_deps[job.name] > 0]
+            raise RuntimeError('Job dependencies contain a cycle involving: %s' % ', '.join(cycle))
+        return res
+
+    def run(self):
+        """Runs all the jobs, returns the list of jobs that did not succeed"""
+        ordered = self.order()
+        if self.dry_run:
+            for job in ordered:
+                print '[DRY-RUN]: ' + self.full_command(job)
+            return []
+        if self.log_dir and not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        self.n_deps = dict((job.name, len(set(job.after))) for job in self.jobs)
+        self.dependents = dict((job.name, []) for job in self.jobs)
+        for job in self.jobs:
+            for dep in set(job.after):
+                self.dependents[dep].append(job)
+        self.ready = deque([job for job in ordered if self.n_deps[job.name] == 0])
+        self.n_finished = 0
+
+        workers = []
+        for i in xrange(min(self.parallel, len(self.jobs))):
+            worker = threading.Thread(target=self.worker, args=(i,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            # Join with a timeout so that the main thread still sees Ctrl-C
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1.)
+        except KeyboardInterrupt:
+            with self.lock:
+                self.aborted = True
+                for proc in self.running.values():
+                    self.kill(proc)
+            raise
+        return [job for job in self.jobs if job.status != 'done']
+
+    def worker(self, slot):
+        while True:
+            with self.lock:
+                while not self.ready and self.n_finished < len(self.jobs) and not self.aborted:
+                    self.lock.wait()
+                if not self.ready or self.aborted:
+                    self.lock.notify_all()
+                    return
+                job = self.ready.popleft()
+                job.status = 'running'
+            ok = self.run_job(job, slot)
+            with self.lock:
+                self.finish(job, 'done' if ok else 'failed')
+                self.lock.notify_all()
+
+    def finish(self, job, status):
+        job.status = status
+        self.n_finished += 1
+        print '>> [%i/%i] %s %s' % (self.n_finished, len(self.jobs), job.name, status.upper())
+        for nxt in self.dependents[job.name]:
+            if nxt.status != 'pending':
+                continue
+            if status == 'done':
+                self.n_deps[nxt.name] -= 1
+                if self.n_deps[nxt.name] == 0:
+                    self.ready.append(nxt)
+            else:
+                self.finish(nxt, 'skipped')
+
+    def full_command(self, job):
+        if job.command.startswith('combine'):
+            return self.pre_cmd + job.command
+        return job.command
+
+    def shell_command(self, command):
+        # Run the command in its own session, and so its own process group, so
+        # that a timeout also kills anything it has started. This and the
+        # memory limit are set up by the shell, as preexec_fn is not safe to
+        # use with several threads starting processes
+        if self.memory is not None:
+            command = 'ulimit -v %i; %s' % (self.memory * 1024, command)
+        return 'exec setsid sh -c %s' % pipes.quote(command)
+
+    def kill(self, proc, sig=signal.SIGTERM):
+        # A script sent to a pool worker has no pid until it has started
+        if proc.pid is None:
+            return
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+
+    def run_job(self, job, slot=0):
+        job.log = os.path.join(self.log_dir, '%s.log' % job.name)
+        command = self.full_command(job)
+        in_pool = self.pool is not None and self.pool.accepts(command)
+        # Opened for appending, as a pool worker writes to the log through
+        # its own file descriptor
+        with open(job.log, 'a') as logfile:
+            logfile.truncate(0)
+            for attempt in xrange(self.retries + 1):
+                job.attempts = attempt + 1
+                logfile.write('>> [attempt %i] %s\n' % (job.attempts, command))
+                logfile.flush()
+                with self.lock:
+                    if self.aborted:
+                        return False
+                    if in_pool:
+                        proc = self.pool.start(slot, command, job.log, self.memory)
+                    else:
+                        proc = subprocess.Popen(self.shell_command(command), shell=True,
+                                                stdout=logfile, stderr=subprocess.STDOUT)
+                    self.running[job.name] = proc
+                start = time.time()
+                killed_at = None
+                while proc.poll() is None:
+                    elapsed = time.time() - start
+                    if self.timeout is not None and killed_at is None and elapsed > self.timeout:
+                        self.kill(proc)
+                        killed_at = elapsed
+                    elif killed_at is not None and elapsed > killed_at + self.KILL_GRACE:
+                        self.kill(proc, signal.SIGKILL)
+                    time.sleep(self.POLL_INTERVAL)
+                with self.lock:
+                    del self.running[job.name]
+                job.returncode = proc.returncode
+                if killed_at is not None:
+                    logfile.write('>> [attempt %i] timed out after %.0fs\n' % (job.attempts, killed_at))
+                else:
+                    logfile.write('>> [attempt %i] exit code %i after %.0fs\n' % (
+                        job.attempts, proc.returncode, time.time() - start))
+                logfile.flush()
+                if killed_at is None and proc.returncode == 0:
+                    return True
+        return False
+
+
+def add_to_dag_file(filename, task, commands, deps=None, after_tasks=None):
+    """Appends the commands to the json job graph in filename, as jobs of
+    the given task. deps maps the index of a command to the indices of the
+    other commands it depends on. Every command also depends on all the jobs
+    already in the file for the tasks in after_tasks, and on those from
+    earlier calls for the same task."""
+    jobs = []
+    if os.path.isfile(filename):
+        with open(filename) as jsonfile:
+            jobs = json.load(jsonfile)
+    after_tasks = list(after_tasks) if after_tasks is not None else []
+    deps = deps if deps is not None else {}
+    for t in after_tasks:
+        if not any(j['task'] == t for j in jobs):
+            raise RuntimeError('Task %s has no jobs in %s' % (t, filename))
+    before = [j['name'] for j in jobs if j['task'] in after_tasks + [task]]
+    offset = sum(1 for j in jobs if j['task'] == task)
+    for i, command in enumerate(commands):
+        jobs.append({
+            'name': '%s.%i' % (task, offset + i),
+            'task': task,
+            'command': command,
+            'after': before + ['%s.%i' % (task, offset + d) for d in deps.get(i, [])]
+        })
+    with open(filename, 'w') as jsonfile:
+        json.dump(jobs, jsonfile, indent=2)
+    return len(commands)
+
+
+def load_dag_file(filename, scheduler):
+    """Adds all the jobs in the json job graph filename to the scheduler"""
+    with open(filename) as jsonfile:
+        jobs = json.load(jsonfile)
+    for j in jobs:
+        scheduler.add(j['name'], j['command'], j['after'], j['task'])
@@ -4,8 +4,9 @@ import ROOT
 import json
 import os
 import pprint
+from multiprocessing import Pool
+import numpy as np
 from collections import defaultdict
-from array import array
 
 import CombineHarvester.CombineTools.combine.utils as utils
 import CombineHarvester.CombineTools.plotting as plot
@@ -77,6 +78,109 @@ class PrintFit(CombineToolBase):
 
             # pprint.pprint(res)
 
+def map_files(func, jobs, workers):
+    """Applies func to each of jobs, in a pool of worker processes if
+    workers > 1, and returns the list of results in the same order"""
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(processes=workers)
+        res = pool.map(func, jobs)
+        pool.close()
+        pool.join()
+        return res
+    else:
+        return [func(job) for job in jobs]
+
+
+def read_limits_file(job):
+    """Validates and reads one file for CollectLimits, where job is a tuple of
+    (filename, toys, limit_err). Returns the dict of limits per mass for this
+    file, or None if the file is corrupt or incomplete"""
+    filename, toys, limit_err = job
+    cols = utils.read_limit_tree(filename, validate=True)
+    if cols is None:
+        print '>> File %s is corrupt or incomplete, skipping' % filename
+        return None
+    js_out = {}
+    masks = utils.quantile_masks(cols['quantileExpected'])
+    for mh_val in np.unique(cols['mh']):
+        mh = str(float(mh_val))
+        at_mh = cols['mh'] == mh_val
+        js_out[mh] = {}
+        if toys:
+            js_out[mh]['toys'] = {}
+            toy = at_mh & (cols['iToy'] > 0)
+            for limit, mask in masks.iteritems():
+                js_out[mh]['toys'][limit] = cols['limit'][toy & mask].tolist()
+            data = at_mh & (cols['iToy'] == 0) & masks['obs']
+            if data.any():
+                js_out[mh]['obs'] = cols['limit'][data].tolist()
+        else:
+            # If a quantile appears more than once the last entry is taken
+            for limit, mask in masks.iteritems():
+                sel = np.flatnonzero(at_mh & mask)
+                if len(sel) == 0:
+                    continue
+                js_out[mh][limit] = float(cols['limit'][sel[-1]])
+                if limit_err:
+                    js_out[mh][limit + '_err'] = float(cols['limitErr'][sel[-1]])
+    return js_out
+
+
+def read_gof_file(filename):
+    """Validates and reads one file for CollectGoodnessOfFit. Returns a dict
+    per mass of the category branch names, the 2D array of toy test statistic
+    values (one row per toy, one column per category) and the row for the
+    observed data, or None if the file is corrupt or incomplete"""
+    file = plot.TFileOpenIfGood(filename)
+    if file is None:
+        print '>> File %s is corrupt or incomplete, skipping' % filename
+        return None
+    tree = file.Get('limit')
+    adding_cat_branch = False
+    branches = []
+    for branch in tree.GetListOfBranches():
+        # Current logic says any branch after quantileExpected is a special
+        # GOF branch labelled according to category
+        if adding_cat_branch:
+            branches.append(branch.GetName())
+        if branch.GetName() == 'quantileExpected':
+            adding_cat_branch = True
+    # print branches
+    stat_cols = branches if branches else ['limit']
+    cols = utils.read_tree_columns(tree, ['mh', 'iToy', 'quantileExpected'] + stat_cols)
+    file.Close()
+    values = np.column_stack([cols[col] for col in stat_cols])
+    selected = cols['quantileExpected'] == -1
+    js_out = {}
+    for mh_val in np.unique(cols['mh']):
+        at_mh = cols['mh'] == mh_val
+        res = {'branches': branches}
+        res['toy'] = values[at_mh & selected & (cols['iToy'] > 0)]
+        data = np.flatnonzero(at_mh & selected & (cols['iToy'] <= 0))
+        if len(data) > 0:
+            res['obs'] = values[data[-1]]
+        js_out[str(float(mh_val))] = res
+    return js_out
+
+
+def gof_p_values(toys, obs, n_bootstrap=0, seed=1):
+    """Returns the p-values, i.e. the fraction of toys with a test statistic
+    at least as large as the observed one, for all the columns of the 2D toys
+    array at once. If n_bootstrap > 0 also returns the spread of each p-value
+    over that many bootstrap resamplings of the toys, otherwise None. At least
+    two resamplings are needed for the spread to be defined"""
+    ntoys = toys.shape[0]
+    p = np.mean(toys >= obs[None, :], axis=0)
+    if n_bootstrap <= 0:
+        return p, None
+    if n_bootstrap == 1:
+        raise RuntimeError('The spread of the p-values needs at least 2 bootstrap resamplings')
+    # The number of passing toys in a resampled set is binomially distributed
+    rng = np.random.RandomState(seed)
+    samples = rng.binomial(ntoys, p, size=(n_bootstrap, len(p))) / float(ntoys)
+    return p, samples.std(axis=0, ddof=1)
+
+
 class CollectLimits(CombineToolBase):
     description = 'Aggregate limit output from combine'
     requires_root = True
@@ -104,13 +208,14 @@ class CollectLimits(CombineToolBase):
         group.add_argument(
             '--limit-err', action='store_true',
             help="""Also store the uncertainties on the limit""")
+        group.add_argument(
+            '--workers', type=int, default=1,
+            help="""Number of processes used to validate and read the input
+                 files""")
 
     def run_method(self):
         limit_sets = defaultdict(list)
         for filename in self.args.input:
-            if not plot.TFileIsGood(filename):
-                print '>> File %s is corrupt or incomplete, skipping' % filename
-                continue
             if self.args.use_dirs is False:
                 limit_sets['default'].append(filename)
             else:
@@ -125,81 +230,47 @@ class CollectLimits(CombineToolBase):
                 limit_sets[label].append(filename)
         # print limit_sets
 
-        for label, filenames in limit_sets.iteritems():
+        # Validate and read each file once, then merge the results per label
+        jobs = [(filename, self.args.toys, self.args.limit_err) for filename in self.args.input]
+        file_results = dict(zip(self.args.input, map_files(read_limits_file, jobs, self.args.workers)))
+
+        for label, all_filenames in limit_sets.iteritems():
+            filenames = [x for x in all_filenames if file_results[x] is not None]
+            if len(filenames) == 0:
+                continue
             js_out = {}
             for filename in filenames:
-                if plot.TFileIsGood(filename):
-                    file = ROOT.TFile(filename)
-                    tree = file.Get('limit')
-                    for evt in tree:
-                        mh = str(evt.mh)
-                        if mh not in js_out:
-                            js_out[mh] = {}
-                            if self.args.toys:
-                                js_out[mh]['toys'] = {}
-                                for limit in ['obs', 'exp0', 'exp-2', 'exp-1', 'exp+1', 'exp+2']:
-                                    js_out[mh]['toys'][limit] = []
-                        if self.args.toys:
-                            if evt.iToy > 0:
-                                if evt.quantileExpected == -1:
-                                    js_out[mh]['toys']['obs'].append(evt.limit)
-                                elif abs(evt.quantileExpected - 0.5) < 1E-4:
-                                    js_out[mh]['toys']["exp0"].append(evt.limit)
-                                elif abs(evt.quantileExpected - 0.025) < 1E-4:
-                                    js_out[mh]['toys']["exp-2"].append(evt.limit)
-                                elif abs(evt.quantileExpected - 0.160) < 1E-4:
-                                    js_out[mh]['toys']["exp-1"].append(evt.limit)
-                                elif abs(evt.quantileExpected - 0.840) < 1E-4:
-                                    js_out[mh]['toys']["exp+1"].append(evt.limit)
-                                elif abs(evt.quantileExpected - 0.975) < 1E-4:
-                                    js_out[mh]['toys']["exp+2"].append(evt.limit)
-                            elif evt.iToy == 0:
-                                if evt.quantileExpected == -1:
-                                    js_out[mh]['obs'].append(evt.limit)
-
+                for mh, vals in file_results[filename].iteritems():
+                    if mh not in js_out:
+                        js_out[mh] = vals
+                        continue
+                    for key, val in vals.iteritems():
+                        if key == 'toys':
+                            for limit, toys in val.iteritems():
+                                js_out[mh]['toys'][limit].extend(toys)
+                        elif key == 'obs' and self.args.toys:
+                            js_out[mh].setdefault('obs', []).extend(val)
                         else:
-                            if evt.quantileExpected == -1:
-                                js_out[mh]['obs'] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['obs_err'] = evt.limitErr
-                            elif abs(evt.quantileExpected - 0.5) < 1E-4:
-                                js_out[mh]["exp0"] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['exp0_err'] = evt.limitErr
-                            elif abs(evt.quantileExpected - 0.025) < 1E-4:
-                                js_out[mh]["exp-2"] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['exp-2_err'] = evt.limitErr
-                            elif abs(evt.quantileExpected - 0.160) < 1E-4:
-                                js_out[mh]["exp-1"] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['exp-1_err'] = evt.limitErr
-                            elif abs(evt.quantileExpected - 0.840) < 1E-4:
-                                js_out[mh]["exp+1"] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['exp+1_err'] = evt.limitErr
-                            elif abs(evt.quantileExpected - 0.975) < 1E-4:
-                                js_out[mh]["exp+2"] = evt.limit
-                                if self.args.limit_err:
-                                    js_out[mh]['exp+2_err'] = evt.limitErr
+                            js_out[mh][key] = val
 
             if self.args.toys:
                 for mh in js_out.keys():
                     print "Expected bands will be taken from toys"
                     print mh
-                    limits = sorted(js_out[mh]['toys']['obs'])
+                    limits = js_out[mh]['toys']['obs']
+                    if len(limits) == 0:
+                        print '>> No toys found for mh=%s, skipping' % mh
+                        continue
                     #if mh == '160.0' or mh == '90.0' :
                     #    limits = [x for x in limits if x > 0.1]
-                    quantiles = array('d', [0.025, 0.160, 0.5, 0.840, 0.975])
-                    res = array('d', [0., 0., 0., 0., 0.])
-                    empty = array('i', [0])
-                    ROOT.TMath.Quantiles(len(limits), len(quantiles), array('d', limits), res, quantiles, True, empty, 1)
+                    quantiles = [0.025, 0.160, 0.5, 0.840, 0.975]
+                    res = utils.empirical_quantiles(limits, quantiles)
                     print res
-                    js_out[mh]['exp-2'] = res[0]
-                    js_out[mh]['exp-1'] = res[1]
-                    js_out[mh]['exp0'] = res[2]
-                    js_out[mh]['exp+1'] = res[3]
-                    js_out[mh]['exp+2'] = res[4]
+                    js_out[mh]['exp-2'] = float(res[0])
+                    js_out[mh]['exp-1'] = float(res[1])
+                    js_out[mh]['exp0'] = float(res[2])
+                    js_out[mh]['exp+1'] = float(res[3])
+                    js_out[mh]['exp+2'] = float(res[4])
             # print js_out
             jsondata = json.dumps(
                 js_out, sort_keys=True, indent=2, separators=(',', ': '))
@@ -231,13 +302,20 @@ class CollectGoodnessOfFit(CombineToolBase):
             '--use-dirs', action='store_true',
             help="""Use the directory structure to create multiple limit
                  outputs and to set the output file names""")
+        group.add_argument(
+            '--bootstrap', type=int, default=0,
+            help="""Estimate the uncertainty on each p-value from this many
+                 bootstrap resamplings of the toys, at least 2""")
+        group.add_argument(
+            '--workers', type=int, default=1,
+            help="""Number of processes used to validate and read the input
+                 files""")
 
     def run_method(self):
+        if self.args.bootstrap == 1:
+            raise RuntimeError('--bootstrap needs at least 2 resamplings to estimate the spread of the p-values')
         limit_sets = defaultdict(list)
         for filename in self.args.input:
-            if not plot.TFileIsGood(filename):
-                print '>> File %s is corrupt or incomplete, skipping' % filename
-                continue
             if not self.args.use_dirs:
                 if 'default' not in limit_sets:
                     limit_sets['default'] = ([],[])
@@ -255,50 +333,47 @@ class CollectGoodnessOfFit(CombineToolBase):
                     limit_sets[label] = ([],[])
                 limit_sets[label][0].append(filename)
 
+        # Validate and read each file once, then merge the results per label
+        file_results = dict(zip(self.args.input, map_files(read_gof_file, self.args.input, self.args.workers)))
 
-        for label, (filenames, toyfiles) in limit_sets.iteritems():
-            js_out = {}
+        for label, (all_filenames, toyfiles) in limit_sets.iteritems():
+            filenames = [x for x in all_filenames if file_results[x] is not None]
+            if len(filenames) == 0:
+                continue
+            merged = {}
             for filename in filenames:
-                file = ROOT.TFile(filename)
-                tree = file.Get('limit')
-                adding_cat_branch = False
-                branches = []
-                for branch in tree.GetListOfBranches():
-                    # Current logic says any branch after quantileExpected is a special
-                    # GOF branch labelled according to category
-                    if adding_cat_branch:
-                        branches.append(branch.GetName())
-                    if branch.GetName() == 'quantileExpected':
-                        adding_cat_branch = True
-                # print branches
-                for evt in tree:
-                    mh = str(evt.mh)
-                    if mh not in js_out:
-                        js_out[mh] = {}
-                    if evt.quantileExpected != -1:
-                        continue
-                    if branches:
-                        for branch in branches:
-                            if branch not in js_out[mh]:
-                                js_out[mh][branch] = {}
-                                js_out[mh][branch]['toy'] = []
-                            if evt.iToy <= 0:
-                                js_out[mh][branch]['obs'] = [getattr(evt, branch)]
-                            else:
-                                js_out[mh][branch]['toy'].append(getattr(evt, branch))
+                for mh, vals in file_results[filename].iteritems():
+                    if mh not in merged:
+                        merged[mh] = {'branches': vals['branches'], 'toy': [], 'obs': None}
+                    merged[mh]['toy'].append(vals['toy'])
+                    if 'obs' in vals:
+                        merged[mh]['obs'] = vals['obs']
+
+            js_out = {}
+            for mh, vals in merged.iteritems():
+                js_out[mh] = {}
+                toys = np.concatenate(vals['toy'])
+                obs = vals['obs']
+                if len(toys) == 0 and obs is None:
+                    continue
+                pvals = None
+                perrs = None
+                if len(toys) > 0 and obs is not None:
+                    pvals, perrs = gof_p_values(toys, obs, self.args.bootstrap)
+                # Without category branches the results go directly under mh
+                targets = vals['branches'] if vals['branches'] else [None]
+                for i, branch in enumerate(targets):
+                    entry = {'toy': toys[:, i].tolist()}
+                    if obs is not None:
+                        entry['obs'] = [float(obs[i])]
+                    if pvals is not None:
+                        entry['p'] = float(pvals[i])
+                    if perrs is not None:
+                        entry['p_err'] = float(perrs[i])
+                    if branch is None:
+                        js_out[mh].update(entry)
                     else:
-                        if 'toy' not in js_out[mh]:
-                            js_out[mh]['toy'] = []
-                        if evt.iToy <= 0:
-                            js_out[mh]['obs'] = [evt.limit]
-                        else:
-                            js_out[mh]['toy'].append(evt.limit)
-            for mh in js_out:
-                if all([entry in js_out[mh] for entry in ['toy','obs']]):
-                    js_out[mh]["p"] = float(len([toy for toy in js_out[mh]['toy'] if toy >= js_out[mh]['obs'][0]]))/len(js_out[mh]['toy'])
-                else:
-                    for branch in js_out[mh]:
-                        js_out[mh][branch]["p"] = float(len([toy for toy in js_out[mh][branch]['toy'] if toy >= js_out[mh][branch]['obs'][0]]))/len(js_out[mh][branch]['toy'])
+                        js_out[mh][branch] = entry
 
             # print js_out
             jsondata = json.dumps(
@@ -414,8 +414,8 @@ class TaylorExpand(CombineToolBase):
 
 
                 if self.args.do_fits:
-                    if self.args.test_mode == 0 and not os.path.isfile(filename):
-                        self.job_queue.append('combine %s %s' % (arg_str, ' '.join(self.passthru)))
+                    if self.args.test_mode == 0:
+                        self.add_job('combine %s %s' % (arg_str, ' '.join(self.passthru)), output=filename)
                     if self.args.test_mode > 0:
                         if idx % 10000 == 0:
                             print 'Done %i/%i NLL evaluations...' % (idx, len(actual_evallist))
@@ -430,6 +430,9 @@ class TaylorExpand(CombineToolBase):
                                 cached_evals[xvals] = results[xidx]
                             multivars = list()
 
+            if self.args.do_fits:
+                # Only the evaluations that are still missing are run
+                self.skip_done_jobs()
             if self.args.do_fits and len(self.job_queue):
                 njobs = len(self.job_queue)
                 self.flush_queue()
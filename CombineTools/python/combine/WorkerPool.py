@@ -0,0 +1,228 @@
+import os
+import sys
+import shlex
+import runpy
+import resource
+import traceback
+import multiprocessing
+
+# Characters that mean an unquoted argument has to be interpreted by the shell
+SHELL_CHARS = set(';|&<>()$`*?[~\\')
+
+# Modules used by text2workspace.py and the other python tools of
+# HiggsAnalysis/CombinedLimit, imported once by each worker
+PRELOAD_MODULES = [
+    'HiggsAnalysis.CombinedLimit.DatacardParser',
+    'HiggsAnalysis.CombinedLimit.ModelTools',
+    'HiggsAnalysis.CombinedLimit.ShapeTools',
+    'HiggsAnalysis.CombinedLimit.PhysicsModel'
+]
+
+
+def split_command(command):
+    """Returns (directory, argv) for a command, optionally wrapped in
+    "pushd DIR; ...; popd", where argv is None if the command can only be
+    run by the shell"""
+    directory = None
+    parts = [x.strip() for x in command.split(';') if x.strip()]
+    if len(parts) == 3 and parts[0].startswith('pushd ') and parts[2] == 'popd':
+        directory = parts[0][len('pushd '):].strip()
+        command = parts[1]
+    try:
+        raw = shlex.split(command, posix=False)
+        argv = shlex.split(command)
+    except ValueError:
+        return (directory, None)
+    for arg in raw:
+        if arg[0] in '"\'' and arg[-1] == arg[0]:
+            continue
+        if any(c in SHELL_CHARS for c in arg):
+            return (directory, None)
+    if len(argv) == 0:
+        return (directory, None)
+    return (directory, argv)
+
+
+def find_python_script(name):
+    """Returns the path of name if it is a python script, searching the PATH
+    like the shell would, otherwise None"""
+    if not name.endswith('.py'):
+        return None
+    if '/' in name:
+        candidates = [name]
+    else:
+        candidates = [os.path.join(x, name) for x in os.environ.get('PATH', '').split(os.pathsep)]
+    for path in candidates:
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            with open(path) as script:
+                first = script.readline()
+            if first.startswith('#!') and 'python' in first:
+                return path
+            return None
+    return None
+
+
+def runs_in_process(command):
+    """Returns True if the command is a single call of a python script, which
+    a PythonWorkerPool can run inside one of its workers"""
+    directory, argv = split_command(command)
+    return argv is not None and find_python_script(argv[0]) is not None
+
+
+def preload():
+    # Paid once per worker instead of once per python script
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    ROOT.gROOT.SetBatch(ROOT.kTRUE)
+    ROOT.gSystem.Load('libHiggsAnalysisCombinedLimit')
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+
+def start_script(command, log, memory=None):
+    """Forks a process that runs the python script in command with its output
+    appended to log, and returns its pid. The process starts a new session,
+    so that it can be killed together with anything it starts, and its
+    virtual memory is limited to memory [MB] if this is given"""
+    directory, argv = split_command(command)
+    script = find_python_script(argv[0])
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    code = 1
+    try:
+        os.setsid()
+        if memory is not None:
+            limit = memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        if directory is not None:
+            os.chdir(directory)
+        sys.argv = [script] + argv[1:]
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        try:
+            runpy.run_path(script, run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write('%s\n' % e.code)
+                code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 127
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def worker_main(conn):
+    try:
+        preload()
+    except Exception:
+        traceback.print_exc()
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        command, log, memory = msg
+        try:
+            pid = start_script(command, log, memory)
+        except Exception:
+            traceback.print_exc()
+            conn.send(('finished', 127))
+            continue
+        conn.send(('started', pid))
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            conn.send(('finished', -os.WTERMSIG(status)))
+        else:
+            conn.send(('finished', os.WEXITSTATUS(status)))
+
+
+class WorkerProcess:
+    """Follows a script started by a PythonWorkerPool worker, with the
+    pid, poll() and returncode of a subprocess.Popen. The pid is None until
+    the worker has reported that the script has started"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = None
+        self.returncode = None
+
+    def poll(self):
+        while self.returncode is None and self.conn.poll():
+            try:
+                status, val = self.conn.recv()
+            except EOFError:
+                # The worker itself has died
+                status, val = 'finished', -1
+            if status == 'started':
+                self.pid = val
+            else:
+                self.returncode = val
+        return self.returncode
+
+
+class PythonWorkerPool:
+    """A set of long-lived worker processes that have already imported ROOT,
+    loaded libHiggsAnalysisCombinedLimit and imported the CombinedLimit
+    python modules, for running python scripts such as text2workspace.py
+    without paying for these imports every time. Each script runs in a
+    process forked from a worker, in the same directory and with the same
+    arguments as it would be otherwise, so it produces the same output
+    files. combine and other programs gain nothing from the workers and are
+    not run here.
+
+    Workers are addressed by slot, and each slot must only be used by one
+    thread at a time, as done by the LocalScheduler"""
+
+    def __init__(self, n_workers):
+        self.workers = [None] * max(1, n_workers)
+        self.conns = [None] * max(1, n_workers)
+        for slot in xrange(len(self.workers)):
+            self.spawn(slot)
+
+    def spawn(self, slot):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=worker_main, args=(child_conn,))
+        proc.daemon = True
+        proc.start()
+        self.workers[slot] = proc
+        self.conns[slot] = parent_conn
+
+    def accepts(self, command):
+        return runs_in_process(command)
+
+    def start(self, slot, command, log, memory=None):
+        """Starts the python script in command in the worker for slot and
+        returns a Popen-like WorkerProcess for it"""
+        if not self.workers[slot].is_alive():
+            self.spawn(slot)
+        self.conns[slot].send((command, log, memory))
+        return WorkerProcess(self.conns[slot])
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for proc in self.workers:
+            proc.join()
+        del self.workers[:]
+        del self.conns[:]
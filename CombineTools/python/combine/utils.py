@@ -1,5 +1,28 @@
-import ROOT
 import re
+import os
+import json
+import hashlib
+import importlib
+
+
+class LazyModule(object):
+    """Stands in for a module that is only imported the first time one of its
+    attributes is used. Lets the job-creation methods use the helpers here
+    without paying for the ROOT and numpy imports at startup"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the proxy itself
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+ROOT = LazyModule('ROOT')
+np = LazyModule('numpy')
+plot = LazyModule('CombineHarvester.CombineTools.plotting')
 
 def split_vals(vals, fmt_spec=None):
     """Converts a string '1:3|1,4,5' into a list [1, 2, 3, 4, 5]"""
@@ -38,9 +61,122 @@ def list_from_workspace(file, workspace, set):
     return res
 
 
-def prefit_from_workspace(file, workspace, params, setPars=None):
-    """Given a list of params, return a dictionary of [-1sig, nominal, +1sig]"""
+def file_hash(filename):
+    """Returns the sha1 hex digest of the contents of a file"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def constraint_type(pdf):
+    """Returns the label used in the impacts output for a constraint pdf"""
+    if pdf.IsA().InheritsFrom(ROOT.RooGaussian.Class()):
+        return 'Gaussian'
+    elif pdf.IsA().InheritsFrom(ROOT.RooPoisson.Class()):
+        return 'Poisson'
+    elif pdf.IsA().InheritsFrom(ROOT.RooBifurGauss.Class()):
+        return 'AsymmetricGaussian'
+    else:
+        return 'Unrecognised'
+
+
+def poisson_nll_crossings(n):
+    """Given an array of observed counts n > 0, returns the arrays (lo, hi) of
+    the Poisson means below and above n at which the NLL is 0.5 units above
+    its minimum"""
+    def dnll(mu):
+        return mu - n * np.log(mu) - (n - n * np.log(n)) - 0.5
+    lo = [np.full_like(n, 1E-12) * n, n.copy()]
+    hi = [n.copy(), n + 2. * np.sqrt(n) + 2.]
+    for i in xrange(100):
+        for (a, b), rising in ((lo, False), (hi, True)):
+            mid = 0.5 * (a + b)
+            above = dnll(mid) > 0
+            if rising:
+                b[:] = np.where(above, mid, b)
+                a[:] = np.where(above, a, mid)
+            else:
+                a[:] = np.where(above, mid, a)
+                b[:] = np.where(above, b, mid)
+    return 0.5 * (lo[0] + lo[1]), 0.5 * (hi[0] + hi[1])
+
+
+def analytic_prefit(ws, params, ptype):
+    """Determines the prefit [-1sig, nominal, +1sig] of params that share the
+    constraint type ptype ('Gaussian', 'AsymmetricGaussian' or 'Poisson')
+    without running a fit. The constraint pdfs are evaluated at a few points
+    either side of the global observable to check they have the expected
+    form, and the returned dict only contains the params that passed"""
+    offsets = np.array([1., -1., 2., -2.])
+    npar = len(params)
+    gval = np.zeros(npar)
+    step = np.zeros(npar)
+    vmin = np.zeros(npar)
+    vmax = np.zeros(npar)
+    pdfvals = np.zeros((npar, 1 + len(offsets)))
+    for i, p in enumerate(params):
+        var = ws.var(p)
+        pdf = ws.pdf(p+'_Pdf')
+        gval[i] = ws.var(p+'_In').getVal()
+        vmin[i] = var.getMin()
+        vmax[i] = var.getMax()
+        scale = np.sqrt(max(gval[i], 0.)) if ptype == 'Poisson' else 1.
+        step[i] = 0.25 * min(scale, vmax[i] - gval[i], gval[i] - vmin[i])
+        if step[i] <= 0.:
+            continue
+        val0 = var.getVal()
+        for j, x in enumerate([0.] + list(offsets)):
+            var.setVal(gval[i] + x * step[i])
+            pdfvals[i, j] = pdf.getVal()
+        var.setVal(val0)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # NLL differences w.r.t. the nominal point
+        dnll = np.log(pdfvals[:, :1]) - np.log(pdfvals[:, 1:])
+        shifts = offsets[None, :] * step[:, None]
+        ok = (step > 0.) & np.all(np.isfinite(dnll), axis=1)
+        if ptype == 'Poisson':
+            n = gval[:, None]
+            expected = n * np.log(n / (n + shifts)) + shifts
+            ok &= np.all(np.abs(dnll - expected) < 1E-6 * (1. + np.abs(expected)), axis=1)
+            mulo, muhi = poisson_nll_crossings(np.where(ok, gval, 1.))
+            errlo = gval - mulo
+            errhi = muhi - gval
+        else:
+            # Either side of the minimum the NLL is k^2/(2*sigma^2)
+            sigmas = np.abs(shifts) / np.sqrt(2. * dnll)
+            ok &= np.abs(sigmas[:, 0] - sigmas[:, 2]) < 1E-4 * sigmas[:, 0]
+            ok &= np.abs(sigmas[:, 1] - sigmas[:, 3]) < 1E-4 * sigmas[:, 1]
+            errhi = sigmas[:, 0]
+            errlo = sigmas[:, 1]
+            if ptype == 'Gaussian':
+                ok &= np.abs(errhi - errlo) < 1E-4 * errhi
+        ok &= (gval - errlo >= vmin) & (gval + errhi <= vmax)
+    return {p: [float(gval[i] - errlo[i]), float(gval[i]), float(gval[i] + errhi[i])]
+            for i, p in enumerate(params) if ok[i]}
+
+
+def prefit_from_workspace(file, workspace, params, setPars=None, cache=None):
+    """Given a list of params, return a dictionary of [-1sig, nominal, +1sig]
+
+    If cache is the name of a json file, the results are stored there keyed by
+    a hash of the workspace file and setPars, and any params already in it are
+    not recomputed"""
     res = {}
+    cache_js = {}
+    cache_key = None
+    if cache is not None:
+        cache_key = hashlib.sha1(
+            '%s:%s:%s' % (file_hash(file), workspace, setPars)).hexdigest()
+        if os.path.isfile(cache):
+            with open(cache) as jsonfile:
+                cache_js = json.load(jsonfile)
+        cached = cache_js.get(cache_key, {})
+        res.update({p: cached[p] for p in params if p in cached})
+        params = [p for p in params if p not in cached]
+        if len(params) == 0:
+            return res
     wsFile = ROOT.TFile(file)
     ws = wsFile.Get(workspace)
     ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
@@ -50,6 +186,8 @@ def prefit_from_workspace(file, workspace, params, setPars=None):
         print 'Setting paramter %s to %g' % (par, float(val))
         ws.var(par).setVal(float(val))
 
+    to_fit = []
+    by_type = {}
     for p in params:
         res[p] = {}
 
@@ -59,41 +197,122 @@ def prefit_from_workspace(file, workspace, params, setPars=None):
 
         # For pyROOT NULL test: "pdf != None" != "pdf is not None"
         if pdf != None and gobs != None:
-            # To get the errors we can just fit the pdf
-            # But don't do pdf.fitTo(globalObs), it forces integration of the
-            # range of the global observable. Instead we make a RooConstraintSum
-            # which is what RooFit creates by default when we have external constraints
-            nll = ROOT.RooConstraintSum('NLL', '', ROOT.RooArgSet(pdf), ROOT.RooArgSet(var))
-            minim = ROOT.RooMinimizer(nll)
-            minim.setEps(0.001)  # Might as well get some better precision...
-            minim.setErrorLevel(0.5) # Unlike for a RooNLLVar we must set this explicitly
-            minim.setPrintLevel(-1)
-            minim.setVerbose(False)
-            # Run the fit then run minos for the error
-            minim.minimize('Minuit2', 'migrad')
-            minim.minos(ROOT.RooArgSet(var))
-            # Should really have checked that these converged ok...
-            # var.Print()
-            # pdf.Print()
-            val = var.getVal()
-            errlo = -1 * var.getErrorLo()
-            errhi = +1 * var.getErrorHi()
-            res[p]['prefit'] = [val-errlo, val, val+errhi]
-            if pdf.IsA().InheritsFrom(ROOT.RooGaussian.Class()):
-                res[p]['type'] = 'Gaussian'
-            elif pdf.IsA().InheritsFrom(ROOT.RooPoisson.Class()):
-                res[p]['type'] = 'Poisson'
-            elif pdf.IsA().InheritsFrom(ROOT.RooBifurGauss.Class()):
-                res[p]['type'] = 'AsymmetricGaussian'
-            else:
-                res[p]['type'] = 'Unrecognised'
+            res[p]['type'] = constraint_type(pdf)
+            by_type.setdefault(res[p]['type'], []).append(p)
         elif pdf == None or pdf.IsA().InheritsFrom(ROOT.RooUniform.Class()):
             res[p]['type'] = 'Unconstrained'
             res[p]['prefit'] = [var.getVal(), var.getVal(), var.getVal()]
         res[p]['groups'] = [x.replace('group_', '') for x in var.attributes() if x.startswith('group_')]
+
+    for ptype, plist in by_type.iteritems():
+        analytic = {}
+        if ptype in ['Gaussian', 'AsymmetricGaussian', 'Poisson']:
+            analytic = analytic_prefit(ws, plist, ptype)
+        for p in plist:
+            if p in analytic:
+                res[p]['prefit'] = analytic[p]
+            else:
+                to_fit.append(p)
+
+    for p in to_fit:
+        var = ws.var(p)
+        pdf = ws.pdf(p+'_Pdf')
+        # To get the errors we can just fit the pdf
+        # But don't do pdf.fitTo(globalObs), it forces integration of the
+        # range of the global observable. Instead we make a RooConstraintSum
+        # which is what RooFit creates by default when we have external constraints
+        nll = ROOT.RooConstraintSum('NLL', '', ROOT.RooArgSet(pdf), ROOT.RooArgSet(var))
+        minim = ROOT.RooMinimizer(nll)
+        minim.setEps(0.001)  # Might as well get some better precision...
+        minim.setErrorLevel(0.5) # Unlike for a RooNLLVar we must set this explicitly
+        minim.setPrintLevel(-1)
+        minim.setVerbose(False)
+        # Run the fit then run minos for the error
+        minim.minimize('Minuit2', 'migrad')
+        minim.minos(ROOT.RooArgSet(var))
+        # Should really have checked that these converged ok...
+        # var.Print()
+        # pdf.Print()
+        val = var.getVal()
+        errlo = -1 * var.getErrorLo()
+        errhi = +1 * var.getErrorHi()
+        res[p]['prefit'] = [val-errlo, val, val+errhi]
+
+    if cache is not None:
+        cache_js.setdefault(cache_key, {}).update({p: res[p] for p in params})
+        with open(cache, 'w') as jsonfile:
+            json.dump(cache_js, jsonfile)
+    return res
+
+
+def read_tree_columns(tree, columns):
+    """Reads the branches listed in columns from a TTree in a single pass and
+    returns a dict of {column: numpy array}, one entry per tree entry"""
+    uniq = []
+    for col in columns:
+        if col not in uniq:
+            uniq.append(col)
+    nentries = tree.GetEntries()
+    if nentries == 0 or len(uniq) == 0:
+        return {col: np.zeros(0) for col in uniq}
+    # TTree::Draw keeps the values of each expression in an internal buffer,
+    # which by default is capped at 1000000 entries
+    tree.SetEstimate(nentries + 1)
+    nsel = tree.Draw(':'.join(uniq), '', 'goff')
+    if nsel == nentries:
+        return {col: np.ndarray((nsel,), dtype=np.float64, buffer=tree.GetVal(i)).copy()
+                for i, col in enumerate(uniq)}
+    # Draw could not parse one of the names as a formula, fall back to a
+    # single event loop filling all the columns at once
+    res = {col: np.zeros(nentries) for col in uniq}
+    for i, evt in enumerate(tree):
+        for col in uniq:
+            res[col][i] = getattr(evt, col)
+    return res
+
+
+# The quantileExpected values that label the observed and expected limits
+LIMIT_QUANTILES = [('obs', -1.), ('exp-2', 0.025), ('exp-1', 0.160), ('exp0', 0.5), ('exp+1', 0.840), ('exp+2', 0.975)]
+
+
+def read_limit_tree(file, columns=('mh', 'limit', 'limitErr', 'quantileExpected', 'iToy'), validate=False):
+    """Reads the given columns of the combine limit tree into numpy arrays,
+    returns None if the file or the tree cannot be opened. With validate=True
+    the file must also pass the plotting.TFileIsGood tests, which are done on
+    the same open file"""
+    if validate:
+        f = plot.TFileOpenIfGood(file)
+    else:
+        f = ROOT.TFile(file)
+    if f is None or f.IsZombie():
+        return None
+    t = f.Get("limit")
+    if t == None:
+        return None
+    res = read_tree_columns(t, columns)
+    f.Close()
     return res
 
 
+def quantile_masks(quantiles, tolerance=1E-4):
+    """Classifies an array of quantileExpected values, returning a dict of
+    {label: boolean mask} for each of the labels in LIMIT_QUANTILES"""
+    return {label: np.abs(quantiles - q) < tolerance for label, q in LIMIT_QUANTILES}
+
+
+def empirical_quantiles(values, probs):
+    """Returns the quantiles of values at each of probs using the inverse of
+    the empirical cdf, the same definition as TMath::Quantiles with type=1"""
+    x = np.sort(np.asarray(values, dtype=np.float64))
+    n = len(x)
+    nppm = n * np.asarray(probs, dtype=np.float64)
+    j = np.floor(nppm).astype(int)
+    gamma = (nppm > j).astype(np.float64)
+    first = np.where((j > 0) & (j <= n), j - 1, np.where(j <= 0, 0, n - 1))
+    second = np.where((j > 0) & (j < n), j, np.where(j <= 0, 0, n - 1))
+    return (1. - gamma) * x[first] + gamma * x[second]
+
+
 def get_singles_results(file, scanned, columns):
     """Extracts the output from the MultiDimFit singles mode
     Note: relies on the list of parameters that were run (scanned) being correct"""
@@ -102,15 +321,16 @@ def get_singles_results(file, scanned, columns):
     if f is None or f.IsZombie():
         return None
     t = f.Get("limit")
+    if t.GetEntries() < (1 + len(scanned)*2):
+        print 'File %s did not contain a sufficient number of entries, skipping' % file
+        return None
+    allvals = read_tree_columns(t, columns)
     for i, param in enumerate(scanned):
         res[param] = {}
         for col in columns:
-            allvals = [getattr(evt, col) for evt in t]
-            if len(allvals) < (1 + len(scanned)*2):
-                print 'File %s did not contain a sufficient number of entries, skipping' % file
-                return None
+            vals = allvals[col]
             res[param][col] = [
-                allvals[i * 2 + 1], allvals[0], allvals[i * 2 + 2]]
+                float(vals[i * 2 + 1]), float(vals[0]), float(vals[i * 2 + 2])]
     return res
 
 def get_none_results(file, params):
@@ -120,9 +340,9 @@ def get_none_results(file, params):
     if f is None or f.IsZombie():
         return None
     t = f.Get("limit")
-    t.GetEntry(0)
+    allvals = read_tree_columns(t, params)
     for param in params:
-      res[param] = getattr(t, param)
+      res[param] = float(allvals[param][0])
     return res
 
 
@@ -133,14 +353,13 @@ def get_fixed_results(file, params):
     if f is None or f.IsZombie():
         return None
     t = f.Get("limit")
-    t.GetEntry(0)
+    allvals = read_tree_columns(t, params + ['deltaNLL', 'quantileExpected'])
     res['bestfit'] = {}
     res['fixedpoint'] = {}
     for param in params:
-        res['bestfit'][param] = getattr(t, param)
-    t.GetEntry(1)
+        res['bestfit'][param] = float(allvals[param][0])
     for param in params:
-        res['fixedpoint'][param] = getattr(t, param)
-    res['deltaNLL'] = getattr(t, 'deltaNLL')
-    res['pvalue'] = getattr(t, 'quantileExpected')
+        res['fixedpoint'][param] = float(allvals[param][1])
+    res['deltaNLL'] = float(allvals['deltaNLL'][1])
+    res['pvalue'] = float(allvals['quantileExpected'][1])
     return res
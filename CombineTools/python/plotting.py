@@ -510,32 +510,48 @@ def GetAxisHist(pad):
 #  @details A collection of functions for working with TFiles.
 ##@{
 
-def TFileIsGood(filename):
-    """Performs a series of tests on a TFile to ensure that it can be opened
-    without errors
+def TFileOpenIfGood(filename):
+    """Opens a TFile and performs the same tests as TFileIsGood, such that a
+    file only has to be opened once to be both validated and read
 
     Args:
-        filename: `str` The name of the TFile to check
+        filename: `str` The name of the TFile to open
 
     Returns:
-        `bool` True if the file can opened, is not a zombie, and if ROOT did
-        not need to try and recover the contents
+        `TFile` The open file if it passes the tests, otherwise None
     """
     fin = R.TFile(filename)
     if not fin:
-        return False
+        return None
     if fin and not fin.IsOpen():
-        return False
+        return None
     elif fin and fin.IsOpen() and fin.IsZombie():
         fin.Close()
-        return False
+        return None
     elif fin and fin.IsOpen() and fin.TestBit(R.TFile.kRecovered):
         fin.Close()
         # don't consider a recovered file to be OK
-        return False
+        return None
     else:
-        fin.Close()
-        return True
+        return fin
+
+
+def TFileIsGood(filename):
+    """Performs a series of tests on a TFile to ensure that it can be opened
+    without errors
+
+    Args:
+        filename: `str` The name of the TFile to check
+
+    Returns:
+        `bool` True if the file can opened, is not a zombie, and if ROOT did
+        not need to try and recover the contents
+    """
+    fin = TFileOpenIfGood(filename)
+    if fin is None:
+        return False
+    fin.Close()
+    return True
 
 
 def MakeTChain(files, tree):
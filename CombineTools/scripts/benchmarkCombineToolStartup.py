@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Measures the cold-start time of combineTool.py, i.e. the time taken by a
+# fresh process to parse the options and create the jobs for a method.
+# Example usage:
+#   benchmarkCombineToolStartup.py -M EnhancedCombine -M T2W --repeat 10 \
+#       --history startup.json -- -d card.txt -m 120:130:5
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '-M', '--method', action='append', default=[], help="""Method to
+    benchmark, can be given more than once [default: EnhancedCombine]""")
+parser.add_argument(
+    '--repeat', type=int, default=5, help="""Number of times to start each
+    method""")
+parser.add_argument(
+    '--history', default=None, help="""Append the results to this json file,
+    so that the startup time can be tracked over time""")
+parser.add_argument(
+    '--label', default='', help="""Label stored with the results in the
+    history file, e.g. a commit hash""")
+parser.add_argument(
+    'extra', nargs=argparse.REMAINDER, help="""Further options passed to
+    combineTool.py, after a '--'""")
+args = parser.parse_args()
+
+methods = args.method if args.method else ['EnhancedCombine']
+extra = [x for x in args.extra if x != '--']
+
+# Run the copy of combineTool.py next to this script, rather than whichever
+# is first in the PATH
+tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'combineTool.py')
+
+# Reports whether ROOT ended up being imported by the combineTool.py process
+probe = """import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    sys.stderr.write('\\n[startup-benchmark] root_imported=%i\\n' % ('ROOT' in sys.modules))
+"""
+
+results = {}
+devnull = open(os.devnull, 'w')
+for method in methods:
+    cmd = [sys.executable, '-c', probe, tool, '-M', method, '--dry-run'] + extra
+    times = []
+    root_imported = False
+    for i in xrange(args.repeat):
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=subprocess.PIPE)
+        err = proc.communicate()[1]
+        times.append(time.time() - start)
+        if proc.returncode != 0:
+            sys.stderr.write(err)
+            sys.exit('>> combineTool.py -M %s failed with exit code %i' % (method, proc.returncode))
+        root_imported = root_imported or 'root_imported=1' in err
+    times.sort()
+    results[method] = {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'root_imported': root_imported
+    }
+    print '%-20s : min %.3fs, median %.3fs, max %.3fs, ROOT imported: %s' % (
+        method, times[0], times[len(times) // 2], times[-1], root_imported)
+devnull.close()
+
+if args.history is not None:
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history) as jsonfile:
+            history = json.load(jsonfile)
+    history.append({
+        'date': datetime.datetime.now().isoformat(),
+        'label': args.label,
+        'repeat': args.repeat,
+        'args': extra,
+        'results': results
+    })
+    with open(args.history, 'w') as jsonfile:
+        json.dump(history, jsonfile, sort_keys=True, indent=2)
@@ -1,28 +1,44 @@
 #!/usr/bin/env python
 import argparse
-import ROOT
+import importlib
+import sys
 
 from CombineHarvester.CombineTools.combine.CombineToolBase import CombineToolBase
-from CombineHarvester.CombineTools.combine.EnhancedCombine import EnhancedCombine
-from CombineHarvester.CombineTools.combine.Impacts import Impacts
-from CombineHarvester.CombineTools.combine.ImpactsFromScans import ImpactsFromScans
-from CombineHarvester.CombineTools.combine.Workspace import PrintWorkspace, ModifyDataSet
-from CombineHarvester.CombineTools.combine.CovMatrix import CovMatrix
-from CombineHarvester.CombineTools.combine.LimitGrids import AsymptoticGrid, HybridNewGrid
-from CombineHarvester.CombineTools.combine.Output import PrintFit, CollectLimits, CollectGoodnessOfFit
-from CombineHarvester.CombineTools.combine.T2W import T2W
-from CombineHarvester.CombineTools.combine.FastScan import FastScan
-from CombineHarvester.CombineTools.combine.TaylorExpand import TaylorExpand
-
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gROOT.SetBatch(ROOT.kTRUE)
-
-
-def register_method(parser, method_dict, method_class):
-    class_name = method_class.__name__
-    parser.description += '  %-20s : %s\n' % (
-        class_name, method_class.description)
-    method_dict[class_name] = method_class
+
+# Each method is listed with the module in CombineHarvester.CombineTools.combine
+# that defines it. Only the module of the requested method is imported, so
+# that creating jobs doesn't pay for ROOT and the imports of every other method
+METHODS = [
+    ('EnhancedCombine', 'EnhancedCombine'),
+    ('T2W', 'T2W'),
+    ('PrintWorkspace', 'Workspace'),
+    ('ModifyDataSet', 'Workspace'),
+    ('Impacts', 'Impacts'),
+    ('ImpactsFromScans', 'ImpactsFromScans'),
+    ('CollectLimits', 'Output'),
+    ('CollectGoodnessOfFit', 'Output'),
+    ('CovMatrix', 'CovMatrix'),
+    ('PrintFit', 'Output'),
+    ('AsymptoticGrid', 'LimitGrids'),
+    ('HybridNewGrid', 'LimitGrids'),
+    ('FastScan', 'FastScan'),
+    ('TaylorExpand', 'TaylorExpand'),
+]
+DEFAULT_METHOD = 'EnhancedCombine'
+
+
+def get_method_class(name):
+    module = importlib.import_module(
+        'CombineHarvester.CombineTools.combine.' + dict(METHODS)[name])
+    return getattr(module, name)
+
+
+def setup_root():
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    ROOT.gROOT.SetBatch(ROOT.kTRUE)
+    return ROOT
+
 
 parser = argparse.ArgumentParser(
     add_help=False,
@@ -30,21 +46,12 @@ parser = argparse.ArgumentParser(
 )
 
 parser.description = 'Available methods:\n\n'
-methods = {}
-register_method(parser, methods, EnhancedCombine)
-register_method(parser, methods, T2W)
-register_method(parser, methods, PrintWorkspace)
-register_method(parser, methods, ModifyDataSet)
-register_method(parser, methods, Impacts)
-register_method(parser, methods, ImpactsFromScans)
-register_method(parser, methods, CollectLimits)
-register_method(parser, methods, CollectGoodnessOfFit)
-register_method(parser, methods, CovMatrix)
-register_method(parser, methods, PrintFit)
-register_method(parser, methods, AsymptoticGrid)
-register_method(parser, methods, HybridNewGrid)
-register_method(parser, methods, FastScan)
-register_method(parser, methods, TaylorExpand)
+# The descriptions are only needed for the help message, and getting them
+# means importing every method
+if '-h' in sys.argv or '--help' in sys.argv:
+    for name, module in METHODS:
+        parser.description += '  %-20s : %s\n' % (
+            name, get_method_class(name).description)
 
 parser.add_argument('-M', '--method')
 
@@ -52,12 +59,17 @@ parser.add_argument('-M', '--method')
 
 # DRY_RUN = args.dry_run
 
-method = methods[
-    args.method]() if args.method in methods else EnhancedCombine()
+method_class = get_method_class(
+    args.method if args.method in dict(METHODS) else DEFAULT_METHOD)
+method = method_class()
 
 # Loading libs is slow: only do it if the method has requested it
-if method.__class__.requires_root:
+if method_class.requires_root:
+    ROOT = setup_root()
     ROOT.gSystem.Load('libHiggsAnalysisCombinedLimit')
+elif 'ROOT' in sys.modules:
+    # One of the imports needed ROOT anyway
+    setup_root()
 
 job_group = parser.add_argument_group(
     'job options', 'options for creating, running and submitting jobs')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Runs a json job graph built up with combineTool.py --job-mode local
+# --local-dag, using all the cores of the local machine. Example usage:
+#   combineTool.py -M T2W -i cards/* --job-mode local --local-dag dag.json --task-name t2w
+#   combineTool.py -M Asymptotic -d cards/*/workspace.root --there --job-mode local \
+#       --local-dag dag.json --task-name fits --local-after t2w
+#   runLocalDAG.py dag.json --add collect --after fits -- \
+#       combineTool.py -M CollectLimits cards/*/higgsCombine*.root
+#   runLocalDAG.py dag.json --parallel 32 --timeout 3600 --retries 1
+import argparse
+import pipes
+import sys
+from CombineHarvester.CombineTools.combine.LocalScheduler import LocalScheduler, add_to_dag_file, load_dag_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    'dag', help="""json job graph""")
+parser.add_argument(
+    '--add', metavar='TASK', default=None, help="""Instead of running the
+    graph, add the command given after '--' to it as a job of this task""")
+parser.add_argument(
+    '--after', nargs='+', default=[], help="""Tasks that must finish before
+    the job given with --add starts""")
+parser.add_argument(
+    '--parallel', type=int, default=1, help="""Number of jobs to run in
+    parallel""")
+parser.add_argument(
+    '--timeout', type=float, default=None, help="""Kill a job that runs for
+    longer than this [s]""")
+parser.add_argument(
+    '--memory', type=int, default=None, help="""Limit on the virtual memory
+    of each job [MB], which for combine is usually several GB above the
+    memory actually used""")
+parser.add_argument(
+    '--retries', type=int, default=0, help="""Number of times to rerun a job
+    that fails or times out""")
+parser.add_argument(
+    '--log-dir', default='dag_logs', help="""Directory for the job logs""")
+parser.add_argument(
+    '--pre-cmd', default='', help="""Prefix the call to combine with this
+    string""")
+parser.add_argument(
+    '--dry-run', action='store_true', help="""Print the commands in the order
+    they could run but do not run them""")
+
+# Everything after a '--' is the command for --add
+argv = sys.argv[1:]
+command = []
+if '--' in argv:
+    command = argv[argv.index('--') + 1:]
+    argv = argv[:argv.index('--')]
+args = parser.parse_args(argv)
+
+if args.add is not None:
+    command = ' '.join([pipes.quote(x) for x in command])
+    if not command:
+        sys.exit('>> No command given after --')
+    add_to_dag_file(args.dag, args.add, [command], after_tasks=args.after)
+    print '>> Added a job for task %s to %s' % (args.add, args.dag)
+    sys.exit(0)
+
+scheduler = LocalScheduler(
+    parallel=args.parallel, timeout=args.timeout, memory=args.memory,
+    retries=args.retries, log_dir=args.log_dir, pre_cmd=args.pre_cmd,
+    dry_run=args.dry_run)
+load_dag_file(args.dag, scheduler)
+failed = scheduler.run()
+if failed:
+    print '>> %i of %i jobs did not succeed:' % (len(failed), len(scheduler.jobs))
+    for job in failed:
+        print '  %-30s %-8s %s' % (job.name, job.status, job.log if job.log is not None else '')
+    sys.exit(1)
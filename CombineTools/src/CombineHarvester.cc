@@ -13,6 +13,8 @@
 
 namespace ch {
 
+unsigned long CombineHarvester::object_edits_ = 0;
+
 CombineHarvester::CombineHarvester() : verbosity_(0), log_(&(std::cout)) {
   // if (verbosity_ >= 3) {
     // log() << "[CombineHarvester] Constructor called: " << this << "\n";
@@ -24,6 +26,8 @@ CombineHarvester::CombineHarvester() : verbosity_(0), log_(&(std::cout)) {
   flags_["workspace-uuid-recycle"] = true;
   flags_["import-parameter-err"] = true;
   flags_["filters-use-regex"] = false;
+  flags_["uncertainties-use-linear"] = false;
+  flags_["shapes-prefetch"] = false;
   // std::cout << "[CombineHarvester] Constructor called for " << this << "\n";
 }
 
@@ -45,6 +49,8 @@ void swap(CombineHarvester& first, CombineHarvester& second) {
   swap(first.post_lines_, second.post_lines_);
   swap(first.log_, second.log_);
   swap(first.auto_stats_settings_, second.auto_stats_settings_);
+  swap(first.index_, second.index_);
+  swap(first.proc_syst_cache_, second.proc_syst_cache_);
 }
 
 CombineHarvester::CombineHarvester(CombineHarvester const& other)
@@ -56,8 +62,10 @@ CombineHarvester::CombineHarvester(CombineHarvester const& other)
       flags_(other.flags_),
       auto_stats_settings_(other.auto_stats_settings_),
       post_lines_(other.post_lines_),
+      index_(other.index_),
       verbosity_(other.verbosity_),
-      log_(other.log_) {
+      log_(other.log_),
+      proc_syst_cache_(other.proc_syst_cache_) {
   // std::cout << "[CombineHarvester] Copy-constructor called " << &other
   //     << " -> " << this << "\n";
 }
@@ -155,7 +163,7 @@ CombineHarvester CombineHarvester::deep() {
 
   for (std::size_t i = 0; i < cpy.obs_.size(); ++i) {
     if (obs_[i]) {
-      cpy.obs_[i] = std::make_shared<Observation>(*(obs_[i]));
+      cpy.obs_.set(i, std::make_shared<Observation>(*(obs_[i])));
       if (obs_[i]->data())
         cpy.obs_[i]->set_data(dat_map.at(obs_[i]->data()));
     }
@@ -163,7 +171,7 @@ CombineHarvester CombineHarvester::deep() {
 
   for (std::size_t i = 0; i < cpy.procs_.size(); ++i) {
     if (procs_[i]) {
-      cpy.procs_[i] = std::make_shared<Process>(*(procs_[i]));
+      cpy.procs_.set(i, std::make_shared<Process>(*(procs_[i])));
       if (procs_[i]->pdf())
         cpy.procs_[i]->set_pdf(pdf_map.at(procs_[i]->pdf()));
       if (procs_[i]->observable())
@@ -177,7 +185,7 @@ CombineHarvester CombineHarvester::deep() {
 
   for (std::size_t i = 0; i < cpy.systs_.size(); ++i) {
     if (systs_[i]) {
-      cpy.systs_[i] = std::make_shared<Systematic>(*(systs_[i]));
+      cpy.systs_.set(i, std::make_shared<Systematic>(*(systs_[i])));
       if (systs_[i]->data_u() || systs_[i]->data_d()) {
         cpy.systs_[i]->set_data(
             static_cast<RooDataHist*>(dat_map.at(systs_[i]->data_u())),
@@ -38,7 +38,7 @@ void CombineHarvester::AddObservations(
     obs->set_channel(channel[c[3]]);
     obs->set_bin_id(bin[c[4]].first);
     obs->set_bin(bin[c[4]].second);
-    obs_.push_back(obs);
+    AppendIndexed(obs_, &FilterIndex::obs, obs);
   }
 }
 
@@ -68,7 +68,7 @@ void CombineHarvester::AddProcesses(
       proc->set_bin(bin[c[4]].second);
       proc->set_process(procs[i]);
       proc->set_signal(signal);
-      procs_.push_back(proc);
+      AppendIndexed(procs_, &FilterIndex::procs, proc);
     }
   }
 }
@@ -131,7 +131,53 @@ void CombineHarvester::AddSystFromProc(Process const& proc,
     params_.at(sys->name())->set_err_d(0.);
     params_.at(sys->name())->set_err_u(0.);
   }
-  systs_.push_back(sys);
+  AppendIndexed(systs_, &FilterIndex::systs, sys);
+}
+
+unsigned CombineHarvester::AddSystBulk(CombineHarvester& target,
+                                       std::vector<std::string> const& bin,
+                                       std::vector<std::string> const& process,
+                                       std::vector<std::string> const& name,
+                                       std::vector<std::string> const& type,
+                                       std::vector<double> const& val_d,
+                                       std::vector<double> const& val_u) {
+  unsigned nrows = name.size();
+  if (bin.size() != nrows || process.size() != nrows ||
+      type.size() != nrows || val_d.size() != nrows ||
+      val_u.size() != nrows) {
+    throw std::runtime_error(
+        FNERROR("All input columns must have the same length"));
+  }
+  // Group the processes by (bin, process) once, so that each row is a
+  // single lookup rather than a loop over all processes
+  std::map<std::pair<std::string, std::string>, std::vector<Process const*>>
+      lookup;
+  for (auto const& proc : procs_) {
+    lookup[std::make_pair(proc->bin(), proc->process())].push_back(proc.get());
+  }
+  unsigned n_added = 0;
+  std::vector<unsigned> not_used;
+  for (unsigned i = 0; i < nrows; ++i) {
+    auto it = lookup.find(std::make_pair(bin[i], process[i]));
+    if (it == lookup.end()) {
+      not_used.push_back(i);
+      continue;
+    }
+    bool asymm = (type[i] == "lnN" || type[i] == "lnU") && val_d[i] != 0.;
+    for (Process const* proc : it->second) {
+      target.AddSystFromProc(*proc, name[i], type[i], asymm, val_u[i],
+                             val_d[i], "", "");
+      ++n_added;
+    }
+  }
+  if (not_used.size() && verbosity_ >= 1) {
+    log() << ">> Rows that did not match any Process:\n";
+    for (unsigned i : not_used) {
+      log() << bin[i] << " " << process[i] << " " << name[i] << " "
+            << type[i] << "\n";
+    }
+  }
+  return n_added;
 }
 
 void CombineHarvester::RenameSystematic(CombineHarvester &target, std::string const& old_name,
@@ -142,6 +188,10 @@ void CombineHarvester::RenameSystematic(CombineHarvester &target, std::string co
       target.CreateParameterIfEmpty(systs_[i]->name());
     }
   }
+  // The renamed objects may be shared with other instances and their
+  // evaluation caches. Any filter index is already marked as out of date by
+  // set_name.
+  ++object_edits_;
 }
 
 void CombineHarvester::ExtractShapes(std::string const& file,
@@ -243,14 +293,17 @@ void CombineHarvester::MergeBinErrors(double bbb_threshold,
 }
 
 void CombineHarvester::InsertObservation(ch::Observation const& obs) {
-  obs_.push_back(std::make_shared<ch::Observation>(obs));
+  AppendIndexed(obs_, &FilterIndex::obs,
+                std::make_shared<ch::Observation>(obs));
 }
 
 void CombineHarvester::InsertProcess(ch::Process const& proc) {
-  procs_.push_back(std::make_shared<ch::Process>(proc));
+  AppendIndexed(procs_, &FilterIndex::procs,
+                std::make_shared<ch::Process>(proc));
 }
 
 void CombineHarvester::InsertSystematic(ch::Systematic const& sys) {
-  systs_.push_back(std::make_shared<ch::Systematic>(sys));
+  AppendIndexed(systs_, &FilterIndex::systs,
+                std::make_shared<ch::Systematic>(sys));
 }
 }
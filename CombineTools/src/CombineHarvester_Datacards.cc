@@ -8,6 +8,14 @@
 #include <set>
 #include <fstream>
 #include <sstream>
+#include <algorithm>
+#include <clocale>
+#include <cstdio>
+#include <exception>
+#include <functional>
+#include <thread>
+#include <tuple>
+#include <unordered_map>
 #include "boost/lexical_cast.hpp"
 #include "boost/algorithm/string.hpp"
 #include "boost/format.hpp"
@@ -29,6 +37,45 @@
 
 namespace ch {
 
+namespace {
+// Appends val to out, padded with spaces to at least width characters
+void AppendPadded(std::string* out, std::string const& val, unsigned width) {
+  out->append(val);
+  if (val.size() < width) out->append(width - val.size(), ' ');
+}
+
+// Appends a single number formatted with a printf-style format. This is much
+// cheaper than boost::format for the many cells of a large datacard. The
+// decimal separator is always written as '.', whatever the C locale is.
+void AppendFormatted(std::string* out, char const* fmt, double val) {
+  char buf[64];
+  int n = std::snprintf(buf, sizeof(buf), fmt, val);
+  if (n < 0) return;
+  std::size_t start = out->size();
+  if (unsigned(n) < sizeof(buf)) {
+    out->append(buf, n);
+  } else {
+    out->resize(start + n + 1);
+    std::snprintf(&(*out)[start], n + 1, fmt, val);
+    out->resize(start + n);
+  }
+  char point = std::localeconv()->decimal_point[0];
+  if (point != '.') std::replace(out->begin() + start, out->end(), point, '.');
+}
+
+// Returns the name of the process in column p of the two "process" lines
+// above the "rate" line r, where the other of the two gives the process ids
+std::string ProcessInColumn(std::vector<std::vector<std::string>> const& words,
+                            unsigned r, unsigned p) {
+  try {
+    boost::lexical_cast<int>(words[r-2][p]);
+    return words[r-1][p];
+  } catch(boost::bad_lexical_cast &) {
+    return words[r-2][p];
+  }
+}
+}
+
 // Extract info from filename using parse rule like:
 // ".*{MASS}/{ANALYSIS}_{CHANNEL}_{BINID}_{ERA}.txt"
 int CombineHarvester::ParseDatacard(std::string const& filename,
@@ -58,6 +105,7 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
     int bin_id,
     std::string const& mass) {
   TH1::AddDirectory(kFALSE);
+  index_.reset();
   // Load the entire datacard into memory as a vector of strings
   std::vector<std::string> lines = ch::ParseFileLines(filename);
   // Loop through lines, trimming whitespace at the beginning or end
@@ -114,7 +162,7 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
         dc_path = words[i][3];
       }
       if (!file_store.count(dc_path))
-        file_store[dc_path] = std::make_shared<TFile>(dc_path.c_str());
+        file_store[dc_path] = ch::GetCachedTFile(dc_path);
       mapping.file = file_store.at(dc_path);
       mapping.pattern = words[i][4];
       if (words[i].size() > 5) mapping.syst_pattern = words[i][5];
@@ -161,6 +209,8 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
     }
   }
 
+  if (flags_.at("shapes-prefetch")) PrefetchShapes(words, mass, hist_mapping);
+
   for (unsigned i = 0; i < words.size(); ++i) {
     if (words[i].size() >= 3 &&
         boost::iequals(words[i][1], "extArg")) {
@@ -522,6 +572,107 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
   return 0;
 }
 
+void CombineHarvester::PrefetchShapes(
+    std::vector<std::vector<std::string>> const& words,
+    std::string const& mass, std::vector<HistMapping> const& mappings) {
+  // Find the (bin, process, systematic) combinations that LoadShapes will
+  // ask for, in the same order, by scanning the card in the same way as
+  // ParseDatacard. An empty systematic means the nominal shape
+  std::vector<std::tuple<std::string, std::string, std::string>> entries;
+  std::set<std::string> bins;
+  bool single_obs = false;
+  int r = -1;
+  for (unsigned i = 0; i < words.size(); ++i) {
+    if (words[i].size() <= 1) continue;
+    if (boost::iequals(words[i][0], "observation")) {
+      if (i >= 1 && boost::iequals(words[i-1][0], "bin") &&
+          words[i].size() == words[i-1].size()) {
+        for (unsigned p = 1; p < words[i].size(); ++p) {
+          entries.emplace_back(words[i-1][p], "data_obs", "");
+        }
+      } else if (words[i].size() == 2) {
+        single_obs = true;
+      }
+    }
+    if (i >= 3 && boost::iequals(words[i][0], "rate") &&
+        boost::iequals(words[i-1][0], "process") &&
+        boost::iequals(words[i-2][0], "process") &&
+        boost::iequals(words[i-3][0], "bin") &&
+        words[i].size() == words[i-1].size() &&
+        words[i].size() == words[i-2].size() &&
+        words[i].size() == words[i-3].size()) {
+      r = i;
+      for (unsigned p = 1; p < words[i].size(); ++p) {
+        bins.insert(words[i-3][p]);
+        entries.emplace_back(words[i-3][p], ProcessInColumn(words, r, p), "");
+      }
+      continue;
+    }
+    if (r >= 0 && words[i].size() - 1 == words[r].size() &&
+        contains(std::vector<std::string>{"shape", "shape?", "shapeN2",
+                                          "shapeU"},
+                 words[i][1])) {
+      for (unsigned p = 2; p < words[i].size(); ++p) {
+        if (words[i][p] == "-") continue;
+        entries.emplace_back(words[r-3][p-1], ProcessInColumn(words, r, p-1),
+                             words[i][0]);
+      }
+    }
+  }
+  if (single_obs && bins.size() == 1) {
+    entries.emplace_back(*(bins.begin()), "data_obs", "");
+  }
+
+  // Resolve each one to the TH1 objects it needs. Combinations without a
+  // mapping are skipped here and reported by LoadShapes
+  std::vector<std::pair<std::string, std::string>> objects;
+  auto add_object = [&](HistMapping const& mapping, std::string path,
+                        std::string const& bin, std::string const& process,
+                        std::string const& syst) {
+    boost::replace_all(path, "$CHANNEL", bin);
+    boost::replace_all(path, "$BIN", bin);
+    boost::replace_all(path, "$PROCESS", process);
+    boost::replace_all(path, "$MASS", mass);
+    boost::replace_all(path, "$SYSTEMATIC", syst);
+    objects.emplace_back(mapping.file->GetName(), path);
+  };
+  for (auto const& entry : entries) {
+    std::string const& bin = std::get<0>(entry);
+    std::string const& process = std::get<1>(entry);
+    std::string const& syst = std::get<2>(entry);
+    HistMapping const* mapping = nullptr;
+    for (auto const& attempt : GenerateShapeMapAttempts(process, bin)) {
+      for (auto const& m : mappings) {
+        if (attempt.first == m.process && attempt.second == m.category) {
+          mapping = &m;
+          break;
+        }
+      }
+      if (mapping) break;
+    }
+    if (!mapping || mapping->is_fake || !mapping->IsHist() ||
+        !mapping->file || !mapping->file->IsOpen()) {
+      continue;
+    }
+    if (syst == "") {
+      add_object(*mapping, mapping->pattern, bin, process, "");
+    } else {
+      add_object(*mapping, mapping->syst_pattern, bin, process, syst + "Up");
+      add_object(*mapping, mapping->syst_pattern, bin, process, syst + "Down");
+    }
+  }
+
+  bool hit_limit = false;
+  unsigned n_read = ch::PrefetchTH1s(objects, 0, &hit_limit);
+  FNLOGC(log(), verbosity_ >= 1) << "Prefetched " << n_read << " of "
+                                 << objects.size() << " histograms\n";
+  if (hit_limit) {
+    FNLOG(log()) << "The histograms of this card do not fit in the TH1 "
+                    "cache, only the first " << n_read << " were prefetched. "
+                    "The limit can be raised with ch::SetTFileCacheLimits\n";
+  }
+}
+
 void CombineHarvester::WriteDatacard(std::string const& name,
                                      std::string const& root_file) {
   TFile file(root_file.c_str(), "RECREATE");
@@ -631,7 +782,7 @@ void CombineHarvester::FillHistMappings(std::vector<HistMapping> & mappings) {
     bool prototype_ok = false;
     HistMapping prototype;
     std::vector<HistMapping> full_list;
-    auto pmap = ch_bin.GenerateProcSystMap();
+    auto const& pmap = ch_bin.GenerateProcSystMap();
     for (unsigned i = 0; i < ch_bin.procs_.size(); ++i) {
       ch::Process * proc = ch_bin.procs_[i].get();
       if (!proc->data() && !proc->pdf()) continue;
@@ -706,18 +857,18 @@ void CombineHarvester::WriteDatacard(std::string const& name,
 
   // First figure out if this is a counting-experiment only
   bool is_counting = true;
-  this->ForEachObs([&](ch::Observation *obs) {
+  for (auto const& obs : obs_) {
     if (obs->shape() != nullptr || obs->data() != nullptr) {
       is_counting = false;
     }
-  });
+  }
   if (is_counting) {
-    this->ForEachProc([&](ch::Process *proc) {
+    for (auto const& proc : procs_) {
       if (proc->shape() != nullptr || proc->data() != nullptr ||
           proc->pdf() != nullptr) {
         is_counting = false;
       }
-    });
+    }
   }
 
   // Allow a non-open ROOT file if this is purely a counting experiment
@@ -736,17 +887,21 @@ void CombineHarvester::WriteDatacard(std::string const& name,
 
   std::string dashes(80, '-');
 
-  auto bin_set = this->SetFromProcs(std::mem_fn(&ch::Process::bin));
-  auto proc_set = this->SetFromProcs(std::mem_fn(&ch::Process::process));
+  std::set<std::string> bin_set;
+  std::set<std::string> proc_set;
+  for (auto const& proc : procs_) {
+    bin_set.insert(proc->bin());
+    proc_set.insert(proc->process());
+  }
   std::set<std::string> sys_set;
   std::set<std::string> rateparam_set;
-  this->ForEachSyst([&](ch::Systematic const* sys) {
+  for (auto const& sys : systs_) {
     if (sys->type() == "rateParam") {
       rateparam_set.insert(sys->name());
     } else {
       sys_set.insert(sys->name());
     }
-  });
+  }
   txt_file << "imax    " << bin_set.size()
             << " number of bins\n";
   txt_file << "jmax    " << proc_set.size() - 1
@@ -760,7 +915,7 @@ void CombineHarvester::WriteDatacard(std::string const& name,
 
   auto bins = this->SetFromObs(std::mem_fn(&ch::Observation::bin));
 
-  auto proc_sys_map = this->GenerateProcSystMap();
+  auto const& proc_sys_map = this->GenerateProcSystMap();
 
   std::set<std::string> all_dependents_pars;
   std::set<std::string> multipdf_cats;
@@ -854,46 +1009,43 @@ void CombineHarvester::WriteDatacard(std::string const& name,
   }
   txt_file << dashes << "\n";
 
+  // The ROOT objects are written by this thread while a second thread
+  // formats and streams the bulk of the text datacard. To make this safe only
+  // this thread touches ROOT, and the text thread only reads plain values
+  // from the Observation, Process, Systematic and Parameter objects.
+  std::vector<std::function<void()>> root_jobs;
+
   if (!is_counting) {
     for (auto ws_it : wspaces_) {
       if (ws_it.first == "_rateParams") continue; // don't write this one
       // Also skip any workspace that isn't needed for this card
       if (!used_wsps.count(ws_it.second->GetName())) continue;
-      ch::WriteToTFile(ws_it.second.get(), &root_file, ws_it.second->GetName());
+      RooWorkspace *ws = ws_it.second.get();
+      root_jobs.push_back([ws, &root_file]() {
+        ch::WriteToTFile(ws, &root_file, ws->GetName());
+      });
     }
   }
 
-  // Writing observations
-  if (obs_.size() > 0) {
-    txt_file << "bin          ";
-    for (auto const& obs : obs_) {
-      txt_file << format("%-15s ") % obs->bin();
-      if (obs->shape()) {
-        bool add_dir = TH1::AddDirectoryStatus();
-        TH1::AddDirectory(false);
-        std::unique_ptr<TH1> h((TH1*)(obs->shape()->Clone()));
-        h->Scale(obs->rate());
-        WriteHistToFile(h.get(), &root_file, mappings, obs->bin(), "data_obs",
-                        obs->mass(), "", 0);
-        TH1::AddDirectory(add_dir);
-      }
-    }
-    txt_file << "\n";
-    txt_file << "observation  ";
-    // On the precision of the observation yields: .1f is not sufficient for
-    // combine to be happy if we have some asimov dataset with non-integer values.
-    // We could just always give .4f but this doesn't look nice for the majority
-    // of cards that have real data. Instead we'll check...
-    std::string obs_fmt_int = "%-15.1f ";
-    std::string obs_fmt_flt = "%-15.4f ";
-    for (auto const& obs : obs_) {
-      bool is_float =
-          std::fabs(obs->rate() - std::round(obs->rate())) > 1E-4;
-      txt_file << format(is_float ? obs_fmt_flt : obs_fmt_int)
-          % obs->rate();
-    }
-    txt_file << "\n";
-    txt_file << dashes << "\n";
+  for (auto const& obs : obs_) {
+    if (!obs->shape()) continue;
+    ch::Observation const* ptr = obs.get();
+    root_jobs.push_back([this, ptr, &root_file, &mappings]() {
+      std::unique_ptr<TH1> h((TH1*)(ptr->shape()->Clone()));
+      h->Scale(ptr->rate());
+      WriteHistToFile(h.get(), &root_file, mappings, ptr->bin(), "data_obs",
+                      ptr->mass(), "", 0);
+    });
+  }
+
+  for (auto const& proc : procs_) {
+    if (!proc->shape()) continue;
+    ch::Process const* ptr = proc.get();
+    root_jobs.push_back([this, ptr, &root_file, &mappings]() {
+      std::unique_ptr<TH1> h = ptr->ClonedScaledShape();
+      WriteHistToFile(h.get(), &root_file, mappings, ptr->bin(),
+                      ptr->process(), ptr->mass(), "", 0);
+    });
   }
 
   unsigned sys_str_len = 14;
@@ -904,30 +1056,6 @@ void CombineHarvester::WriteDatacard(std::string const& name,
     if (sys.length() > sys_str_len) sys_str_len = sys.length();
   }
   std::string sys_str_short = boost::lexical_cast<std::string>(sys_str_len);
-  std::string sys_str_long = boost::lexical_cast<std::string>(sys_str_len+9);
-
-  txt_file << format("%-"+sys_str_long+"s") % "bin";
-  for (auto const& proc : procs_) {
-    if (proc->shape()) {
-      bool add_dir = TH1::AddDirectoryStatus();
-      TH1::AddDirectory(false);
-      std::unique_ptr<TH1> h = proc->ClonedScaledShape();
-      WriteHistToFile(h.get(), &root_file, mappings, proc->bin(),
-                      proc->process(), proc->mass(), "", 0);
-      TH1::AddDirectory(add_dir);
-    }
-    txt_file << format("%-15s ") % proc->bin();
-  }
-  txt_file << "\n";
-
-  txt_file << format("%-"+sys_str_long+"s") % "process";
-
-  for (auto const& proc : procs_) {
-    txt_file << format("%-15s ") % proc->process();
-  }
-  txt_file << "\n";
-
-  txt_file << format("%-"+sys_str_long+"s") % "process";
 
   // Setup process_ids first
   std::map<std::string, int> p_ids;
@@ -956,111 +1084,211 @@ void CombineHarvester::WriteDatacard(std::string const& name,
       }
     }
   }
-  for (auto const& proc : procs_) {
-    txt_file << format("%-15s ") % p_ids[proc->process()];
-  }
-  txt_file << "\n";
-
-
-  txt_file << format("%-"+sys_str_long+"s") % "rate";
-  for (auto const& proc : procs_) {
-    txt_file << format("%-15.6g ") % proc->no_norm_rate();
-  }
-  txt_file << "\n";
-  txt_file << dashes << "\n";
 
-  // Need to write parameters here that feature both in the list of pdf
-  // dependents and sys_set.
-  for (auto par : params_) {
-    Parameter const* p = par.second.get();
-    if (p->err_d() != 0.0 && p->err_u() != 0.0 &&
-        all_dependents_pars.count(p->name()) && sys_set.count(p->name())) {
-      txt_file << format((format("%%-%is param %%g %%g") % sys_str_len).str()) %
-                      p->name() % p->val() % ((p->err_u() - p->err_d()) / 2.0);
-      if (p->range_d() != std::numeric_limits<double>::lowest() &&
-          p->range_u() != std::numeric_limits<double>::max()) {
-        txt_file << format(" [%.4g,%.4g]") % p->range_d() % p->range_u();
-      }
-      txt_file << "\n";
-    }
-  }
-
-  for (auto const& sys : sys_set) {
-    std::vector<std::string> line(procs_.size() + 2);
-    line[0] = sys;
-    bool seen_lnN = false;
-    bool seen_lnU = false;
-    bool seen_shape = false;
-    bool seen_shapeN2 = false;
-    bool seen_shapeU = false;
-    for (unsigned p = 0; p < procs_.size(); ++p) {
-      line[p + 2] = "-";
-      for (unsigned n = 0; n < proc_sys_map[p].size(); ++n) {
-        ch::Systematic const* ptr = proc_sys_map[p][n];
-        // Only interested into Systematics with name "sys"
-        if (ptr->name() != sys) continue;
-        std::string tp = ptr->type();
-        if (tp == "lnN" || tp == "lnU") {
-          if (tp == "lnN") seen_lnN = true;
-          if (tp == "lnU") seen_lnU = true;
-          line[p + 2] =
-              ptr->asymm()
-                  ? (format("%g/%g") % ptr->value_d() % ptr->value_u()).str()
-                  : (format("%g") % ptr->value_u()).str();
-          break;
-        }
-        if (tp == "shape" || tp == "shapeN2" || tp == "shapeU") {
-          if (tp == "shape") seen_shape = true;
-          if (tp == "shapeN2") seen_shapeN2 = true;
-          if (tp == "shapeU") seen_shapeU = true;
-          line[p + 2] = (format("%g") % ptr->scale()).str();
-          if (ptr->shape_u() && ptr->shape_d()) {
-            bool add_dir = TH1::AddDirectoryStatus();
-            TH1::AddDirectory(false);
+  // Build the dense (systematic x process) table of entries in a single pass
+  // over the process-systematic map. For each cell we take the entries with
+  // that name in order, stopping at the first lnN/lnU entry or the first
+  // shape entry that has histograms.
+  unsigned n_procs = procs_.size();
+  std::vector<std::string> sys_names(sys_set.begin(), sys_set.end());
+  std::unordered_map<std::string, unsigned> sys_rows;
+  for (unsigned s = 0; s < sys_names.size(); ++s) sys_rows[sys_names[s]] = s;
+  std::vector<ch::Systematic const*> sys_cells(sys_names.size() * n_procs,
+                                               nullptr);
+  std::vector<bool> sys_closed(sys_cells.size(), false);
+  enum SeenType { kLnN = 1, kLnU = 2, kShape = 4, kShapeN2 = 8, kShapeU = 16 };
+  std::vector<unsigned> sys_seen(sys_names.size(), 0);
+  for (unsigned p = 0; p < n_procs; ++p) {
+    for (ch::Systematic const* ptr : proc_sys_map[p]) {
+      auto row_it = sys_rows.find(ptr->name());
+      if (row_it == sys_rows.end()) continue;
+      unsigned row = row_it->second;
+      unsigned cell = row * n_procs + p;
+      if (sys_closed[cell]) continue;
+      std::string const& tp = ptr->type();
+      if (tp == "lnN" || tp == "lnU") {
+        sys_seen[row] |= (tp == "lnN") ? kLnN : kLnU;
+        sys_cells[cell] = ptr;
+        sys_closed[cell] = true;
+      } else if (tp == "shape" || tp == "shapeN2" || tp == "shapeU") {
+        if (tp == "shape") sys_seen[row] |= kShape;
+        if (tp == "shapeN2") sys_seen[row] |= kShapeN2;
+        if (tp == "shapeU") sys_seen[row] |= kShapeU;
+        sys_cells[cell] = ptr;
+        if (ptr->shape_u() && ptr->shape_d()) {
+          sys_closed[cell] = true;
+          ch::Process const* proc = procs_[p].get();
+          root_jobs.push_back([this, ptr, proc, &root_file, &mappings]() {
             std::unique_ptr<TH1> h_d = ptr->ClonedShapeD();
-            h_d->Scale(procs_[p]->rate() * ptr->value_d());
+            h_d->Scale(proc->rate() * ptr->value_d());
             WriteHistToFile(h_d.get(), &root_file, mappings, ptr->bin(),
                             ptr->process(), ptr->mass(), ptr->name(), 1);
             std::unique_ptr<TH1> h_u = ptr->ClonedShapeU();
-            h_u->Scale(procs_[p]->rate() * ptr->value_u());
+            h_u->Scale(proc->rate() * ptr->value_u());
             WriteHistToFile(h_u.get(), &root_file, mappings, ptr->bin(),
                             ptr->process(), ptr->mass(), ptr->name(), 2);
-            TH1::AddDirectory(add_dir);
-            break;
-          } else if (ptr->data_u() && ptr->data_d()) {
-          } else {
-            if (!flags_.at("allow-missing-shapes")) {
-              std::stringstream err;
-              err << "Trying to write shape uncertainty with missing "
-                     "shapes:\n";
-              err << Systematic::PrintHeader << *ptr;
-              throw std::runtime_error(FNERROR(err.str()));
-            }
+          });
+        } else if (ptr->data_u() && ptr->data_d()) {
+        } else {
+          if (!flags_.at("allow-missing-shapes")) {
+            std::stringstream err;
+            err << "Trying to write shape uncertainty with missing "
+                   "shapes:\n";
+            err << Systematic::PrintHeader << *ptr;
+            throw std::runtime_error(FNERROR(err.str()));
           }
         }
       }
     }
-    if (seen_shapeN2) {
-      line[1] = "shapeN2";
-    } else if (seen_shapeU) {
-      line[1] = "shapeU";
-    } else if (seen_lnU) {
-      line[1] = "lnU";
-    } else if (seen_lnN && !seen_shape) {
-      line[1] = "lnN";
-    } else if (!seen_lnN && seen_shape) {
-      line[1] = "shape";
-    } else if (seen_lnN && seen_shape) {
-      line[1] = "shape?";
+  }
+  std::vector<std::string> sys_types(sys_names.size());
+  for (unsigned s = 0; s < sys_names.size(); ++s) {
+    unsigned seen = sys_seen[s];
+    if (seen & kShapeN2) {
+      sys_types[s] = "shapeN2";
+    } else if (seen & kShapeU) {
+      sys_types[s] = "shapeU";
+    } else if (seen & kLnU) {
+      sys_types[s] = "lnU";
+    } else if ((seen & kLnN) && !(seen & kShape)) {
+      sys_types[s] = "lnN";
+    } else if (!(seen & kLnN) && (seen & kShape)) {
+      sys_types[s] = "shape";
+    } else if ((seen & kLnN) && (seen & kShape)) {
+      sys_types[s] = "shape?";
     } else {
       throw std::runtime_error(FNERROR("Systematic type could not be deduced"));
     }
-    txt_file << format("%-" + sys_str_short + "s %-7s ") % line[0] % line[1];
-    for (unsigned p = 0; p < procs_.size(); ++p) {
-      txt_file << format("%-15s ") % line[p + 2];
+  }
+
+  // Writes the observation, process and systematic blocks. Each line is
+  // built in a reused buffer, with the numbers formatted by
+  // AppendFormatted, and then streamed to the file.
+  auto write_body = [&]() {
+    std::string line;
+    line.reserve(16 * (std::max(n_procs, unsigned(obs_.size())) + 2) +
+                 sys_str_len);
+    auto flush_line = [&]() {
+      line += '\n';
+      txt_file.write(line.data(), line.size());
+      line.clear();
+    };
+    auto add_cell = [&](std::string const& val) {
+      AppendPadded(&line, val, 15);
+      line += ' ';
+    };
+
+    // Writing observations
+    if (obs_.size() > 0) {
+      line += "bin          ";
+      for (auto const& obs : obs_) add_cell(obs->bin());
+      flush_line();
+      line += "observation  ";
+      // On the precision of the observation yields: .1f is not sufficient
+      // for combine to be happy if we have some asimov dataset with
+      // non-integer values. We could just always give .4f but this doesn't
+      // look nice for the majority of cards that have real data. Instead
+      // we'll check...
+      for (auto const& obs : obs_) {
+        bool is_float =
+            std::fabs(obs->rate() - std::round(obs->rate())) > 1E-4;
+        AppendFormatted(&line, is_float ? "%-15.4f " : "%-15.1f ",
+                        obs->rate());
+      }
+      flush_line();
+      line += dashes;
+      flush_line();
     }
-    txt_file << "\n";
+
+    AppendPadded(&line, "bin", sys_str_len + 9);
+    for (auto const& proc : procs_) add_cell(proc->bin());
+    flush_line();
+
+    AppendPadded(&line, "process", sys_str_len + 9);
+    for (auto const& proc : procs_) add_cell(proc->process());
+    flush_line();
+
+    AppendPadded(&line, "process", sys_str_len + 9);
+    for (auto const& proc : procs_) {
+      add_cell(boost::lexical_cast<std::string>(p_ids.at(proc->process())));
+    }
+    flush_line();
+
+    AppendPadded(&line, "rate", sys_str_len + 9);
+    for (auto const& proc : procs_) {
+      AppendFormatted(&line, "%-15.6g ", proc->no_norm_rate());
+    }
+    flush_line();
+    line += dashes;
+    flush_line();
+
+    // Need to write parameters here that feature both in the list of pdf
+    // dependents and sys_set.
+    for (auto par : params_) {
+      Parameter const* p = par.second.get();
+      if (p->err_d() != 0.0 && p->err_u() != 0.0 &&
+          all_dependents_pars.count(p->name()) && sys_set.count(p->name())) {
+        txt_file << format((format("%%-%is param %%g %%g") % sys_str_len).str()) %
+                        p->name() % p->val() % ((p->err_u() - p->err_d()) / 2.0);
+        if (p->range_d() != std::numeric_limits<double>::lowest() &&
+            p->range_u() != std::numeric_limits<double>::max()) {
+          txt_file << format(" [%.4g,%.4g]") % p->range_d() % p->range_u();
+        }
+        txt_file << "\n";
+      }
+    }
+
+    std::string cell;
+    for (unsigned s = 0; s < sys_names.size(); ++s) {
+      AppendPadded(&line, sys_names[s], sys_str_len);
+      line += ' ';
+      AppendPadded(&line, sys_types[s], 7);
+      line += ' ';
+      for (unsigned p = 0; p < n_procs; ++p) {
+        ch::Systematic const* ptr = sys_cells[s * n_procs + p];
+        cell.clear();
+        if (!ptr) {
+          cell = "-";
+        } else if (ptr->type() == "lnN" || ptr->type() == "lnU") {
+          if (ptr->asymm()) {
+            AppendFormatted(&cell, "%g", ptr->value_d());
+            cell += '/';
+          }
+          AppendFormatted(&cell, "%g", ptr->value_u());
+        } else {
+          AppendFormatted(&cell, "%g", ptr->scale());
+        }
+        add_cell(cell);
+      }
+      flush_line();
+    }
+  };
+
+  if (root_jobs.empty()) {
+    write_body();
+  } else {
+    std::exception_ptr body_err;
+    std::thread body_thread([&]() {
+      try {
+        write_body();
+      } catch (...) {
+        body_err = std::current_exception();
+      }
+    });
+    bool add_dir = TH1::AddDirectoryStatus();
+    TH1::AddDirectory(false);
+    try {
+      for (auto const& job : root_jobs) job();
+    } catch (...) {
+      TH1::AddDirectory(add_dir);
+      body_thread.join();
+      throw;
+    }
+    TH1::AddDirectory(add_dir);
+    body_thread.join();
+    if (body_err) std::rethrow_exception(body_err);
   }
+
   // write param line for any parameter which has a non-zero error
   // and which doesn't appear in list of nuisances
   CombineHarvester ch_rp = this->cp().syst_type({"rateParam"});
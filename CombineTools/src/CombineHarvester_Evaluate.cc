@@ -6,6 +6,8 @@
 #include <utility>
 #include <set>
 #include <fstream>
+#include <thread>
+#include <algorithm>
 #include "boost/lexical_cast.hpp"
 #include "boost/algorithm/string.hpp"
 #include "boost/range/algorithm_ext/erase.hpp"
@@ -14,6 +16,7 @@
 #include "TDirectory.h"
 #include "TH1.h"
 #include "TH2.h"
+#include "TMatrixDSym.h"
 #include "CombineHarvester/CombineTools/interface/Observation.h"
 #include "CombineHarvester/CombineTools/interface/Process.h"
 #include "CombineHarvester/CombineTools/interface/Systematic.h"
@@ -29,20 +32,112 @@
 
 namespace ch {
 
-CombineHarvester::ProcSystMap CombineHarvester::GenerateProcSystMap() {
-  ProcSystMap lookup(procs_.size());
+CombineHarvester::ProcSystMap const& CombineHarvester::GenerateProcSystMap() {
+  auto cache = std::make_shared<ProcSystCache>();
+  cache->procs.reserve(procs_.size());
+  cache->systs.reserve(systs_.size());
+  for (auto const& proc : procs_) cache->procs.push_back(proc.get());
+  for (auto const& sys : systs_) cache->systs.push_back(sys.get());
+  cache->edits = object_edits_;
+  if (proc_syst_cache_ && proc_syst_cache_->edits == cache->edits &&
+      proc_syst_cache_->procs == cache->procs &&
+      proc_syst_cache_->systs == cache->systs) {
+    return proc_syst_cache_->lookup;
+  }
+  // Hash join of the systematics onto the processes, using a key built from
+  // every property that ch::MatchingProcess compares
+  std::unordered_map<std::string, std::vector<unsigned>> proc_keys;
+  for (unsigned j = 0; j < procs_.size(); ++j) {
+    proc_keys[ch::MatchingProcessKey(*(procs_[j]))].push_back(j);
+  }
+  cache->lookup.resize(procs_.size());
   for (unsigned i = 0; i < systs_.size(); ++i) {
-    for (unsigned j = 0; j < procs_.size(); ++j) {
-      if (MatchingProcess(*(systs_[i]), *(procs_[j]))) {
-        lookup[j].push_back(systs_[i].get());
+    auto it = proc_keys.find(ch::MatchingProcessKey(*(systs_[i])));
+    if (it == proc_keys.end()) continue;
+    for (unsigned j : it->second) {
+      cache->lookup[j].push_back(systs_[i].get());
+    }
+  }
+  proc_syst_cache_ = cache;
+  return proc_syst_cache_->lookup;
+}
+
+std::vector<ch::Parameter*> CombineHarvester::SampleParameters(
+    RooFitResult const& fit, unsigned n_samples,
+    std::vector<std::vector<double>> & samples) {
+  // Calling randomizePars() ensures that the RooArgList of sampled parameters
+  // is already created within the RooFitResult
+  RooArgList const& rands = fit.randomizePars();
+
+  // Now create two aligned vectors of the RooRealVar parameters and the
+  // corresponding ch::Parameter pointers. Frozen parameters would ignore the
+  // sampled values, so they are left out.
+  std::vector<RooRealVar const*> r_vec;
+  std::vector<ch::Parameter*> p_vec;
+  for (int n = 0; n < rands.getSize(); ++n) {
+    RooRealVar const* var = dynamic_cast<RooRealVar const*>(rands.at(n));
+    ch::Parameter* par = GetParameter(var->GetName());
+    if (!par || par->frozen()) continue;
+    r_vec.push_back(var);
+    p_vec.push_back(par);
+  }
+  samples.assign(n_samples, std::vector<double>(p_vec.size(), 0.));
+  for (unsigned i = 0; i < n_samples; ++i) {
+    fit.randomizePars();
+    for (unsigned n = 0; n < r_vec.size(); ++n) {
+      samples[i][n] = r_vec[n]->getVal();
+    }
+  }
+  return p_vec;
+}
+
+CombineHarvester::RateTermMap CombineHarvester::BuildRateTerms(
+    ProcSystMap const& lookup, std::vector<ch::Parameter*> const& sampled) {
+  std::map<std::string, int> slots;
+  for (unsigned n = 0; n < sampled.size(); ++n) {
+    slots[sampled[n]->name()] = n;
+  }
+  RateTermMap terms(lookup.size());
+  for (unsigned i = 0; i < lookup.size(); ++i) {
+    for (auto sys_it : lookup[i]) {
+      if (sys_it->type() == "rateParam") {
+        continue;  // don't evaluate this for now
+      }
+      auto param_it = params_.find(sys_it->name());
+      if (param_it == params_.end()) {
+        throw std::runtime_error(
+            FNERROR("Parameter " + sys_it->name() +
+                    " not found in CombineHarvester instance"));
       }
+      auto slot_it = slots.find(sys_it->name());
+      RateTerm term;
+      term.sys = sys_it;
+      term.slot = slot_it != slots.end() ? slot_it->second : -1;
+      term.x = param_it->second->val();
+      terms[i].push_back(term);
     }
   }
-  return lookup;
+  return terms;
+}
+
+double CombineHarvester::EvalRateTerms(std::vector<RateTerm> const& terms,
+                                       double const* vals) const {
+  double scale = 1.;
+  for (auto const& term : terms) {
+    double x = term.slot >= 0 ? vals[term.slot] : term.x;
+    if (term.sys->asymm()) {
+      scale *= logKappaForX(x * term.sys->scale(), term.sys->value_d(),
+                            term.sys->value_u());
+    } else {
+      scale *= std::pow(term.sys->value_u(), x * term.sys->scale());
+    }
+  }
+  return scale;
 }
 
 double CombineHarvester::GetUncertainty() {
-  auto lookup = GenerateProcSystMap();
+  if (GetFlag("uncertainties-use-linear")) return GetUncertaintyLinear(nullptr);
+  auto const& lookup = GenerateProcSystMap();
   double err_sq = 0.0;
   for (auto param_it : params_) {
     double backup = param_it.second->val();
@@ -64,7 +159,8 @@ double CombineHarvester::GetUncertainty(RooFitResult const* fit,
 
 double CombineHarvester::GetUncertainty(RooFitResult const& fit,
                                         unsigned n_samples) {
-  auto lookup = GenerateProcSystMap();
+  if (GetFlag("uncertainties-use-linear")) return GetUncertaintyLinear(&fit);
+  auto const& lookup = GenerateProcSystMap();
   double rate = GetRateInternal(lookup);
   double err_sq = 0.0;
 
@@ -101,7 +197,10 @@ double CombineHarvester::GetUncertainty(RooFitResult const& fit,
 }
 
 TH1F CombineHarvester::GetShapeWithUncertainty() {
-  auto lookup = GenerateProcSystMap();
+  if (GetFlag("uncertainties-use-linear")) {
+    return GetShapeWithUncertaintyLinear(nullptr);
+  }
+  auto const& lookup = GenerateProcSystMap();
   TH1F shape = GetShape();
   for (int i = 1; i <= shape.GetNbinsX(); ++i) {
     shape.SetBinError(i, 0.0);
@@ -132,7 +231,10 @@ TH1F CombineHarvester::GetShapeWithUncertainty(RooFitResult const* fit,
 
 TH1F CombineHarvester::GetShapeWithUncertainty(RooFitResult const& fit,
                                                unsigned n_samples) {
-  auto lookup = GenerateProcSystMap();
+  if (GetFlag("uncertainties-use-linear")) {
+    return GetShapeWithUncertaintyLinear(&fit);
+  }
+  auto const& lookup = GenerateProcSystMap();
   TH1F shape = GetShapeInternal(lookup);
   for (int i = 1; i <= shape.GetNbinsX(); ++i) {
     shape.SetBinError(i, 0.0);
@@ -176,76 +278,182 @@ TH1F CombineHarvester::GetShapeWithUncertainty(RooFitResult const& fit,
   return shape;
 }
 
+std::vector<TH1F> CombineHarvester::GetShapesWithUncertainty(
+    std::vector<std::string> const& bins,
+    std::vector<std::vector<std::string>> const& processes,
+    RooFitResult const& fit, unsigned n_samples) {
+  if (bins.size() != processes.size()) {
+    throw std::runtime_error(
+        FNERROR("The bins and processes vectors must have the same length"));
+  }
+  unsigned n_sel = bins.size();
+  std::vector<CombineHarvester> sel;
+  std::vector<ProcSystMap const*> lookups(n_sel);
+  std::vector<TH1F> shapes(n_sel);
+  for (unsigned s = 0; s < n_sel; ++s) {
+    sel.push_back(this->cp());
+    if (bins[s] != "") sel[s].bin({bins[s]});
+    if (processes[s].size()) sel[s].process(processes[s]);
+  }
+  if (GetFlag("uncertainties-use-linear")) {
+    for (unsigned s = 0; s < n_sel; ++s) {
+      shapes[s] = sel[s].GetShapeWithUncertaintyLinear(&fit);
+    }
+    return shapes;
+  }
+  for (unsigned s = 0; s < n_sel; ++s) {
+    lookups[s] = &(sel[s].GenerateProcSystMap());
+    shapes[s] = sel[s].GetShapeInternal(*(lookups[s]));
+    for (int i = 1; i <= shapes[s].GetNbinsX(); ++i) {
+      shapes[s].SetBinError(i, 0.0);
+    }
+  }
+
+  // Create a backup copy of the current parameter values
+  auto backup = GetParameters();
+
+  // The parameters are shared by the shallow copies, so each sampled vector
+  // only has to be set once for all of the selections
+  std::vector<std::vector<double>> samples;
+  std::vector<ch::Parameter*> sampled =
+      SampleParameters(fit, n_samples, samples);
+
+  // Main loop through n_samples
+  for (unsigned rnd = 0; rnd < n_samples; ++rnd) {
+    for (unsigned k = 0; k < sampled.size(); ++k) {
+      sampled[k]->set_val(samples[rnd][k]);
+    }
+    for (unsigned s = 0; s < n_sel; ++s) {
+      TH1F rand_shape = sel[s].GetShapeInternal(*(lookups[s]));
+      for (int i = 1; i <= shapes[s].GetNbinsX(); ++i) {
+        double err = std::fabs(rand_shape.GetBinContent(i) -
+                               shapes[s].GetBinContent(i));
+        shapes[s].SetBinError(i, err*err + shapes[s].GetBinError(i));
+      }
+    }
+  }
+  for (unsigned s = 0; s < n_sel; ++s) {
+    for (int i = 1; i <= shapes[s].GetNbinsX(); ++i) {
+      shapes[s].SetBinError(
+          i, std::sqrt(shapes[s].GetBinError(i) / double(n_samples)));
+    }
+  }
+  this->UpdateParameters(backup);
+  return shapes;
+}
+
 TH2F CombineHarvester::GetRateCovariance(RooFitResult const& fit,
                                          unsigned n_samples) {
-  auto lookup = GenerateProcSystMap();
+  auto cov = GetRateCovarianceMatrix(fit, n_samples);
 
   unsigned n = procs_.size();
-  TH1F nom("nominal", "nominal", n, 0, n);
   TH2F res("covariance", "covariance", n, 0, n, n, 0, n);
 
-  std::vector<CombineHarvester> ch_procs;
-  std::vector<std::string> labels;
   unsigned nbins = this->bin_set().size();
-
-  for (unsigned i = 0; i < procs_.size(); ++i) {
-    ch_procs.push_back(
-        this->cp().bin({procs_[i]->bin()}).process({procs_[i]->process()}));
-    if (nbins > 1) {
-      labels.push_back(procs_[i]->bin() + "," + procs_[i]->process());
-    } else {
-      labels.push_back(procs_[i]->process());
+  for (unsigned i = 0; i < n; ++i) {
+    std::string label = procs_[i]->process();
+    if (nbins > 1) label = procs_[i]->bin() + "," + label;
+    res.GetXaxis()->SetBinLabel(i + 1, label.c_str());
+    res.GetYaxis()->SetBinLabel(n - i, label.c_str());
+  }
+  for (unsigned i = 0; i < n; ++i) {
+    for (unsigned j = 0; j < n; ++j) {
+      res.SetBinContent(j + 1, n - i, cov[i][j]);
     }
   }
-  for (unsigned i = 0; i < procs_.size(); ++i) {
-    nom.SetBinContent(i + 1, ch_procs[i].GetRate());
+  return res;
+}
+
+std::vector<std::vector<double>> CombineHarvester::GetRateCovarianceMatrix(
+    RooFitResult const& fit, unsigned n_samples, unsigned n_threads) {
+  if (GetFlag("uncertainties-use-linear")) return GetRateCovarianceLinear(&fit);
+  auto const& lookup = GenerateProcSystMap();
+  unsigned n = procs_.size();
+
+  // Each entry of the matrix is for the sum of all the processes sharing a
+  // bin and process name, so we work with these groups throughout
+  std::map<std::pair<std::string, std::string>, unsigned> group_ids;
+  std::vector<unsigned> group(n);
+  for (unsigned i = 0; i < n; ++i) {
+    auto key = std::make_pair(procs_[i]->bin(), procs_[i]->process());
+    group[i] = group_ids.emplace(key, group_ids.size()).first->second;
   }
+  unsigned ng = group_ids.size();
+
   auto backup = GetParameters();
+  std::vector<std::vector<double>> samples;
+  std::vector<ch::Parameter*> sampled =
+      SampleParameters(fit, n_samples, samples);
+  RateTermMap terms = BuildRateTerms(lookup, sampled);
 
-  // Calling randomizePars() ensures that the RooArgList of sampled parameters
-  // is already created within the RooFitResult
-  RooArgList const& rands = fit.randomizePars();
+  // The normalisation of a process with a RooFit term can only be obtained
+  // by updating the workspace, which cannot be shared between threads
+  bool update_ws = ch::any_of(procs_, [](std::shared_ptr<Process> const& p) {
+    return p->norm() || p->pdf();
+  });
+  std::vector<double> base(n);
+  for (unsigned i = 0; i < n; ++i) base[i] = procs_[i]->rate();
 
-  // Now create two aligned vectors of the RooRealVar parameters and the
-  // corresponding ch::Parameter pointers
-  int n_pars = rands.getSize();
-  std::vector<RooRealVar const*> r_vec(n_pars, nullptr);
-  std::vector<ch::Parameter*> p_vec(n_pars, nullptr);
-  for (unsigned n = 0; n < p_vec.size(); ++n) {
-    r_vec[n] = dynamic_cast<RooRealVar const*>(rands.at(n));
-    p_vec[n] = GetParameter(r_vec[n]->GetName());
+  std::vector<double> current(sampled.size());
+  for (unsigned k = 0; k < sampled.size(); ++k) current[k] = sampled[k]->val();
+  std::vector<double> nominal(ng, 0.);
+  for (unsigned i = 0; i < n; ++i) {
+    nominal[group[i]] += base[i] * EvalRateTerms(terms[i], current.data());
   }
 
-  // Main loop through n_samples
-  for (unsigned rnd = 0; rnd < n_samples; ++rnd) {
-    // Randomise and update values
-    fit.randomizePars();
-    for (int n = 0; n < n_pars; ++n) {
-      if (p_vec[n]) p_vec[n]->set_val(r_vec[n]->getVal());
+  if (n_threads == 0) n_threads = std::thread::hardware_concurrency();
+  if (update_ws || n_threads == 0) n_threads = 1;
+  n_threads = std::min(n_threads, std::max(n_samples, 1u));
+
+  // Every thread fills the upper triangle of its own matrix
+  std::vector<std::vector<double>> partial(n_threads,
+                                           std::vector<double>(ng * ng, 0.));
+  auto run = [&](unsigned t) {
+    std::vector<double> diff(ng);
+    std::vector<double> p_base(base);
+    double * cov = partial[t].data();
+    for (unsigned rnd = t; rnd < n_samples; rnd += n_threads) {
+      double const* vals = samples[rnd].data();
+      if (update_ws) {
+        for (unsigned k = 0; k < sampled.size(); ++k) {
+          sampled[k]->set_val(vals[k]);
+        }
+        for (unsigned i = 0; i < n; ++i) p_base[i] = procs_[i]->rate();
+      }
+      for (unsigned g = 0; g < ng; ++g) diff[g] = -nominal[g];
+      for (unsigned i = 0; i < n; ++i) {
+        diff[group[i]] += p_base[i] * EvalRateTerms(terms[i], vals);
+      }
+      for (unsigned a = 0; a < ng; ++a) {
+        double const da = diff[a];
+        double * row = cov + a * ng;
+        for (unsigned b = a; b < ng; ++b) row[b] += da * diff[b];
+      }
     }
+  };
+  std::vector<std::thread> threads;
+  for (unsigned t = 1; t < n_threads; ++t) threads.emplace_back(run, t);
+  run(0);
+  for (auto & thread : threads) thread.join();
+  if (update_ws) this->UpdateParameters(backup);
 
-    for (int i = 1; i <= nom.GetNbinsX(); ++i) {
-      for (int j = 1; j <= nom.GetNbinsX(); ++j) {
-        int x = j;
-        int y = nom.GetNbinsX() - (i - 1);
-        res.GetXaxis()->SetBinLabel(x, labels[j - 1].c_str());
-        res.GetYaxis()->SetBinLabel(y, labels[i - 1].c_str());
-        res.SetBinContent(
-            x, y, res.GetBinContent(x, y) +
-                      (ch_procs[i - 1].GetRate() - nom.GetBinContent(i)) *
-                      (ch_procs[j - 1].GetRate() - nom.GetBinContent(j)));
+  std::vector<double> group_cov(ng * ng, 0.);
+  for (auto const& part : partial) {
+    for (unsigned a = 0; a < ng; ++a) {
+      for (unsigned b = a; b < ng; ++b) {
+        group_cov[a * ng + b] += part[a * ng + b];
       }
     }
   }
-
-  for (int i = 1; i <= nom.GetNbinsX(); ++i) {
-    for (int j = 1; j <= nom.GetNbinsX(); ++j) {
-      int x = j;
-      int y = nom.GetNbinsX() - (i - 1);
-      res.SetBinContent(x, y, res.GetBinContent(x, y) / double(n_samples));
+  std::vector<std::vector<double>> res(n, std::vector<double>(n, 0.));
+  if (n_samples == 0) return res;
+  for (unsigned i = 0; i < n; ++i) {
+    for (unsigned j = 0; j < n; ++j) {
+      unsigned a = std::min(group[i], group[j]);
+      unsigned b = std::max(group[i], group[j]);
+      res[i][j] = group_cov[a * ng + b] / double(n_samples);
     }
   }
-  this->UpdateParameters(backup);
   return res;
 }
 
@@ -269,13 +477,266 @@ TH2F CombineHarvester::GetRateCorrelation(RooFitResult const& fit,
   return res;
 }
 
+std::vector<ch::Parameter*> CombineHarvester::GetParameterCovariance(
+    RooFitResult const* fit, std::vector<std::vector<double>> & cov) {
+  std::vector<ch::Parameter*> pars;
+  if (fit) {
+    RooArgList const& floats = fit->floatParsFinal();
+    TMatrixDSym const& fit_cov = fit->covarianceMatrix();
+    std::vector<int> rows;
+    for (int n = 0; n < floats.getSize(); ++n) {
+      ch::Parameter* par = GetParameter(floats.at(n)->GetName());
+      if (!par || par->frozen()) continue;
+      pars.push_back(par);
+      rows.push_back(n);
+    }
+    cov.assign(pars.size(), std::vector<double>(pars.size(), 0.));
+    for (unsigned k = 0; k < rows.size(); ++k) {
+      for (unsigned l = 0; l < rows.size(); ++l) {
+        cov[k][l] = fit_cov(rows[k], rows[l]);
+      }
+    }
+  } else {
+    // Without a fit the parameters are uncorrelated, and the +/-1 sigma
+    // shifts used by GetUncertainty() give the width
+    for (auto const& it : params_) {
+      if (it.second->frozen()) continue;
+      pars.push_back(it.second.get());
+    }
+    cov.assign(pars.size(), std::vector<double>(pars.size(), 0.));
+    for (unsigned k = 0; k < pars.size(); ++k) {
+      double err = (pars[k]->err_u() - pars[k]->err_d()) / 2.;
+      cov[k][k] = err * err;
+    }
+  }
+  return pars;
+}
+
+double CombineHarvester::LogRateDerivative(Systematic const* sys,
+                                           double x) const {
+  if (!sys->asymm()) return sys->scale() * std::log(sys->value_u());
+  double h = 1E-3;
+  double hi = logKappaForX((x + h) * sys->scale(), sys->value_d(),
+                           sys->value_u());
+  double lo = logKappaForX((x - h) * sys->scale(), sys->value_d(),
+                           sys->value_u());
+  return (std::log(hi) - std::log(lo)) / (2. * h);
+}
+
+std::vector<std::vector<double>> CombineHarvester::GetRateJacobian(
+    ProcSystMap const& lookup, std::vector<ch::Parameter*> const& pars) {
+  RateTermMap terms = BuildRateTerms(lookup, pars);
+  std::vector<double> current(pars.size());
+  for (unsigned k = 0; k < pars.size(); ++k) current[k] = pars[k]->val();
+  std::vector<std::vector<double>> jac(
+      procs_.size(), std::vector<double>(pars.size(), 0.));
+  for (unsigned i = 0; i < procs_.size(); ++i) {
+    double p_rate =
+        procs_[i]->rate() * EvalRateTerms(terms[i], current.data());
+    for (auto const& term : terms[i]) {
+      if (term.slot < 0) continue;
+      jac[i][term.slot] +=
+          p_rate * LogRateDerivative(term.sys, current[term.slot]);
+    }
+  }
+  return jac;
+}
+
+std::vector<std::vector<double>> CombineHarvester::GetShapeJacobian(
+    ProcSystMap const& lookup, std::vector<ch::Parameter*> const& pars,
+    TH1F & shape) {
+  RateTermMap terms = BuildRateTerms(lookup, pars);
+  std::vector<double> current(pars.size());
+  for (unsigned k = 0; k < pars.size(); ++k) current[k] = pars[k]->val();
+  std::vector<std::vector<double>> jac;
+  bool shape_init = false;
+  double h = 1E-3;
+
+  for (unsigned i = 0; i < procs_.size(); ++i) {
+    bool is_hist = procs_[i]->shape() || procs_[i]->data();
+    if (!is_hist && !procs_[i]->pdf()) continue;
+    TH1F proc_shape = is_hist ? procs_[i]->ShapeAsTH1F()
+                              : PdfShapeInternal(procs_[i].get());
+    TH1F nom_shape = proc_shape;
+    double p_rate =
+        procs_[i]->rate() * EvalRateTerms(terms[i], current.data());
+    // The derivative of the shape template itself, for each term
+    std::vector<TH1F> shape_derivs(terms[i].size());
+    for (unsigned t = 0; t < terms[i].size(); ++t) {
+      Systematic const* sys = terms[i][t].sys;
+      double x = terms[i][t].slot >= 0 ? current[terms[i][t].slot]
+                                       : terms[i][t].x;
+      if (!is_hist || !sys->asymm() ||
+          (sys->type() != "shape" && sys->type() != "shapeN2" &&
+           sys->type() != "shapeU")) {
+        continue;
+      }
+      bool linear = sys->type() != "shapeN2";
+      if (sys->shape_u() && sys->shape_d()) {
+        ShapeDiff(x * sys->scale(), &proc_shape, procs_[i]->shape(),
+                  sys->shape_d(), sys->shape_u(), linear);
+      }
+      RooDataHist const* nom =
+          dynamic_cast<RooDataHist const*>(procs_[i]->data());
+      if (sys->data_u() && sys->data_d() && nom) {
+        ShapeDiff(x * sys->scale(), &proc_shape, nom, sys->data_d(),
+                  sys->data_u());
+      }
+      if (terms[i][t].slot < 0) continue;
+      // Evaluate the variation on its own, starting from zero for the
+      // additive case or from one for the multiplicative (shapeN2) case
+      TH1F v_hi = nom_shape;
+      TH1F v_lo = nom_shape;
+      for (int b = 1; b <= v_hi.GetNbinsX(); ++b) {
+        v_hi.SetBinContent(b, linear ? 0. : 1.);
+        v_lo.SetBinContent(b, linear ? 0. : 1.);
+      }
+      if (sys->shape_u() && sys->shape_d()) {
+        ShapeDiff((x + h) * sys->scale(), &v_hi, procs_[i]->shape(),
+                  sys->shape_d(), sys->shape_u(), linear);
+        ShapeDiff((x - h) * sys->scale(), &v_lo, procs_[i]->shape(),
+                  sys->shape_d(), sys->shape_u(), linear);
+      }
+      if (sys->data_u() && sys->data_d() && nom) {
+        ShapeDiff((x + h) * sys->scale(), &v_hi, nom, sys->data_d(),
+                  sys->data_u());
+        ShapeDiff((x - h) * sys->scale(), &v_lo, nom, sys->data_d(),
+                  sys->data_u());
+      }
+      shape_derivs[t] = v_hi;
+      for (int b = 1; b <= v_hi.GetNbinsX(); ++b) {
+        double d = linear ? (v_hi.GetBinContent(b) - v_lo.GetBinContent(b))
+                          : (std::log(v_hi.GetBinContent(b)) -
+                             std::log(v_lo.GetBinContent(b)));
+        shape_derivs[t].SetBinContent(b, d / (2. * h));
+      }
+    }
+    // The multiplicative variations scale with the final template
+    for (unsigned t = 0; t < terms[i].size(); ++t) {
+      if (terms[i][t].sys->type() != "shapeN2" ||
+          !shape_derivs[t].GetNbinsX()) {
+        continue;
+      }
+      for (int b = 1; b <= proc_shape.GetNbinsX(); ++b) {
+        shape_derivs[t].SetBinContent(
+            b, shape_derivs[t].GetBinContent(b) * proc_shape.GetBinContent(b));
+      }
+    }
+    for (int b = 1; b <= proc_shape.GetNbinsX(); ++b) {
+      if (proc_shape.GetBinContent(b) < 0.) proc_shape.SetBinContent(b, 0.);
+    }
+    proc_shape.Scale(p_rate);
+    if (!shape_init) {
+      proc_shape.Copy(shape);
+      shape.Reset();
+      jac.assign(pars.size(),
+                 std::vector<double>(proc_shape.GetNbinsX(), 0.));
+      shape_init = true;
+    }
+    shape.Add(&proc_shape);
+    for (unsigned t = 0; t < terms[i].size(); ++t) {
+      int k = terms[i][t].slot;
+      if (k < 0) continue;
+      double dlog = LogRateDerivative(terms[i][t].sys, current[k]);
+      for (int b = 1; b <= proc_shape.GetNbinsX(); ++b) {
+        double d = dlog * proc_shape.GetBinContent(b);
+        // Bins truncated at zero have no dependence on the template
+        if (shape_derivs[t].GetNbinsX() && proc_shape.GetBinContent(b) > 0.) {
+          d += p_rate * shape_derivs[t].GetBinContent(b);
+        }
+        jac[k][b - 1] += d;
+      }
+    }
+  }
+  return jac;
+}
+
+double CombineHarvester::GetUncertaintyLinear(RooFitResult const* fit) {
+  auto const& lookup = GenerateProcSystMap();
+  std::vector<std::vector<double>> cov;
+  auto pars = GetParameterCovariance(fit, cov);
+  auto jac = GetRateJacobian(lookup, pars);
+  std::vector<double> tot(pars.size(), 0.);
+  for (auto const& row : jac) {
+    for (unsigned k = 0; k < pars.size(); ++k) tot[k] += row[k];
+  }
+  double err_sq = 0.;
+  for (unsigned k = 0; k < pars.size(); ++k) {
+    for (unsigned l = 0; l < pars.size(); ++l) {
+      err_sq += tot[k] * cov[k][l] * tot[l];
+    }
+  }
+  return std::sqrt(err_sq);
+}
+
+TH1F CombineHarvester::GetShapeWithUncertaintyLinear(RooFitResult const* fit) {
+  auto const& lookup = GenerateProcSystMap();
+  std::vector<std::vector<double>> cov;
+  auto pars = GetParameterCovariance(fit, cov);
+  TH1F shape;
+  auto jac = GetShapeJacobian(lookup, pars, shape);
+  for (int b = 1; b <= shape.GetNbinsX(); ++b) {
+    double err_sq = 0.;
+    for (unsigned k = 0; k < pars.size(); ++k) {
+      if (jac[k][b - 1] == 0.) continue;
+      for (unsigned l = 0; l < pars.size(); ++l) {
+        err_sq += jac[k][b - 1] * cov[k][l] * jac[l][b - 1];
+      }
+    }
+    shape.SetBinError(b, std::sqrt(err_sq));
+  }
+  return shape;
+}
+
+std::vector<std::vector<double>> CombineHarvester::GetRateCovarianceLinear(
+    RooFitResult const* fit) {
+  auto const& lookup = GenerateProcSystMap();
+  unsigned n = procs_.size();
+  std::vector<std::vector<double>> cov;
+  auto pars = GetParameterCovariance(fit, cov);
+  auto jac = GetRateJacobian(lookup, pars);
+
+  // Sum the derivatives of the processes sharing a bin and process name
+  std::map<std::pair<std::string, std::string>, unsigned> group_ids;
+  std::vector<unsigned> group(n);
+  for (unsigned i = 0; i < n; ++i) {
+    auto key = std::make_pair(procs_[i]->bin(), procs_[i]->process());
+    group[i] = group_ids.emplace(key, group_ids.size()).first->second;
+  }
+  unsigned ng = group_ids.size();
+  std::vector<std::vector<double>> g_jac(ng,
+                                         std::vector<double>(pars.size(), 0.));
+  for (unsigned i = 0; i < n; ++i) {
+    for (unsigned k = 0; k < pars.size(); ++k) g_jac[group[i]][k] += jac[i][k];
+  }
+  // J.C once, then (J.C).J^T
+  std::vector<std::vector<double>> jc(ng, std::vector<double>(pars.size(), 0.));
+  for (unsigned a = 0; a < ng; ++a) {
+    for (unsigned k = 0; k < pars.size(); ++k) {
+      if (g_jac[a][k] == 0.) continue;
+      for (unsigned l = 0; l < pars.size(); ++l) {
+        jc[a][l] += g_jac[a][k] * cov[k][l];
+      }
+    }
+  }
+  std::vector<std::vector<double>> res(n, std::vector<double>(n, 0.));
+  for (unsigned i = 0; i < n; ++i) {
+    for (unsigned j = 0; j < n; ++j) {
+      for (unsigned l = 0; l < pars.size(); ++l) {
+        res[i][j] += jc[group[i]][l] * g_jac[group[j]][l];
+      }
+    }
+  }
+  return res;
+}
+
 double CombineHarvester::GetRate() {
-  auto lookup = GenerateProcSystMap();
+  auto const& lookup = GenerateProcSystMap();
   return GetRateInternal(lookup);
 }
 
 TH1F CombineHarvester::GetShape() {
-  auto lookup = GenerateProcSystMap();
+  auto const& lookup = GenerateProcSystMap();
   return GetShapeInternal(lookup);
 }
 
@@ -376,28 +837,7 @@ TH1F CombineHarvester::GetShapeInternal(ProcSystMap const& lookup,
       }
       shape.Add(&proc_shape);
     } else if (procs_[i]->pdf()) {
-      if (!procs_[i]->observable()) {
-        RooAbsData const* data_obj = FindMatchingData(procs_[i].get());
-        std::string var_name = "CMS_th1x";
-        if (data_obj) var_name = data_obj->get()->first()->GetName();
-        procs_[i]->set_observable((RooRealVar *)procs_[i]->pdf()->findServer(var_name.c_str()));
-      }
-      TH1::AddDirectory(false);
-      TH1F* tmp = (TH1F*)procs_[i]->observable()->createHistogram("");
-      for (int b = 1; b <= tmp->GetNbinsX(); ++b) {
-        procs_[i]->observable()->setVal(tmp->GetBinCenter(b));
-        tmp->SetBinContent(b, tmp->GetBinWidth(b) * procs_[i]->pdf()->getVal());
-      }
-      TH1F proc_shape = *tmp;
-      delete tmp;
-      RooAbsPdf const* aspdf = dynamic_cast<RooAbsPdf const*>(procs_[i]->pdf());
-      if ((aspdf && !aspdf->selfNormalized()) || (!aspdf)) {
-        // LOGLINE(log(), "Have a pdf that is not selfNormalized");
-        // std::cout << "Integral: " << proc_shape.Integral() << "\n";
-        if (proc_shape.Integral() > 0.) {
-          proc_shape.Scale(1. / proc_shape.Integral());
-        }
-      }
+      TH1F proc_shape = PdfShapeInternal(procs_[i].get());
       for (auto sys_it : lookup[i]) {
         if (sys_it->type() == "rateParam") {
           continue;  // don't evaluate this for now
@@ -422,6 +862,32 @@ TH1F CombineHarvester::GetShapeInternal(ProcSystMap const& lookup,
   return shape;
 }
 
+TH1F CombineHarvester::PdfShapeInternal(Process * proc) {
+  if (!proc->observable()) {
+    RooAbsData const* data_obj = FindMatchingData(proc);
+    std::string var_name = "CMS_th1x";
+    if (data_obj) var_name = data_obj->get()->first()->GetName();
+    proc->set_observable((RooRealVar *)proc->pdf()->findServer(var_name.c_str()));
+  }
+  TH1::AddDirectory(false);
+  TH1F* tmp = (TH1F*)proc->observable()->createHistogram("");
+  for (int b = 1; b <= tmp->GetNbinsX(); ++b) {
+    proc->observable()->setVal(tmp->GetBinCenter(b));
+    tmp->SetBinContent(b, tmp->GetBinWidth(b) * proc->pdf()->getVal());
+  }
+  TH1F proc_shape = *tmp;
+  delete tmp;
+  RooAbsPdf const* aspdf = dynamic_cast<RooAbsPdf const*>(proc->pdf());
+  if ((aspdf && !aspdf->selfNormalized()) || (!aspdf)) {
+    // LOGLINE(log(), "Have a pdf that is not selfNormalized");
+    // std::cout << "Integral: " << proc_shape.Integral() << "\n";
+    if (proc_shape.Integral() > 0.) {
+      proc_shape.Scale(1. / proc_shape.Integral());
+    }
+  }
+  return proc_shape;
+}
+
 double CombineHarvester::GetObservedRate() {
   double rate = 0.0;
   for (unsigned i = 0; i < obs_.size(); ++i) {
@@ -3,6 +3,7 @@
 #include <string>
 #include <utility>
 #include <set>
+#include <algorithm>
 #include "CombineHarvester/CombineTools/interface/Observation.h"
 #include "CombineHarvester/CombineTools/interface/Process.h"
 #include "CombineHarvester/CombineTools/interface/Systematic.h"
@@ -10,6 +11,111 @@
 
 namespace ch {
 
+template <typename T, typename Converter>
+void CombineHarvester::FilterIndexed(CowVector<std::shared_ptr<T>>& in,
+                                     CollectionIndex<T> const* idx,
+                                     std::string const& key,
+                                     std::vector<std::string> const& vec,
+                                     Converter fn, bool cond) {
+  // The index can only be used while it still describes exactly the objects
+  // in this collection. Filters only ever remove objects and added objects
+  // are appended to the index, so a matching size shows that none have been
+  // removed since it was built.
+  if (!idx || !IndexCurrent(in, *idx) || !idx->keys.count(key)) {
+    FilterContaining(in, vec, fn, cond);
+    return;
+  }
+  IndexKeyMap const& keys = idx->keys.at(key);
+  std::vector<unsigned> pos;
+  for (auto const& val : vec) {
+    auto it = keys.find(val);
+    if (it != keys.end()) {
+      pos.insert(pos.end(), it->second.begin(), it->second.end());
+    }
+  }
+  std::sort(pos.begin(), pos.end());
+  pos.erase(std::unique(pos.begin(), pos.end()), pos.end());
+  std::vector<std::shared_ptr<T>> res;
+  if (cond) {
+    res.reserve(pos.size());
+    for (unsigned i : pos) res.push_back(idx->base[i]);
+  } else {
+    res.reserve(idx->base.size() - pos.size());
+    auto it = pos.begin();
+    for (unsigned i = 0; i < idx->base.size(); ++i) {
+      if (it != pos.end() && *it == i) {
+        ++it;
+        continue;
+      }
+      res.push_back(idx->base[i]);
+    }
+  }
+  in.assign(std::move(res));
+}
+
+void CombineHarvester::IndexKeys(Observation const& obs, unsigned i,
+                                 CollectionIndex<Observation>* idx) {
+  idx->keys["bin"][obs.bin()].push_back(i);
+  idx->keys["era"][obs.era()].push_back(i);
+  idx->keys["channel"][obs.channel()].push_back(i);
+  idx->keys["mass"][obs.mass()].push_back(i);
+}
+
+void CombineHarvester::IndexKeys(Process const& proc, unsigned i,
+                                 CollectionIndex<Process>* idx) {
+  idx->keys["bin"][proc.bin()].push_back(i);
+  idx->keys["process"][proc.process()].push_back(i);
+  idx->keys["era"][proc.era()].push_back(i);
+  idx->keys["channel"][proc.channel()].push_back(i);
+  idx->keys["mass"][proc.mass()].push_back(i);
+}
+
+void CombineHarvester::IndexKeys(Systematic const& sys, unsigned i,
+                                 CollectionIndex<Systematic>* idx) {
+  idx->keys["bin"][sys.bin()].push_back(i);
+  idx->keys["process"][sys.process()].push_back(i);
+  idx->keys["era"][sys.era()].push_back(i);
+  idx->keys["channel"][sys.channel()].push_back(i);
+  idx->keys["mass"][sys.mass()].push_back(i);
+  idx->keys["name"][sys.name()].push_back(i);
+}
+
+CombineHarvester& CombineHarvester::BuildIndex() {
+  auto idx = std::make_shared<FilterIndex>();
+  idx->obs.base = obs_;
+  idx->procs.base = procs_;
+  idx->systs.base = systs_;
+  idx->obs.edits = Object::key_edits();
+  idx->procs.edits = Object::key_edits();
+  idx->systs.edits = Object::key_edits();
+  for (unsigned i = 0; i < obs_.size(); ++i) {
+    IndexKeys(*(obs_[i]), i, &(idx->obs));
+    obs_[i]->set_indexed();
+  }
+  for (unsigned i = 0; i < procs_.size(); ++i) {
+    IndexKeys(*(procs_[i]), i, &(idx->procs));
+    procs_[i]->set_indexed();
+  }
+  for (unsigned i = 0; i < systs_.size(); ++i) {
+    IndexKeys(*(systs_[i]), i, &(idx->systs));
+    systs_[i]->set_indexed();
+  }
+  index_ = idx;
+  return *this;
+}
+
+void CombineHarvester::ClearIndex() {
+  index_.reset();
+}
+
+void CombineHarvester::ReleaseStaleIndex() {
+  if (index_ && (!IndexCurrent(obs_, index_->obs) ||
+                 !IndexCurrent(procs_, index_->procs) ||
+                 !IndexCurrent(systs_, index_->systs))) {
+    index_.reset();
+  }
+}
+
 CombineHarvester& CombineHarvester::bin(
     std::vector<std::string> const& vec, bool cond) {
   if (GetFlag("filters-use-regex")) {
@@ -17,10 +123,14 @@ CombineHarvester& CombineHarvester::bin(
     FilterContainingRgx(obs_, vec, std::mem_fn(&Observation::bin), cond);
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::bin), cond);
   } else {
-    FilterContaining(procs_, vec, std::mem_fn(&Process::bin), cond);
-    FilterContaining(obs_, vec, std::mem_fn(&Observation::bin), cond);
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::bin), cond);  
+    FilterIndexed(procs_, procs_index(), "bin", vec,
+                  std::mem_fn(&Process::bin), cond);
+    FilterIndexed(obs_, obs_index(), "bin", vec,
+                  std::mem_fn(&Observation::bin), cond);
+    FilterIndexed(systs_, systs_index(), "bin", vec,
+                  std::mem_fn(&Systematic::bin), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -29,6 +139,7 @@ CombineHarvester& CombineHarvester::bin_id(
   FilterContaining(procs_, vec, std::mem_fn(&Process::bin_id), cond);
   FilterContaining(obs_, vec, std::mem_fn(&Observation::bin_id), cond);
   FilterContaining(systs_, vec, std::mem_fn(&Systematic::bin_id), cond);
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -38,10 +149,12 @@ CombineHarvester& CombineHarvester::process(
     FilterContainingRgx(procs_, vec, std::mem_fn(&Process::process), cond);
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::process), cond);
   } else {
-    FilterContaining(procs_, vec, std::mem_fn(&Process::process), cond);
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::process), cond);
+    FilterIndexed(procs_, procs_index(), "process", vec,
+                  std::mem_fn(&Process::process), cond);
+    FilterIndexed(systs_, systs_index(), "process", vec,
+                  std::mem_fn(&Systematic::process), cond);
   }
-
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -49,6 +162,7 @@ CombineHarvester& CombineHarvester::process_rgx(
     std::vector<std::string> const& vec, bool cond) {
   FilterContainingRgx(procs_, vec, std::mem_fn(&Process::process), cond);
   FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::process), cond);
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -63,6 +177,7 @@ CombineHarvester& CombineHarvester::analysis(
     FilterContaining(obs_, vec, std::mem_fn(&Observation::analysis), cond);
     FilterContaining(systs_, vec, std::mem_fn(&Systematic::analysis), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -73,10 +188,14 @@ CombineHarvester& CombineHarvester::era(
     FilterContainingRgx(obs_, vec, std::mem_fn(&Observation::era), cond);
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::era), cond);
   } else {
-    FilterContaining(procs_, vec, std::mem_fn(&Process::era), cond);
-    FilterContaining(obs_, vec, std::mem_fn(&Observation::era), cond);
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::era), cond);
+    FilterIndexed(procs_, procs_index(), "era", vec,
+                  std::mem_fn(&Process::era), cond);
+    FilterIndexed(obs_, obs_index(), "era", vec,
+                  std::mem_fn(&Observation::era), cond);
+    FilterIndexed(systs_, systs_index(), "era", vec,
+                  std::mem_fn(&Systematic::era), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -87,10 +206,14 @@ CombineHarvester& CombineHarvester::channel(
     FilterContainingRgx(obs_, vec, std::mem_fn(&Observation::channel), cond);
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::channel), cond);
   } else {
-    FilterContaining(procs_, vec, std::mem_fn(&Process::channel), cond);
-    FilterContaining(obs_, vec, std::mem_fn(&Observation::channel), cond);
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::channel), cond);
+    FilterIndexed(procs_, procs_index(), "channel", vec,
+                  std::mem_fn(&Process::channel), cond);
+    FilterIndexed(obs_, obs_index(), "channel", vec,
+                  std::mem_fn(&Observation::channel), cond);
+    FilterIndexed(systs_, systs_index(), "channel", vec,
+                  std::mem_fn(&Systematic::channel), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -101,10 +224,14 @@ CombineHarvester& CombineHarvester::mass(
     FilterContainingRgx(obs_, vec, std::mem_fn(&Observation::mass), cond);
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::mass), cond);
   } else {
-    FilterContaining(procs_, vec, std::mem_fn(&Process::mass), cond);
-    FilterContaining(obs_, vec, std::mem_fn(&Observation::mass), cond);
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::mass), cond);
+    FilterIndexed(procs_, procs_index(), "mass", vec,
+                  std::mem_fn(&Process::mass), cond);
+    FilterIndexed(obs_, obs_index(), "mass", vec,
+                  std::mem_fn(&Observation::mass), cond);
+    FilterIndexed(systs_, systs_index(), "mass", vec,
+                  std::mem_fn(&Systematic::mass), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -119,6 +246,7 @@ CombineHarvester& CombineHarvester::attr(
     FilterContaining(obs_, vec, std::mem_fn(&Observation::attribute), attr_label, cond);
     FilterContaining(systs_, vec, std::mem_fn(&Systematic::attribute), attr_label, cond);  
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -128,8 +256,10 @@ CombineHarvester& CombineHarvester::syst_name(
   if (GetFlag("filters-use-regex")) {
     FilterContainingRgx(systs_, vec, std::mem_fn(&Systematic::name), cond);
   } else {
-    FilterContaining(systs_, vec, std::mem_fn(&Systematic::name), cond);
+    FilterIndexed(systs_, systs_index(), "name", vec,
+                  std::mem_fn(&Systematic::name), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -140,6 +270,7 @@ CombineHarvester& CombineHarvester::syst_type(
   } else {
     FilterContaining(systs_, vec, std::mem_fn(&Systematic::type), cond);
   }
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -150,6 +281,7 @@ CombineHarvester & CombineHarvester::signals() {
   ch::erase_if(procs_, [&] (std::shared_ptr<Process> val) {
     return !val->signal();
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -160,6 +292,7 @@ CombineHarvester & CombineHarvester::backgrounds() {
   ch::erase_if(procs_, [&] (std::shared_ptr<Process> val) {
     return val->signal();
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -170,6 +303,7 @@ CombineHarvester & CombineHarvester::histograms() {
   ch::erase_if(procs_, [&] (std::shared_ptr<Process> val) {
     return val->shape() == nullptr;
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -177,6 +311,7 @@ CombineHarvester & CombineHarvester::pdfs() {
   ch::erase_if(procs_, [&] (std::shared_ptr<Process> val) {
     return val->pdf() == nullptr;
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -184,6 +319,7 @@ CombineHarvester & CombineHarvester::data() {
   ch::erase_if(obs_, [&] (std::shared_ptr<Observation> val) {
     return val->data() == nullptr;
   });
+  ReleaseStaleIndex();
   return *this;
 }
 
@@ -8,6 +8,7 @@
 #include "CombineHarvester/CombineTools/interface/CopyTools.h"
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
 #include "CombineHarvester/CombineTools/interface/ParseCombineWorkspace.h"
+#include "CombineHarvester/CombineTools/interface/TFileIO.h"
 #include "boost/python.hpp"
 #include "TFile.h"
 #include "TH1F.h"
@@ -187,12 +188,21 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
   py::to_python_converter<std::set<int>,
                           convert_cpp_set_to_py_list<int>>();
 
+  py::to_python_converter<std::vector<double>,
+                          convert_cpp_vector_to_py_list<double>>();
+
+  py::to_python_converter<std::vector<std::vector<double>>,
+                          convert_cpp_vector_to_py_list<std::vector<double>>>();
+
   py::to_python_converter<std::map<std::string, CombineHarvester>,
                           convert_cpp_map_to_py_dict<std::string, CombineHarvester>>();
 
   py::to_python_converter<TH1F,
                           convert_cpp_root_to_py_root<TH1F>>();
 
+  py::to_python_converter<std::vector<TH1F>,
+                          convert_cpp_vector_to_py_list<TH1F>>();
+
   py::to_python_converter<TH2F,
                           convert_cpp_root_to_py_root<TH2F>>();
 
@@ -204,6 +214,7 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
 
   // Define converters from python --> C++
   convert_py_seq_to_cpp_vector<std::string>();
+  convert_py_seq_to_cpp_vector<std::vector<std::string>>();
   convert_py_tup_to_cpp_pair<int, std::string>();
   convert_py_seq_to_cpp_vector<std::pair<int, std::string>>();
   convert_py_seq_to_cpp_vector<int>();
@@ -240,6 +251,8 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       .def("QuickParseDatacard", Overload2_ParseDatacard)
       .def("WriteDatacard", Overload1_WriteDatacard)
       .def("WriteDatacard", Overload2_WriteDatacard)
+      .def("SaveSnapshot", &CombineHarvester::SaveSnapshot)
+      .def("LoadSnapshot", &CombineHarvester::LoadSnapshot)
       // Filters
       .def("bin", &CombineHarvester::bin,
           defaults_bin()[py::return_internal_reference<>()])
@@ -279,6 +292,10 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
           py::return_internal_reference<>())
       .def("FilterSysts", FilterSystsPy,
           py::return_internal_reference<>())
+      .def("BuildIndex", &CombineHarvester::BuildIndex,
+          py::return_internal_reference<>())
+      .def("ClearIndex", &CombineHarvester::ClearIndex)
+      .def("HasIndex", &CombineHarvester::HasIndex)
       // Set producers
       .def("bin_set", &CombineHarvester::bin_set)
       .def("bin_id_set", &CombineHarvester::bin_id_set)
@@ -313,13 +330,17 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       .def("GetShape", &CombineHarvester::GetShape)
       .def("GetShapeWithUncertainty", Overload1_GetShapeWithUncertainty)
       .def("GetShapeWithUncertainty", Overload2_GetShapeWithUncertainty)
+      .def("__GetShapesWithUncertainty__",
+           &CombineHarvester::GetShapesWithUncertainty)
       .def("GetRateCovariance", &CombineHarvester::GetRateCovariance)
       .def("GetRateCorrelation", &CombineHarvester::GetRateCorrelation)
+      .def("__GetRateCovarianceMatrix__", &CombineHarvester::GetRateCovarianceMatrix)
       .def("GetObservedShape", &CombineHarvester::GetObservedShape)
       // Creation
       .def("__AddObservations__", &CombineHarvester::AddObservations)
       .def("__AddProcesses__", &CombineHarvester::AddProcesses)
       .def("AddSystFromProc", &CombineHarvester::AddSystFromProc)
+      .def("__AddSystBulk__", &CombineHarvester::AddSystBulk)
       .def("ExtractShapes", &CombineHarvester::ExtractShapes)
       .def("AddBinByBin", Overload_AddBinByBin)
       .def("MergeBinErrors",  &CombineHarvester::MergeBinErrors)
@@ -468,4 +489,6 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
     py::def("ValsFromRange", ch::ValsFromRange, defaults_ValsFromRange());
     py::def("SetStandardBinNames", ch::SetStandardBinNames, defaults_SetStandardBinNames());
     py::def("ParseCombineWorkspace", ch::ParseCombineWorkspacePy);
+    py::def("SetTFileCacheLimits", ch::SetTFileCacheLimits);
+    py::def("ClearTFileCache", ch::ClearTFileCache);
 }
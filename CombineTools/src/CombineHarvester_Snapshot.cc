@@ -0,0 +1,493 @@
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include <cstdint>
+#include <cstring>
+#include <fstream>
+#include <map>
+#include <memory>
+#include <string>
+#include <utility>
+#include <vector>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include "TH1.h"
+#include "TH1F.h"
+#include "TH1D.h"
+#include "RooRealVar.h"
+#include "RooWorkspace.h"
+#include "CombineHarvester/CombineTools/interface/Observation.h"
+#include "CombineHarvester/CombineTools/interface/Process.h"
+#include "CombineHarvester/CombineTools/interface/Systematic.h"
+#include "CombineHarvester/CombineTools/interface/Parameter.h"
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+
+namespace ch {
+
+namespace {
+// A snapshot file has three parts:
+//  - the header below
+//  - the meta section, with every object property, parameter and setting
+//    packed in a fixed order
+//  - the data section, with each histogram stored as contiguous doubles: the
+//    nbins+1 bin edges, the nbins+2 bin contents and, if the histogram has
+//    them, the nbins+2 sums of weights squared
+// The data section starts on an 8-byte boundary, so that it can be used
+// directly from a memory-mapped file.
+char const kSnapshotMagic[8] = {'C', 'H', 'S', 'N', 'A', 'P', '\0', '\0'};
+uint32_t const kSnapshotVersion = 1;
+uint32_t const kSnapshotByteOrder = 0x01020304;
+
+struct SnapshotHeader {
+  char magic[8];
+  uint32_t version;
+  uint32_t byte_order;
+  uint64_t meta_size;
+  uint64_t data_offset;
+  uint64_t data_size;
+};
+
+// Histogram types in the meta section
+enum SnapshotHist : uint8_t { kNoHist = 0, kTH1F = 1, kTH1D = 2 };
+
+class SnapshotWriter {
+ public:
+  template <typename T>
+  void Put(T const& val) {
+    meta_.append(reinterpret_cast<char const*>(&val), sizeof(T));
+  }
+
+  void PutStr(std::string const& str) {
+    Put<uint32_t>(str.size());
+    meta_.append(str);
+  }
+
+  void PutObject(Object const& obj) {
+    PutStr(obj.bin());
+    PutStr(obj.process());
+    Put<uint8_t>(obj.signal());
+    PutStr(obj.analysis());
+    PutStr(obj.era());
+    PutStr(obj.channel());
+    Put<int32_t>(obj.bin_id());
+    PutStr(obj.mass());
+    Put<uint32_t>(obj.all_attributes().size());
+    for (auto const& it : obj.all_attributes()) {
+      PutStr(it.first);
+      PutStr(it.second);
+    }
+  }
+
+  void PutHist(TH1 const* h) {
+    if (!h) {
+      Put<uint8_t>(kNoHist);
+      return;
+    }
+    if (h->GetDimension() != 1) {
+      throw std::runtime_error(FNERROR(std::string("Histogram ") +
+                                       h->GetName() + " is not 1D"));
+    }
+    int n = h->GetNbinsX();
+    bool has_sumw2 = h->GetSumw2N() > 0;
+    Put<uint8_t>(h->InheritsFrom(TH1F::Class()) ? kTH1F : kTH1D);
+    PutStr(h->GetName());
+    PutStr(h->GetTitle());
+    Put<int32_t>(n);
+    Put<uint64_t>(data_.size());
+    Put<uint8_t>(has_sumw2);
+    Put<double>(h->GetEntries());
+    TAxis const* axis = h->GetXaxis();
+    for (int i = 1; i <= n + 1; ++i) data_.push_back(axis->GetBinLowEdge(i));
+    for (int i = 0; i <= n + 1; ++i) data_.push_back(h->GetBinContent(i));
+    if (has_sumw2) {
+      TArrayD const* sumw2 = h->GetSumw2();
+      data_.insert(data_.end(), sumw2->GetArray(),
+                   sumw2->GetArray() + sumw2->GetSize());
+    }
+  }
+
+  void Write(std::string const& path) const {
+    SnapshotHeader header;
+    std::memcpy(header.magic, kSnapshotMagic, sizeof(header.magic));
+    header.version = kSnapshotVersion;
+    header.byte_order = kSnapshotByteOrder;
+    header.meta_size = meta_.size();
+    uint64_t meta_end = sizeof(SnapshotHeader) + meta_.size();
+    header.data_offset = (meta_end + 7) / 8 * 8;
+    header.data_size = data_.size();
+    std::ofstream file(path, std::ios::binary | std::ios::trunc);
+    if (!file.is_open()) {
+      throw std::runtime_error(FNERROR("Unable to create file: " + path));
+    }
+    file.write(reinterpret_cast<char const*>(&header), sizeof(header));
+    file.write(meta_.data(), meta_.size());
+    std::string padding(header.data_offset - meta_end, '\0');
+    file.write(padding.data(), padding.size());
+    file.write(reinterpret_cast<char const*>(data_.data()),
+               data_.size() * sizeof(double));
+    if (!file.good()) {
+      throw std::runtime_error(FNERROR("Error writing to file: " + path));
+    }
+  }
+
+ private:
+  std::string meta_;
+  std::vector<double> data_;
+};
+
+class SnapshotReader {
+ public:
+  explicit SnapshotReader(std::string const& path) {
+    int fd = open(path.c_str(), O_RDONLY);
+    if (fd < 0) {
+      throw std::runtime_error(FNERROR("Unable to open file: " + path));
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || st.st_size < off_t(sizeof(SnapshotHeader))) {
+      close(fd);
+      throw std::runtime_error(FNERROR(path + " is not a snapshot file"));
+    }
+    size_ = st.st_size;
+    void* addr = mmap(nullptr, size_, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (addr == MAP_FAILED) {
+      throw std::runtime_error(FNERROR("Unable to map file: " + path));
+    }
+    base_ = static_cast<char const*>(addr);
+    SnapshotHeader header;
+    std::memcpy(&header, base_, sizeof(header));
+    if (std::memcmp(header.magic, kSnapshotMagic, sizeof(header.magic)) != 0 ||
+        header.byte_order != kSnapshotByteOrder) {
+      Unmap();
+      throw std::runtime_error(FNERROR(
+          path + " is not a snapshot file, or was written on a machine with "
+                 "a different byte order"));
+    }
+    if (header.version != kSnapshotVersion) {
+      Unmap();
+      throw std::runtime_error(FNERROR(path + " has unsupported version " +
+                                       std::to_string(header.version)));
+    }
+    if (header.data_offset % 8 != 0 ||
+        sizeof(SnapshotHeader) + header.meta_size > header.data_offset ||
+        header.data_offset + header.data_size * sizeof(double) > size_) {
+      Unmap();
+      throw std::runtime_error(FNERROR(path + " is truncated or corrupt"));
+    }
+    pos_ = base_ + sizeof(SnapshotHeader);
+    meta_end_ = pos_ + header.meta_size;
+    data_ = reinterpret_cast<double const*>(base_ + header.data_offset);
+    data_size_ = header.data_size;
+  }
+
+  ~SnapshotReader() { Unmap(); }
+
+  SnapshotReader(SnapshotReader const&) = delete;
+  SnapshotReader& operator=(SnapshotReader const&) = delete;
+
+  template <typename T>
+  T Get() {
+    Need(sizeof(T));
+    T val;
+    std::memcpy(&val, pos_, sizeof(T));
+    pos_ += sizeof(T);
+    return val;
+  }
+
+  std::string GetStr() {
+    uint32_t len = Get<uint32_t>();
+    Need(len);
+    std::string res(pos_, len);
+    pos_ += len;
+    return res;
+  }
+
+  void GetObject(Object* obj) {
+    obj->set_bin(GetStr());
+    obj->set_process(GetStr());
+    obj->set_signal(Get<uint8_t>());
+    obj->set_analysis(GetStr());
+    obj->set_era(GetStr());
+    obj->set_channel(GetStr());
+    obj->set_bin_id(Get<int32_t>());
+    obj->set_mass(GetStr());
+    uint32_t n_attrs = Get<uint32_t>();
+    std::map<std::string, std::string> attrs;
+    for (uint32_t i = 0; i < n_attrs; ++i) {
+      std::string label = GetStr();
+      attrs[label] = GetStr();
+    }
+    obj->set_all_attributes(attrs);
+  }
+
+  std::unique_ptr<TH1> GetHist() {
+    uint8_t type = Get<uint8_t>();
+    if (type == kNoHist) return nullptr;
+    std::string name = GetStr();
+    std::string title = GetStr();
+    int32_t n = Get<int32_t>();
+    uint64_t offset = Get<uint64_t>();
+    bool has_sumw2 = Get<uint8_t>();
+    double entries = Get<double>();
+    uint64_t n_vals = uint64_t(n + 1) + (has_sumw2 ? 2 : 1) * uint64_t(n + 2);
+    if ((type != kTH1F && type != kTH1D) || n < 1 || offset > data_size_ ||
+        n_vals > data_size_ - offset) {
+      throw std::runtime_error(FNERROR("Snapshot file is corrupt"));
+    }
+    double const* edges = data_ + offset;
+    double const* content = edges + n + 1;
+    std::unique_ptr<TH1> h;
+    if (type == kTH1F) {
+      h.reset(new TH1F(name.c_str(), title.c_str(), n, edges));
+    } else {
+      h.reset(new TH1D(name.c_str(), title.c_str(), n, edges));
+    }
+    h->SetDirectory(0);
+    h->SetContent(content);
+    if (has_sumw2) {
+      h->Sumw2();
+      h->GetSumw2()->Set(n + 2, content + n + 2);
+    } else if (h->GetSumw2N() > 0) {
+      h->Sumw2(false);
+    }
+    h->SetEntries(entries);
+    return h;
+  }
+
+  bool AtEnd() const { return pos_ == meta_end_; }
+
+ private:
+  char const* base_ = nullptr;
+  std::size_t size_ = 0;
+  char const* pos_ = nullptr;
+  char const* meta_end_ = nullptr;
+  double const* data_ = nullptr;
+  uint64_t data_size_ = 0;
+
+  void Need(std::size_t n) const {
+    if (n > std::size_t(meta_end_ - pos_)) {
+      throw std::runtime_error(FNERROR("Snapshot file is truncated or corrupt"));
+    }
+  }
+
+  void Unmap() {
+    if (base_) munmap(const_cast<char*>(base_), size_);
+    base_ = nullptr;
+  }
+};
+}
+
+void CombineHarvester::SaveSnapshot(std::string const& path) {
+  // Check first that everything can be stored
+  for (auto const& obs : obs_) {
+    if (obs->data()) {
+      throw std::runtime_error(FNERROR(
+          "Observations with RooAbsData can't be stored in a snapshot"));
+    }
+  }
+  for (auto const& proc : procs_) {
+    if (proc->pdf() || proc->data() || proc->norm()) {
+      throw std::runtime_error(FNERROR(
+          "Processes with RooFit objects can't be stored in a snapshot"));
+    }
+  }
+  for (auto const& sys : systs_) {
+    if (sys->data_u() || sys->data_d()) {
+      throw std::runtime_error(FNERROR(
+          "Systematics with RooDataHist shapes can't be stored in a snapshot"));
+    }
+  }
+  // The only workspace we can handle is the one holding simple rateParams,
+  // which is recreated from the parameter names on loading
+  std::vector<std::pair<std::string, bool>> rate_vars;
+  for (auto const& it : wspaces_) {
+    if (it.first != "_rateParams") {
+      throw std::runtime_error(
+          FNERROR("Workspace " + it.first + " can't be stored in a snapshot"));
+    }
+    if (it.second->allFunctions().getSize() > 0) {
+      throw std::runtime_error(FNERROR(
+          "rateParam functions can't be stored in a snapshot"));
+    }
+    RooArgSet vars = it.second->allVars();
+    RooFIter vars_it = vars.fwdIterator();
+    RooAbsArg *var = nullptr;
+    while ((var = vars_it.next())) {
+      rate_vars.emplace_back(var->GetName(), var->getAttribute("extArg"));
+    }
+  }
+
+  SnapshotWriter out;
+  out.Put<uint32_t>(obs_.size());
+  for (auto const& obs : obs_) {
+    out.PutObject(*obs);
+    out.Put<double>(obs->rate());
+    out.PutHist(obs->shape());
+  }
+  out.Put<uint32_t>(procs_.size());
+  for (auto const& proc : procs_) {
+    out.PutObject(*proc);
+    out.Put<double>(proc->no_norm_rate());
+    out.PutHist(proc->shape());
+  }
+  out.Put<uint32_t>(systs_.size());
+  for (auto const& sys : systs_) {
+    out.PutObject(*sys);
+    out.PutStr(sys->name());
+    out.PutStr(sys->type());
+    out.Put<double>(sys->value_u());
+    out.Put<double>(sys->value_d());
+    out.Put<double>(sys->scale());
+    out.Put<uint8_t>(sys->asymm());
+    out.PutHist(sys->shape_u());
+    out.PutHist(sys->shape_d());
+  }
+  unsigned n_params = 0;
+  for (auto const& it : params_) {
+    if (it.second) ++n_params;
+  }
+  out.Put<uint32_t>(n_params);
+  for (auto const& it : params_) {
+    if (!it.second) continue;
+    Parameter & par = *(it.second);
+    out.PutStr(par.name());
+    out.Put<double>(par.val());
+    out.Put<double>(par.err_u());
+    out.Put<double>(par.err_d());
+    out.Put<double>(par.range_u());
+    out.Put<double>(par.range_d());
+    out.Put<uint8_t>(par.frozen());
+    out.Put<uint32_t>(par.groups().size());
+    for (auto const& grp : par.groups()) out.PutStr(grp);
+  }
+  out.Put<uint32_t>(rate_vars.size());
+  for (auto const& var : rate_vars) {
+    out.PutStr(var.first);
+    out.Put<uint8_t>(var.second);
+  }
+  out.Put<uint32_t>(auto_stats_settings_.size());
+  for (auto const& it : auto_stats_settings_) {
+    out.PutStr(it.first);
+    out.Put<double>(it.second.event_threshold);
+    out.Put<uint8_t>(it.second.include_signal);
+    out.Put<int32_t>(it.second.hist_mode);
+  }
+  out.Put<uint32_t>(post_lines_.size());
+  for (auto const& line : post_lines_) out.PutStr(line);
+  out.Write(path);
+}
+
+void CombineHarvester::LoadSnapshot(std::string const& path) {
+  SnapshotReader in(path);
+  bool add_dir = TH1::AddDirectoryStatus();
+  TH1::AddDirectory(false);
+
+  // Read everything before modifying this instance, so that it is left
+  // unchanged if the file turns out to be corrupt
+  std::vector<std::shared_ptr<Observation>> new_obs;
+  std::vector<std::shared_ptr<Process>> new_procs;
+  std::vector<std::shared_ptr<Systematic>> new_systs;
+  std::vector<Parameter> new_params;
+  std::vector<std::pair<std::string, bool>> rate_vars;
+  std::map<std::string, AutoMCStatsSettings> new_stats;
+  std::vector<std::string> new_lines;
+  try {
+    uint32_t n_obs = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_obs; ++i) {
+      auto obs = std::make_shared<Observation>();
+      in.GetObject(obs.get());
+      obs->set_rate(in.Get<double>());
+      obs->set_shape(in.GetHist(), false);
+      new_obs.push_back(obs);
+    }
+    uint32_t n_procs = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_procs; ++i) {
+      auto proc = std::make_shared<Process>();
+      in.GetObject(proc.get());
+      proc->set_rate(in.Get<double>());
+      proc->set_shape(in.GetHist(), false);
+      new_procs.push_back(proc);
+    }
+    uint32_t n_systs = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_systs; ++i) {
+      auto sys = std::make_shared<Systematic>();
+      in.GetObject(sys.get());
+      sys->set_name(in.GetStr());
+      sys->set_type(in.GetStr());
+      sys->set_value_u(in.Get<double>());
+      sys->set_value_d(in.Get<double>());
+      sys->set_scale(in.Get<double>());
+      sys->set_asymm(in.Get<uint8_t>());
+      std::unique_ptr<TH1> shape_u = in.GetHist();
+      std::unique_ptr<TH1> shape_d = in.GetHist();
+      sys->set_shapes(std::move(shape_u), std::move(shape_d), nullptr);
+      new_systs.push_back(sys);
+    }
+    uint32_t n_params = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_params; ++i) {
+      Parameter par;
+      par.set_name(in.GetStr());
+      par.set_val(in.Get<double>());
+      par.set_err_u(in.Get<double>());
+      par.set_err_d(in.Get<double>());
+      par.set_range_u(in.Get<double>());
+      par.set_range_d(in.Get<double>());
+      par.set_frozen(in.Get<uint8_t>());
+      uint32_t n_groups = in.Get<uint32_t>();
+      for (uint32_t g = 0; g < n_groups; ++g) par.groups().insert(in.GetStr());
+      new_params.push_back(par);
+    }
+    uint32_t n_rate_vars = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_rate_vars; ++i) {
+      std::string name = in.GetStr();
+      rate_vars.emplace_back(name, in.Get<uint8_t>());
+    }
+    uint32_t n_stats = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_stats; ++i) {
+      std::string bin = in.GetStr();
+      double thresh = in.Get<double>();
+      bool sig = in.Get<uint8_t>();
+      new_stats[bin] = AutoMCStatsSettings(thresh, sig, in.Get<int32_t>());
+    }
+    uint32_t n_lines = in.Get<uint32_t>();
+    for (uint32_t i = 0; i < n_lines; ++i) new_lines.push_back(in.GetStr());
+    if (!in.AtEnd()) {
+      throw std::runtime_error(FNERROR("Snapshot file is corrupt"));
+    }
+  } catch (...) {
+    TH1::AddDirectory(add_dir);
+    throw;
+  }
+  TH1::AddDirectory(add_dir);
+
+  index_.reset();
+  for (auto const& obs : new_obs) obs_.push_back(obs);
+  for (auto const& proc : new_procs) procs_.push_back(proc);
+  for (auto const& sys : new_systs) systs_.push_back(sys);
+  for (auto & par : new_params) {
+    if (params_.count(par.name()) && params_.at(par.name())) {
+      // Keep any links to existing RooRealVars
+      Parameter * existing = params_.at(par.name()).get();
+      par.vars() = existing->vars();
+      *existing = par;
+      bool frozen = existing->frozen();
+      existing->set_frozen(false);
+      existing->set_val(existing->val());
+      existing->set_frozen(frozen);
+    } else {
+      params_[par.name()] = std::make_shared<Parameter>(par);
+    }
+  }
+  for (auto const& var : rate_vars) {
+    Parameter * par = params_.count(var.first) ? params_.at(var.first).get()
+                                                : nullptr;
+    double val = par ? par->val() : 0.;
+    bool frozen = par ? par->frozen() : false;
+    if (par) par->set_frozen(false);
+    Parameter * rate_par = SetupRateParamVar(var.first, val, var.second);
+    rate_par->set_frozen(frozen);
+  }
+  for (auto const& it : new_stats) auto_stats_settings_[it.first] = it.second;
+  post_lines_.insert(post_lines_.end(), new_lines.begin(), new_lines.end());
+}
+}
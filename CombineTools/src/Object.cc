@@ -2,6 +2,8 @@
 #include <iostream>
 namespace ch {
 
+unsigned long Object::key_edits_ = 0;
+
 Object::Object()
     : bin_(""),
       process_(""),
@@ -10,13 +12,15 @@ Object::Object()
       era_(""),
       channel_(""),
       bin_id_(0),
-      mass_("") {
+      mass_(""),
+      indexed_(false) {
   }
 
 Object::~Object() { }
 
 void swap(Object& first, Object& second) {
   using std::swap;
+  if (first.indexed_ || second.indexed_) ++Object::key_edits_;
   swap(first.bin_, second.bin_);
   swap(first.process_, second.process_);
   swap(first.signal_, second.signal_);
@@ -37,7 +41,8 @@ Object::Object(Object const& other)
       channel_(other.channel_),
       bin_id_(other.bin_id_),
       mass_(other.mass_),
-      attributes_(other.attributes_) {
+      attributes_(other.attributes_),
+      indexed_(false) {
 }
 
 Object::Object(Object&& other)
@@ -48,7 +53,8 @@ Object::Object(Object&& other)
       era_(""),
       channel_(""),
       bin_id_(0),
-      mass_("") {
+      mass_(""),
+      indexed_(false) {
   swap(*this, other);
 }
 
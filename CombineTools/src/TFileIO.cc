@@ -1,18 +1,141 @@
 #include "CombineHarvester/CombineTools/interface/TFileIO.h"
+#include <algorithm>
+#include <atomic>
+#include <list>
+#include <map>
 #include <memory>
+#include <mutex>
+#include <set>
 #include <string>
+#include <thread>
+#include <unordered_map>
+#include <utility>
 #include <vector>
+#include "boost/filesystem.hpp"
+#include "boost/lexical_cast.hpp"
 #include "TFile.h"
 #include "TH1.h"
+#include "TKey.h"
+#include "TROOT.h"
 #include "TDirectory.h"
 #include "CombineHarvester/CombineTools/interface/Logging.h"
 
 namespace ch {
 
+namespace {
+struct TFileCache {
+  std::mutex mtx;
+  unsigned max_files = 64;
+  std::size_t max_hist_bytes = 512 * 1024 * 1024;
+  std::size_t hist_bytes = 0;
+
+  // Both lists are kept in order of use, most recent first
+  typedef std::pair<std::string, std::shared_ptr<TFile>> FileEntry;
+  typedef std::pair<std::string, std::shared_ptr<TH1 const>> HistEntry;
+  std::list<FileEntry> files;
+  std::list<HistEntry> hists;
+  std::unordered_map<std::string, std::list<FileEntry>::iterator> file_pos;
+  std::unordered_map<std::string, std::list<HistEntry>::iterator> hist_pos;
+
+  void Trim() {
+    while (files.size() > max_files) {
+      file_pos.erase(files.back().first);
+      files.pop_back();
+    }
+    while (hist_bytes > max_hist_bytes) {
+      hist_bytes -= HistBytes(*(hists.back().second));
+      hist_pos.erase(hists.back().first);
+      hists.pop_back();
+    }
+  }
+
+  static std::size_t HistBytes(TH1 const& h) {
+    std::size_t n = h.GetNcells();
+    if (h.GetSumw2N() > 0) n *= 2;
+    return n * sizeof(double) + sizeof(TH1);
+  }
+};
+
+TFileCache& Cache() {
+  static TFileCache cache;
+  return cache;
+}
+
+// Identifies the current version of the file on disk. If the file can't be
+// found (e.g. a remote path) only the path as given is used.
+std::string FileKey(std::string const& path) {
+  boost::system::error_code ec;
+  boost::filesystem::path full = boost::filesystem::canonical(path, ec);
+  if (ec) return path;
+  std::time_t mtime = boost::filesystem::last_write_time(full, ec);
+  if (ec) return full.string();
+  return full.string() + ":" + boost::lexical_cast<std::string>(mtime);
+}
+
+std::string HistKey(std::string const& file_key, std::string const& path) {
+  return file_key + ":" + path;
+}
+
+std::unique_ptr<TH1> CloneTH1(TH1 const& h) {
+  std::unique_ptr<TH1> res(static_cast<TH1*>(h.Clone()));
+  res->SetDirectory(0);
+  return res;
+}
+
+std::shared_ptr<TH1 const> FindCachedTH1(std::string const& key) {
+  TFileCache& cache = Cache();
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  auto it = cache.hist_pos.find(key);
+  if (it == cache.hist_pos.end()) return nullptr;
+  cache.hists.splice(cache.hists.begin(), cache.hists, it->second);
+  return it->second->second;
+}
+
+void InsertCachedTH1(std::string const& key, std::unique_ptr<TH1> h) {
+  TFileCache& cache = Cache();
+  std::size_t bytes = TFileCache::HistBytes(*h);
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  if (bytes > cache.max_hist_bytes || cache.hist_pos.count(key)) return;
+  cache.hists.emplace_front(key, std::shared_ptr<TH1 const>(std::move(h)));
+  cache.hist_pos[key] = cache.hists.begin();
+  cache.hist_bytes += bytes;
+  cache.Trim();
+}
+
+bool UseTH1Cache(TFile* file) {
+  if (std::string(file->GetOption()) != "READ") return false;
+  TFileCache& cache = Cache();
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  return cache.max_hist_bytes > 0;
+}
+
+// Estimates the memory needed for an object from the uncompressed size of
+// its key, returns zero if there is no such object
+std::size_t ObjectBytes(TFile* file, std::string const& path) {
+  std::size_t slash = path.find_last_of('/');
+  TDirectory* dir = file;
+  std::string name = path;
+  if (slash != path.npos) {
+    dir = file->GetDirectory(path.substr(0, slash).c_str());
+    name = path.substr(slash + 1);
+  }
+  if (!dir) return 0;
+  TKey* key = dir->GetKey(name.c_str());
+  return key ? key->GetObjlen() : 0;
+}
+}
+
 std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path) {
   if (!file) {
     throw std::runtime_error(FNERROR("Supplied ROOT file pointer is null"));
   }
+  std::string key;
+  bool use_cache = UseTH1Cache(file);
+  if (use_cache) {
+    key = HistKey(FileKey(file->GetName()), path);
+    std::shared_ptr<TH1 const> cached = FindCachedTH1(key);
+    if (cached) return CloneTH1(*cached);
+  }
   TDirectory* backup_dir = gDirectory;
   file->cd();
   if (!gDirectory->Get(path.c_str())) {
@@ -29,6 +152,135 @@ std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path) {
   }
   res->SetDirectory(0);
   gDirectory = backup_dir;
+  if (use_cache) InsertCachedTH1(key, CloneTH1(*res));
   return res;
 }
+
+std::shared_ptr<TFile> GetCachedTFile(std::string const& path) {
+  std::string key = FileKey(path);
+  TFileCache& cache = Cache();
+  {
+    std::lock_guard<std::mutex> lock(cache.mtx);
+    auto it = cache.file_pos.find(key);
+    if (it != cache.file_pos.end()) {
+      cache.files.splice(cache.files.begin(), cache.files, it->second);
+      return it->second->second;
+    }
+  }
+  auto file = std::make_shared<TFile>(path.c_str());
+  // Don't keep hold of files that failed to open, so that the error is
+  // reported again if the same path is requested later
+  if (!file->IsOpen() || file->IsZombie()) return file;
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  if (cache.file_pos.count(key)) return cache.file_pos.at(key)->second;
+  cache.files.emplace_front(key, file);
+  cache.file_pos[key] = cache.files.begin();
+  cache.Trim();
+  return file;
+}
+
+void SetTFileCacheLimits(unsigned max_files, std::size_t max_hist_bytes) {
+  TFileCache& cache = Cache();
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  cache.max_files = max_files;
+  cache.max_hist_bytes = max_hist_bytes;
+  cache.Trim();
+}
+
+void ClearTFileCache() {
+  TFileCache& cache = Cache();
+  std::lock_guard<std::mutex> lock(cache.mtx);
+  cache.files.clear();
+  cache.file_pos.clear();
+  cache.hists.clear();
+  cache.hist_pos.clear();
+  cache.hist_bytes = 0;
+}
+
+unsigned PrefetchTH1s(
+    std::vector<std::pair<std::string, std::string>> const& objects,
+    unsigned n_threads, bool* hit_limit) {
+  if (n_threads == 0) {
+    n_threads = std::max(1u, std::thread::hardware_concurrency());
+  }
+  if (hit_limit) *hit_limit = false;
+  std::size_t max_bytes = 0;
+  {
+    TFileCache& cache = Cache();
+    std::lock_guard<std::mutex> lock(cache.mtx);
+    max_bytes = cache.max_hist_bytes;
+  }
+  if (max_bytes == 0) return 0;
+  // Take the objects not yet in the cache, in order, for as long as they fit
+  // in it. Reading any more would only evict the first ones before they are
+  // used
+  std::vector<std::string> files;
+  std::map<std::string, std::pair<std::string, std::vector<std::string>>> todo;
+  std::set<std::string> seen;
+  std::size_t total_bytes = 0;
+  for (auto const& obj : objects) {
+    if (!todo.count(obj.first)) {
+      files.push_back(obj.first);
+      todo[obj.first].first = FileKey(obj.first);
+    }
+    std::string key = HistKey(todo[obj.first].first, obj.second);
+    if (seen.count(key) || FindCachedTH1(key)) continue;
+    seen.insert(key);
+    std::shared_ptr<TFile> file = GetCachedTFile(obj.first);
+    if (!file->IsOpen() || file->IsZombie()) continue;
+    std::size_t bytes = ObjectBytes(file.get(), obj.second);
+    if (bytes == 0) continue;
+    if (total_bytes + bytes > max_bytes) {
+      if (hit_limit) *hit_limit = true;
+      break;
+    }
+    total_bytes += bytes;
+    todo[obj.first].second.push_back(obj.second);
+  }
+  // Split the objects to be read from each file into at most n_threads
+  // chunks, so that a single large file is also read in parallel
+  struct Chunk {
+    std::string file;
+    std::string file_key;
+    std::vector<std::string> paths;
+  };
+  std::vector<Chunk> chunks;
+  for (auto const& name : files) {
+    std::string const& file_key = todo[name].first;
+    std::vector<std::string> const& paths = todo[name].second;
+    if (paths.empty()) continue;
+    unsigned n_chunks = std::min<std::size_t>(n_threads, paths.size());
+    for (unsigned c = 0; c < n_chunks; ++c) {
+      Chunk chunk{name, file_key, {}};
+      for (unsigned i = c; i < paths.size(); i += n_chunks) {
+        chunk.paths.push_back(paths[i]);
+      }
+      chunks.push_back(std::move(chunk));
+    }
+  }
+  if (chunks.empty()) return 0;
+
+  ROOT::EnableThreadSafety();
+  std::atomic<unsigned> next_chunk(0);
+  std::atomic<unsigned> n_read(0);
+  auto worker = [&]() {
+    for (unsigned c = next_chunk++; c < chunks.size(); c = next_chunk++) {
+      Chunk const& chunk = chunks[c];
+      std::unique_ptr<TFile> file(TFile::Open(chunk.file.c_str(), "READ"));
+      if (!file || !file->IsOpen() || file->IsZombie()) continue;
+      for (auto const& path : chunk.paths) {
+        TH1* h = dynamic_cast<TH1*>(file->Get(path.c_str()));
+        if (!h) continue;
+        h->SetDirectory(0);
+        InsertCachedTH1(HistKey(chunk.file_key, path), std::unique_ptr<TH1>(h));
+        ++n_read;
+      }
+    }
+  };
+  unsigned n_workers = std::min<std::size_t>(n_threads, chunks.size());
+  std::vector<std::thread> workers;
+  for (unsigned t = 0; t < n_workers; ++t) workers.emplace_back(worker);
+  for (auto& t : workers) t.join();
+  return n_read;
+}
 }